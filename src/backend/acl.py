@@ -0,0 +1,361 @@
+# Cisco拡張ACLのコンパイルと照合
+# 各エントリを次元 (プロトコル・送信元・宛先・ポート・ICMPタイプ) ごとのビット集合に索引化し、
+# 全次元のビット集合のANDの最下位ビットを「最初に一致したエントリ」とする
+
+import ipaddress
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+PROTOCOLS = {
+    "ip": None, "icmp": 1, "igmp": 2, "ipinip": 4, "tcp": 6, "udp": 17,
+    "gre": 47, "esp": 50, "ahp": 51, "eigrp": 88, "ospf": 89, "pim": 103,
+}
+
+# IOSで使われる代表的なポート名
+PORT_NAMES = {
+    "bgp": 179, "bootpc": 68, "bootps": 67, "domain": 53, "echo": 7, "ftp": 21,
+    "ftp-data": 20, "http": 80, "www": 80, "https": 443, "isakmp": 500,
+    "ntp": 123, "pop3": 110, "smtp": 25, "snmp": 161, "snmptrap": 162,
+    "ssh": 22, "syslog": 514, "tacacs": 49, "telnet": 23, "tftp": 69,
+}
+
+PORT_MAX = 65535
+ALL_PORTS = ((0, PORT_MAX),)
+
+# ICMPのメッセージ名 -> (タイプ, コード) - コードが None の名前はタイプ内の全コードに一致する
+ICMP_NAMES = {
+    "echo-reply": (0, None), "unreachable": (3, None), "net-unreachable": (3, 0), "host-unreachable": (3, 1),
+    "protocol-unreachable": (3, 2), "port-unreachable": (3, 3), "packet-too-big": (3, 4),
+    "administratively-prohibited": (3, 13), "source-quench": (4, None), "redirect": (5, None),
+    "net-redirect": (5, 0), "host-redirect": (5, 1), "alternate-address": (6, None), "echo": (8, None),
+    "router-advertisement": (9, None), "router-solicitation": (10, None), "time-exceeded": (11, None),
+    "ttl-exceeded": (11, 0), "reassembly-timeout": (11, 1), "parameter-problem": (12, None),
+    "timestamp-request": (13, None), "timestamp-reply": (14, None), "information-request": (15, None),
+    "information-reply": (16, None), "mask-request": (17, None), "mask-reply": (18, None),
+    "traceroute": (30, None),
+}
+
+# 照合に影響しないオプション (これ以外の修飾子は解析エラーにして、黙って無視しない)
+IGNORED_OPTIONS = ("log", "log-input")
+
+class ACLParseError(ValueError):
+    def __init__(self, line: str, reason: str, index: Optional[int] = None):
+        self.line = line
+        self.reason = reason
+        self.index = index
+        where = f"entry {index}: " if index is not None else ""
+        super().__init__(f"{where}{reason}: '{line}'")
+
+class ACLRule:
+    def __init__(self, index: int, line: str, action: str, protocol: Optional[int],
+                 src: Tuple[int, int], src_ports: Optional[Tuple[Tuple[int, int], ...]],
+                 dst: Tuple[int, int], dst_ports: Optional[Tuple[Tuple[int, int], ...]],
+                 established: bool, icmp: Optional[Tuple[int, Optional[int]]] = None):
+        self.index = index
+        self.line = line
+        self.action = action
+        self.protocol = protocol
+        # (アドレス, ワイルドカード) - ワイルドカードのビットは無視される
+        self.src = src
+        self.dst = dst
+        self.src_ports = src_ports
+        self.dst_ports = dst_ports
+        self.established = established
+        # ICMPの (タイプ, コード) - コードが None の場合はタイプ内の全コード
+        self.icmp = icmp
+
+def _parse_ip(token: str, line: str) -> int:
+    try:
+        return int(ipaddress.IPv4Address(token))
+    except ValueError:
+        raise ACLParseError(line, f"invalid address {token}")
+
+def _parse_address(tokens: List[str], pos: int, line: str) -> Tuple[Tuple[int, int], int]:
+    if pos >= len(tokens):
+        raise ACLParseError(line, "missing address")
+    token = tokens[pos]
+    if token == "any":
+        return (0, 0xFFFFFFFF), pos + 1
+    if token == "host":
+        if pos + 1 >= len(tokens):
+            raise ACLParseError(line, "missing host address")
+        return (_parse_ip(tokens[pos + 1], line), 0), pos + 2
+    if pos + 1 >= len(tokens):
+        raise ACLParseError(line, "missing wildcard mask")
+    address = _parse_ip(token, line)
+    wildcard = _parse_ip(tokens[pos + 1], line)
+    return (address & ~wildcard & 0xFFFFFFFF, wildcard), pos + 2
+
+def _parse_port(token: str, line: str) -> int:
+    port = PORT_NAMES.get(token)
+    if port is None:
+        if not token.isdigit():
+            raise ACLParseError(line, f"unknown port {token}")
+        port = int(token)
+    if port > PORT_MAX:
+        raise ACLParseError(line, f"port out of range {token}")
+    return port
+
+def _parse_ports(tokens: List[str], pos: int, line: str) -> Tuple[Optional[Tuple[Tuple[int, int], ...]], int]:
+    if pos >= len(tokens):
+        return None, pos
+    op = tokens[pos]
+    if op == "range":
+        if pos + 2 >= len(tokens):
+            raise ACLParseError(line, "incomplete port range")
+        low, high = _parse_port(tokens[pos + 1], line), _parse_port(tokens[pos + 2], line)
+        return ((min(low, high), max(low, high)),), pos + 3
+    if op in ("eq", "neq", "lt", "gt"):
+        if pos + 1 >= len(tokens):
+            raise ACLParseError(line, f"missing port after {op}")
+        if op == "lt":
+            port = _parse_port(tokens[pos + 1], line)
+            return ((0, port - 1),) if port > 0 else (), pos + 2
+        if op == "gt":
+            port = _parse_port(tokens[pos + 1], line)
+            return ((port + 1, PORT_MAX),) if port < PORT_MAX else (), pos + 2
+        # eq/neqは複数ポートを並べられる
+        ports = []
+        end = pos + 1
+        while end < len(tokens) and (tokens[end].isdigit() or tokens[end] in PORT_NAMES):
+            ports.append(_parse_port(tokens[end], line))
+            end += 1
+        if not ports:
+            raise ACLParseError(line, f"missing port after {op}")
+        if op == "eq":
+            return tuple((port, port) for port in sorted(set(ports))), end
+        intervals = []
+        low = 0
+        for port in sorted(set(ports)):
+            if port > low:
+                intervals.append((low, port - 1))
+            low = port + 1
+        if low <= PORT_MAX:
+            intervals.append((low, PORT_MAX))
+        return tuple(intervals), end
+    return None, pos
+
+def _parse_icmp(tokens: List[str], pos: int, line: str) -> Tuple[Optional[Tuple[int, Optional[int]]], int]:
+    # メッセージ名、またはタイプ番号 (続けてコード番号) を読む
+    if pos >= len(tokens):
+        return None, pos
+    token = tokens[pos]
+    if token in ICMP_NAMES:
+        return ICMP_NAMES[token], pos + 1
+    if not token.isdigit():
+        return None, pos
+    icmp_type = int(token)
+    if icmp_type > 255:
+        raise ACLParseError(line, f"ICMP type out of range {token}")
+    if pos + 1 < len(tokens) and tokens[pos + 1].isdigit():
+        icmp_code = int(tokens[pos + 1])
+        if icmp_code > 255:
+            raise ACLParseError(line, f"ICMP code out of range {tokens[pos + 1]}")
+        return (icmp_type, icmp_code), pos + 2
+    return (icmp_type, None), pos + 1
+
+def parse_entry(line: str, index: int = 0) -> Optional[ACLRule]:
+    tokens = line.split()
+    # シーケンス番号を読み飛ばす
+    if tokens and tokens[0].isdigit():
+        tokens = tokens[1:]
+    if not tokens or tokens[0] == "remark":
+        return None
+    action = tokens[0]
+    if action not in ("permit", "deny"):
+        raise ACLParseError(line, f"unknown action {action}", index)
+    if len(tokens) < 2:
+        raise ACLParseError(line, "missing protocol", index)
+    proto_token = tokens[1]
+    if proto_token in PROTOCOLS:
+        protocol = PROTOCOLS[proto_token]
+    elif proto_token.isdigit() and int(proto_token) <= 255:
+        protocol = int(proto_token)
+    else:
+        raise ACLParseError(line, f"unknown protocol {proto_token}", index)
+    try:
+        src, pos = _parse_address(tokens, 2, line)
+        src_ports, pos = _parse_ports(tokens, pos, line) if protocol in (6, 17) else (None, pos)
+        dst, pos = _parse_address(tokens, pos, line)
+        dst_ports, pos = _parse_ports(tokens, pos, line) if protocol in (6, 17) else (None, pos)
+        icmp, pos = _parse_icmp(tokens, pos, line) if protocol == 1 else (None, pos)
+    except ACLParseError as e:
+        raise ACLParseError(line, e.reason, index)
+    established = False
+    for option in tokens[pos:]:
+        if option == "established" and protocol == 6:
+            established = True
+        elif option not in IGNORED_OPTIONS:
+            # 照合できない修飾子 (dscp / fragments / time-range など) を無視すると本来より広く一致してしまう
+            raise ACLParseError(line, f"unsupported option {option}", index)
+    return ACLRule(index, line, action, protocol, src, src_ports, dst, dst_ports, established, icmp)
+
+class _AddressIndex:
+    # マスクごとのハッシュ表 - 連続したマスクならプレフィックス長ごとの表と同じで、
+    # 最長一致ではなく一致する全エントリのビットを集める
+    # 照合コストはエントリ数ではなく異なるマスクの種類数に比例する
+    def __init__(self):
+        self.by_mask: Dict[int, Dict[int, int]] = {}
+        self.tables: List[Tuple[int, Dict[int, int]]] = []
+
+    def add(self, bit: int, address: int, wildcard: int):
+        mask = ~wildcard & 0xFFFFFFFF
+        table = self.by_mask.setdefault(mask, {})
+        table[address] = table.get(address, 0) | bit
+
+    def freeze(self):
+        self.tables = sorted(self.by_mask.items())
+
+    def lookup(self, address: int) -> int:
+        bits = 0
+        for mask, table in self.tables:
+            bits |= table.get(address & mask, 0)
+        return bits
+
+class _PortIndex:
+    # ポート範囲の境界で区切った区間ごとに一致するエントリのビット集合を持つ
+    def __init__(self, entries: List[Tuple[int, Optional[Tuple[Tuple[int, int], ...]]]]):
+        bounds = {0}
+        for _, intervals in entries:
+            for low, high in ALL_PORTS if intervals is None else intervals:
+                bounds.add(low)
+                if high < PORT_MAX:
+                    bounds.add(high + 1)
+        self.starts = sorted(bounds)
+        self.unconstrained = 0
+        # 区間の開始と終了でビットを反転し、累積XORで各区間の集合を求める
+        # (1エントリ内の区間は互いに重ならない)
+        toggles = [0] * (len(self.starts) + 1)
+        for bit, intervals in entries:
+            if intervals is None:
+                self.unconstrained |= bit
+            for low, high in ALL_PORTS if intervals is None else intervals:
+                toggles[bisect_right(self.starts, low) - 1] ^= bit
+                toggles[bisect_right(self.starts, high)] ^= bit
+        self.bits = []
+        current = 0
+        for toggle in toggles[:-1]:
+            current ^= toggle
+            self.bits.append(current)
+
+    def lookup(self, port: Optional[int]) -> int:
+        if port is None:
+            return self.unconstrained
+        return self.bits[bisect_right(self.starts, port) - 1]
+
+class _ICMPIndex:
+    # タイプのみ・タイプとコードの指定ごとに一致するエントリのビット集合を持つ
+    def __init__(self):
+        self.unconstrained = 0
+        self.by_type: Dict[int, int] = {}
+        self.by_type_code: Dict[Tuple[int, int], int] = {}
+
+    def add(self, bit: int, icmp: Optional[Tuple[int, Optional[int]]]):
+        if icmp is None:
+            self.unconstrained |= bit
+        elif icmp[1] is None:
+            self.by_type[icmp[0]] = self.by_type.get(icmp[0], 0) | bit
+        else:
+            self.by_type_code[icmp] = self.by_type_code.get(icmp, 0) | bit
+
+    def lookup(self, icmp_type: Optional[int], icmp_code: Optional[int]) -> int:
+        if icmp_type is None:
+            return self.unconstrained
+        bits = self.unconstrained | self.by_type.get(icmp_type, 0)
+        if icmp_code is not None:
+            bits |= self.by_type_code.get((icmp_type, icmp_code), 0)
+        return bits
+
+class CompiledACL:
+    def __init__(self, name: str, entries: Sequence[str]):
+        self.name = name
+        self.rules: List[ACLRule] = []
+        for index, line in enumerate(entries):
+            rule = parse_entry(line, index)
+            if rule is not None:
+                self.rules.append(rule)
+
+        self._any_protocol = 0
+        self._by_protocol: Dict[int, int] = {}
+        self._established = 0
+        self._src = _AddressIndex()
+        self._dst = _AddressIndex()
+        self._icmp = _ICMPIndex()
+        src_ports = []
+        dst_ports = []
+        for position, rule in enumerate(self.rules):
+            bit = 1 << position
+            if rule.protocol is None:
+                self._any_protocol |= bit
+            else:
+                self._by_protocol[rule.protocol] = self._by_protocol.get(rule.protocol, 0) | bit
+            if rule.established:
+                self._established |= bit
+            self._src.add(bit, *rule.src)
+            self._dst.add(bit, *rule.dst)
+            self._icmp.add(bit, rule.icmp)
+            src_ports.append((bit, rule.src_ports))
+            dst_ports.append((bit, rule.dst_ports))
+        self._src.freeze()
+        self._dst.freeze()
+        self._src_ports = _PortIndex(src_ports)
+        self._dst_ports = _PortIndex(dst_ports)
+
+    def match(self, protocol: int, src: int, dst: int, src_port: Optional[int] = None,
+              dst_port: Optional[int] = None, established: bool = False, icmp_type: Optional[int] = None,
+              icmp_code: Optional[int] = None) -> Optional[ACLRule]:
+        bits = self._any_protocol | self._by_protocol.get(protocol, 0)
+        if not established:
+            bits &= ~self._established
+        if bits:
+            bits &= self._src.lookup(src)
+        if bits:
+            bits &= self._dst.lookup(dst)
+        if bits:
+            bits &= self._src_ports.lookup(src_port if protocol in (6, 17) else None)
+        if bits:
+            bits &= self._dst_ports.lookup(dst_port if protocol in (6, 17) else None)
+        if bits and protocol == 1:
+            bits &= self._icmp.lookup(icmp_type, icmp_code)
+        if not bits:
+            return None
+        return self.rules[(bits & -bits).bit_length() - 1]
+
+    def evaluate(self, flow: Dict[str, Union[str, int, None]]) -> Dict[str, Union[str, int, None]]:
+        rule = self.match(
+            parse_protocol(flow.get("protocol", "tcp")),
+            int(ipaddress.IPv4Address(flow["src"])),
+            int(ipaddress.IPv4Address(flow["dst"])),
+            flow.get("src_port"),
+            flow.get("dst_port"),
+            bool(flow.get("established", False)),
+            flow.get("icmp_type"),
+            flow.get("icmp_code"),
+        )
+        if rule is None:
+            # 暗黙のdeny
+            return {"action": "deny", "entry": None, "line": None}
+        return {"action": rule.action, "entry": rule.index, "line": rule.line}
+
+    def evaluate_batch(self, flows: Sequence[Dict[str, Union[str, int, None]]]) -> List[Dict[str, Union[str, int, None]]]:
+        return [self.evaluate(flow) for flow in flows]
+
+def parse_protocol(value: Union[str, int]) -> int:
+    if isinstance(value, int) or value.isdigit():
+        # IPのプロトコル番号は8ビット
+        if not 0 <= int(value) <= 255:
+            raise ValueError(f"protocol number {value} out of range (0-255)")
+        return int(value)
+    protocol = PROTOCOLS.get(value.lower())
+    if protocol is None:
+        raise ValueError(f"unknown protocol {value}")
+    return protocol
+
+@lru_cache(maxsize=1024)
+def _compile_cached(name: str, entries: Tuple[str, ...]) -> CompiledACL:
+    return CompiledACL(name, entries)
+
+def compile_acl(name: str, entries: Sequence[str]) -> CompiledACL:
+    # 同じ内容のACLは一度だけコンパイルする
+    return _compile_cached(name, tuple(entries))
@@ -0,0 +1,354 @@
+# REST / WebSocket APIの負荷試験とベンチマーク
+# アプリをプロセス内 (ASGI直接) または実ソケット (uvicorn) で起動し、
+# 並行クライアントのスループット・レイテンシ (p50/p95/p99)・WebSocketの遅延・接続あたりのメモリを計測する
+#
+# 使い方:
+#   python benchmark.py --rest-clients 50 --ws-clients 20 --duration 10 --save-baseline baseline.json
+#   python benchmark.py --rest-clients 50 --ws-clients 20 --duration 10 --baseline baseline.json
+# ベースラインと比較して悪化した指標があれば終了コード1を返す
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+try:
+    import websockets
+except ImportError:  # websocketsが無い環境ではソケット経由のWebSocket計測は行えない
+    websockets = None
+
+DEFAULT_ENDPOINTS = (
+    "/router/{ip}/info",
+    "/router/{ip}/interfaces",
+    "/router/{ip}/acls",
+    "/router/{ip}/ping?target=10.0.0.2",
+)
+WS_COMMANDS = ("ping", "traceroute", "set_scenario")
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(q * len(ordered)) - 1)
+    return ordered[rank]
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, name: str, seconds: float):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def error(self, name: str):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for name in sorted(set(self.samples) | set(self.errors)):
+            values = self.samples.get(name) or [0.0]
+            result[name] = {
+                "count": len(self.samples.get(name, [])),
+                "errors": self.errors.get(name, 0),
+                "throughput": round(len(self.samples.get(name, [])) / elapsed, 2) if elapsed else None,
+                "mean_ms": round(sum(values) / len(values) * 1000, 3),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+                "max_ms": round(max(values) * 1000, 3),
+            }
+        return result
+
+class ASGIWebSocketClient:
+    # uvicornを介さずにASGIアプリへ直接WebSocket接続する
+    def __init__(self, app, path: str):
+        self.app = app
+        self.path = path
+        self._to_app: asyncio.Queue = asyncio.Queue()
+        self._from_app: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": self.path,
+            "raw_path": self.path.encode(),
+            "query_string": b"",
+            "headers": [],
+            "client": ("127.0.0.1", 0),
+            "server": ("testserver", 80),
+            "subprotocols": [],
+        }
+        self._task = asyncio.create_task(self.app(scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await self._from_app.get()
+        if message["type"] != "websocket.accept":
+            raise ConnectionError(f"WebSocket rejected: {message}")
+
+    async def send_json(self, data: Dict[str, Any]):
+        await self._to_app.put({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive_json(self) -> Dict[str, Any]:
+        message = await self._from_app.get()
+        if message["type"] == "websocket.close":
+            raise ConnectionError(f"WebSocket closed ({message.get('code')})")
+        return json.loads(message.get("text") or message.get("bytes"))
+
+    async def close(self):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, 5)
+            except (asyncio.TimeoutError, Exception):
+                self._task.cancel()
+
+class SocketWebSocketClient:
+    def __init__(self, url: str):
+        self.url = url
+        self._connection = None
+
+    async def connect(self):
+        self._connection = await websockets.connect(self.url, max_queue=None)
+
+    async def send_json(self, data: Dict[str, Any]):
+        await self._connection.send(json.dumps(data))
+
+    async def receive_json(self) -> Dict[str, Any]:
+        return json.loads(await self._connection.recv())
+
+    async def close(self):
+        await self._connection.close()
+
+async def rest_worker(client: httpx.AsyncClient, recorder: LatencyRecorder, endpoints: List[str],
+                      routers: List[str], deadline: float, rng: random.Random):
+    while time.perf_counter() < deadline:
+        template = rng.choice(endpoints)
+        url = template.format(ip=rng.choice(routers))
+        name = "GET " + template.split("?")[0]
+        # プロセス内ではI/O待ちが発生せず1つのクライアントがループを独占するため、毎回制御を返す
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        try:
+            response = await client.get(url)
+            if response.status_code >= 400:
+                recorder.error(name)
+                continue
+        except httpx.HTTPError:
+            recorder.error(name)
+            continue
+        recorder.record(name, time.perf_counter() - started)
+
+async def ws_worker(ws, client_id: str, recorder: LatencyRecorder, scenario_names: List[str],
+                    deadline: float, rng: random.Random):
+    # 1クライアントずつコマンドを順に送り、最初の応答までの遅延 (lag) と完了までの時間を測る
+    sequence = 0
+    while time.perf_counter() < deadline:
+        command = rng.choice(WS_COMMANDS)
+        sequence += 1
+        request_id = f"{client_id}-{sequence}"
+        message: Dict[str, Any] = {"command": command, "request_id": request_id}
+        if command == "set_scenario":
+            message["scenario"] = rng.choice(scenario_names)
+        else:
+            message["target"] = "10.0.0.2"
+        started = time.perf_counter()
+        try:
+            await ws.send_json(message)
+            first = None
+            while True:
+                frame = await asyncio.wait_for(ws.receive_json(), 30)
+                now = time.perf_counter()
+                if command == "set_scenario":
+                    if frame.get("type") in ("scenario_changed", "error"):
+                        break
+                    continue
+                if frame.get("request_id") != request_id:
+                    continue
+                if first is None:
+                    first = now
+                    recorder.record("ws lag", first - started)
+                if frame.get("type") in ("command_result", "error", "command_cancelled"):
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            recorder.error(f"ws {command}")
+            return
+        recorder.record(f"ws {command}", time.perf_counter() - started)
+
+async def _run_clients(app, base_url: str, ws_factory: Callable[[str], Any], args,
+                       routers: List[str], scenario_names: List[str]) -> Dict[str, Any]:
+    recorder = LatencyRecorder()
+    rng = random.Random(args.seed)
+    transport = httpx.ASGITransport(app=app) if app is not None else None
+    limits = httpx.Limits(max_connections=args.rest_clients or 1, max_keepalive_connections=args.rest_clients or 1)
+    async with httpx.AsyncClient(base_url=base_url, transport=transport, limits=limits, timeout=30) as client:
+        # WebSocket接続を確立し、その間に確保されたメモリから接続あたりの使用量を求める
+        sockets = []
+        memory_per_connection = None
+        if args.ws_clients:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            for index in range(args.ws_clients):
+                ws = ws_factory(f"bench-{index}")
+                await ws.connect()
+                sockets.append(ws)
+            memory_per_connection = round((tracemalloc.get_traced_memory()[0] - before) / args.ws_clients)
+            tracemalloc.stop()
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+        workers = [
+            rest_worker(client, recorder, args.endpoints, routers, deadline, random.Random(rng.random()))
+            for _ in range(args.rest_clients)
+        ] + [
+            ws_worker(ws, f"bench-{index}", recorder, scenario_names, deadline, random.Random(rng.random()))
+            for index, ws in enumerate(sockets)
+        ]
+        await asyncio.gather(*workers)
+        elapsed = time.perf_counter() - started
+        for ws in sockets:
+            await ws.close()
+
+    metrics = recorder.summary(elapsed)
+    rest_total = sum(value["count"] for name, value in metrics.items() if name.startswith("GET "))
+    ws_total = sum(value["count"] for name, value in metrics.items()
+                   if name.startswith("ws ") and name != "ws lag")
+    return {
+        "elapsed": round(elapsed, 3),
+        "rest_throughput": round(rest_total / elapsed, 2),
+        "ws_throughput": round(ws_total / elapsed, 2),
+        "ws_memory_per_connection": memory_per_connection,
+        "metrics": metrics,
+    }
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    # シミュレーターの設定は main の読み込み時に環境変数から決まる
+    os.environ["SIM_ROUTERS"] = str(args.routers)
+    os.environ["SIM_LATENCY"] = args.latency
+    os.environ["SIM_SEED"] = str(args.seed)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    routers = list(main.router_data)
+    scenario_names = list(main.scenarios)
+    if args.mode == "inprocess":
+        async with main.app.router.lifespan_context(main.app):
+            result = await _run_clients(
+                main.app, "http://testserver",
+                lambda client_id: ASGIWebSocketClient(main.app, f"/ws/{client_id}"),
+                args, routers, scenario_names
+            )
+    else:
+        import uvicorn
+        if args.ws_clients and websockets is None:
+            raise SystemExit("socket mode with --ws-clients requires the 'websockets' package")
+        config = uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+        server = uvicorn.Server(config)
+        serve_task = asyncio.create_task(server.serve())
+        while not server.started:
+            if serve_task.done():
+                serve_task.result()
+            await asyncio.sleep(0.05)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        try:
+            result = await _run_clients(
+                None, f"http://127.0.0.1:{port}",
+                lambda client_id: SocketWebSocketClient(f"ws://127.0.0.1:{port}/ws/{client_id}"),
+                args, routers, scenario_names
+            )
+        finally:
+            server.should_exit = True
+            await serve_task
+
+    result["config"] = {
+        "mode": args.mode,
+        "rest_clients": args.rest_clients,
+        "ws_clients": args.ws_clients,
+        "duration": args.duration,
+        "routers": len(routers),
+        "latency": args.latency,
+        "seed": args.seed,
+    }
+    return result
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float,
+            min_delta_ms: float = 0.5) -> List[str]:
+    # レイテンシはtolerance以上の悪化 (かつ min_delta_ms 以上の差)、スループットはtolerance以上の低下を回帰とする
+    regressions = []
+    for key in ("rest_throughput", "ws_throughput"):
+        old, new = baseline.get(key), result.get(key)
+        if old and new is not None and new < old * (1 - tolerance):
+            regressions.append(f"{key}: {old} -> {new}")
+    old_memory, new_memory = baseline.get("ws_memory_per_connection"), result.get("ws_memory_per_connection")
+    if old_memory and new_memory and new_memory > old_memory * (1 + tolerance):
+        regressions.append(f"ws_memory_per_connection: {old_memory} -> {new_memory} bytes")
+    for name, metrics in result["metrics"].items():
+        old_metrics = baseline.get("metrics", {}).get(name)
+        if not old_metrics:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            old, new = old_metrics[key], metrics[key]
+            if new > old * (1 + tolerance) and new - old >= min_delta_ms:
+                regressions.append(f"{name} {key}: {old} -> {new}")
+    return regressions
+
+def print_report(result: Dict[str, Any]):
+    config = result["config"]
+    print(f"mode={config['mode']} rest_clients={config['rest_clients']} ws_clients={config['ws_clients']} "
+          f"routers={config['routers']} latency={config['latency']} elapsed={result['elapsed']}s")
+    print(f"REST throughput: {result['rest_throughput']} req/s, WebSocket throughput: {result['ws_throughput']} cmd/s")
+    if result["ws_memory_per_connection"] is not None:
+        print(f"Memory per WebSocket connection: {result['ws_memory_per_connection']} bytes")
+    print(f"{'metric':<36}{'count':>8}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, metrics in result["metrics"].items():
+        print(f"{name:<36}{metrics['count']:>8}{metrics['errors']:>6}{metrics['p50_ms']:>10}"
+              f"{metrics['p95_ms']:>10}{metrics['p99_ms']:>10}{metrics['max_ms']:>10}")
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the network diagnostics API")
+    parser.add_argument("--mode", choices=("inprocess", "socket"), default="inprocess")
+    parser.add_argument("--rest-clients", type=int, default=20)
+    parser.add_argument("--ws-clients", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--routers", type=int, default=100, help="number of simulated routers")
+    parser.add_argument("--latency", default="zero", help="simulated device latency distribution")
+    parser.add_argument("--endpoints", nargs="+", default=list(DEFAULT_ENDPOINTS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=0, help="port for socket mode (0 = any free port)")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--save-baseline", help="store the results as a baseline")
+    parser.add_argument("--baseline", help="compare against a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run_benchmark(args))
+    print_report(result)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != result["config"]:
+            print("warning: baseline was recorded with a different configuration")
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,315 @@
+# showコマンド出力のテンプレートパーサー
+# TextFSM形式のサブセット (Value / 状態 / ルールとアクション) を解釈する
+# テンプレートは一度だけコンパイルしてキャッシュし、複数の出力にまとめて適用する
+
+import re
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+VALUE_OPTIONS = {"Filldown", "Required", "List", "Key"}
+LINE_ACTIONS = {"Next", "Continue"}
+RECORD_ACTIONS = {"Record", "NoRecord", "Clear", "Clearall"}
+
+class TemplateError(ValueError):
+    pass
+
+class _Value:
+    def __init__(self, name: str, pattern: str, options: Iterable[str]):
+        self.name = name
+        self.pattern = pattern
+        self.options = set(options)
+
+class _Rule:
+    def __init__(self, regex: re.Pattern, line_action: str, record_action: Optional[str],
+                 new_state: Optional[str], error: bool):
+        self.regex = regex
+        self.line_action = line_action
+        self.record_action = record_action
+        self.new_state = new_state
+        self.error = error
+
+_VALUE_LINE = re.compile(r"^Value\s+(?:(\S+)\s+)?(\w+)\s+(\(.*\))\s*$")
+_RULE_LINE = re.compile(r"^\s+\^(.*?)(?:\s+->\s+(.*))?$")
+_VAR = re.compile(r"\$\{(\w+)\}|\$(\w+)")
+
+class CompiledTemplate:
+    def __init__(self, name: str, source: str):
+        self.name = name
+        self.values: List[_Value] = []
+        self.states: Dict[str, List[_Rule]] = {}
+        self._parse(source)
+        if "Start" not in self.states:
+            raise TemplateError(f"{name}: missing Start state")
+
+    def _parse(self, source: str):
+        lines = source.strip("\n").splitlines()
+        state: Optional[str] = None
+        for number, line in enumerate(lines, 1):
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            if line.startswith("Value "):
+                match = _VALUE_LINE.match(line)
+                if not match:
+                    raise TemplateError(f"{self.name}:{number}: invalid Value line")
+                options = match.group(1).split(",") if match.group(1) else []
+                unknown = set(options) - VALUE_OPTIONS
+                if unknown:
+                    raise TemplateError(f"{self.name}:{number}: unknown option {unknown}")
+                self.values.append(_Value(match.group(2), match.group(3), options))
+            elif not line[0].isspace():
+                state = line.strip()
+                self.states[state] = []
+            else:
+                if state is None:
+                    raise TemplateError(f"{self.name}:{number}: rule outside of a state")
+                self.states[state].append(self._compile_rule(line, number))
+        for rules in self.states.values():
+            for rule in rules:
+                if rule.new_state and rule.new_state not in self.states and rule.new_state != "End":
+                    raise TemplateError(f"{self.name}: unknown state {rule.new_state}")
+
+    def _compile_rule(self, line: str, number: int) -> _Rule:
+        match = _RULE_LINE.match(line)
+        if not match:
+            raise TemplateError(f"{self.name}:{number}: invalid rule")
+        patterns = {value.name: value.pattern for value in self.values}
+
+        def substitute(var: re.Match) -> str:
+            name = var.group(1) or var.group(2)
+            if name not in patterns:
+                raise TemplateError(f"{self.name}:{number}: unknown value {name}")
+            return f"(?P<{name}>{patterns[name][1:-1]})"
+
+        # "$$" は行末を表す
+        regex = re.compile("^" + _VAR.sub(substitute, match.group(1)).replace("$$", "$"))
+        line_action, record_action, new_state, error = "Next", None, None, False
+        for token in (match.group(2) or "").split():
+            parts = token.split(".")
+            for part in parts:
+                if part in LINE_ACTIONS:
+                    line_action = part
+                elif part in RECORD_ACTIONS:
+                    record_action = part
+                elif part == "Error":
+                    error = True
+                else:
+                    new_state = part
+        return _Rule(regex, line_action, record_action, new_state, error)
+
+    def parse(self, text: str) -> List[Dict[str, Any]]:
+        records: List[Dict[str, Any]] = []
+        current = self._empty_record()
+        state = "Start"
+        for line in text.splitlines():
+            if state == "End":
+                break
+            for rule in self.states[state]:
+                match = rule.regex.match(line)
+                if not match:
+                    continue
+                if rule.error:
+                    raise TemplateError(f"{self.name}: unexpected line '{line}'")
+                for name, value in match.groupdict().items():
+                    if value is None:
+                        continue
+                    if isinstance(current[name], list):
+                        current[name].append(value)
+                    else:
+                        current[name] = value
+                if rule.record_action == "Record":
+                    self._record(records, current)
+                    current = self._empty_record(current)
+                elif rule.record_action == "Clear":
+                    current = self._empty_record(current)
+                elif rule.record_action == "Clearall":
+                    current = self._empty_record()
+                if rule.new_state:
+                    state = rule.new_state
+                if rule.line_action == "Next":
+                    break
+        # 入力の終わりでは暗黙的にRecordする
+        self._record(records, current)
+        return records
+
+    def _empty_record(self, previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        record = {}
+        for value in self.values:
+            if previous is not None and "Filldown" in value.options:
+                record[value.name] = previous[value.name]
+            else:
+                record[value.name] = [] if "List" in value.options else None
+        return record
+
+    def _record(self, records: List[Dict[str, Any]], record: Dict[str, Any]):
+        # Filldown以外の値が空のレコードと、Required値が欠けたレコードは捨てる
+        if not any(record[value.name] for value in self.values if "Filldown" not in value.options):
+            return
+        if any(not record[value.name] for value in self.values if "Required" in value.options):
+            return
+        records.append(dict(record))
+
+# 標準テンプレート
+TEMPLATES: Dict[str, str] = {
+    "show ip interface brief": r"""
+Value Required name (\S+)
+Value ip (\S+)
+Value status (up|down|administratively down|deleted)
+Value protocol (up|down)
+
+Start
+  ^Interface\s+IP-Address -> Next
+  ^${name}\s+${ip}\s+\S+\s+\S+\s+${status}\s+${protocol}\s*$$ -> Record
+""",
+    "show version": r"""
+Value software (.+?)
+Value version ([^\s,]+)
+Value rom (.+)
+Value hostname (\S+)
+Value uptime (.+)
+Value image (\S+)
+Value model (\S+)
+Value serial_number (\S+)
+
+Start
+  ^Cisco IOS Software,\s+${software},\s+Version\s+${version}
+  ^ROM:\s+${rom}
+  ^${hostname}\s+uptime\s+is\s+${uptime}
+  ^System image file is "${image}"
+  ^[Cc]isco\s+${model}\s+\(.*\)\s+processor
+  ^Processor board ID\s+${serial_number}
+""",
+    "show interfaces": r"""
+Value Required name (\S+)
+Value status (up|down|administratively down)
+Value protocol (up|down)
+Value hardware (.+?)
+Value description (.+)
+Value ip (\S+)
+Value mtu (\d+)
+Value bandwidth (\d+)
+Value duplex (\S+)
+Value speed (\S+)
+Value input_packets (\d+)
+Value input_errors (\d+)
+Value output_packets (\d+)
+Value output_errors (\d+)
+
+Start
+  ^\S+\s+is\s+ -> Continue.Record
+  ^${name}\s+is\s+${status},\s+line\s+protocol\s+is\s+${protocol}
+  ^\s+Hardware\s+is\s+${hardware}(,|\s*$$)
+  ^\s+Description:\s+${description}
+  ^\s+Internet\s+address\s+is\s+${ip}
+  ^\s+MTU\s+${mtu}\s+bytes,\s+BW\s+${bandwidth}\s+Kbit
+  ^\s+${duplex}-duplex,\s+${speed},
+  ^\s+${input_packets}\s+packets\s+input
+  ^\s+${input_errors}\s+input\s+errors
+  ^\s+${output_packets}\s+packets\s+output
+  ^\s+${output_errors}\s+output\s+errors
+""",
+    "ping": r"""
+Value sent (\d+)
+Value received (\d+)
+Value success_rate (\d+)
+Value rtt_min (\d+)
+Value rtt_avg (\d+)
+Value rtt_max (\d+)
+
+Start
+  ^Success\s+rate\s+is\s+${success_rate}\s+percent\s+\(${received}/${sent}\)(,\s+round-trip\s+min/avg/max\s+=\s+${rtt_min}/${rtt_avg}/${rtt_max}\s+ms)?
+""",
+}
+
+# 省略形コマンド (例: "sh ip int br") を正式なテンプレート名に解決する
+@lru_cache(maxsize=4096)
+def resolve_command(command: str) -> Optional[str]:
+    words = command.split()
+    for name in sorted(TEMPLATES, key=len, reverse=True):
+        template_words = name.split()
+        if len(words) != len(template_words):
+            continue
+        if all(template_word.startswith(word) for word, template_word in zip(words, template_words)):
+            return name
+    return None
+
+_compiled: Dict[str, CompiledTemplate] = {}
+
+def get_template(name: str) -> CompiledTemplate:
+    template = _compiled.get(name)
+    if template is None:
+        if name not in TEMPLATES:
+            raise TemplateError(f"No template for '{name}'")
+        template = CompiledTemplate(name, TEMPLATES[name])
+        _compiled[name] = template
+    return template
+
+def register_template(name: str, source: str):
+    # 追加・上書きしたテンプレートは次回の利用時にコンパイルされる
+    TEMPLATES[name] = source
+    _compiled.pop(name, None)
+    resolve_command.cache_clear()
+
+def parse_output(command: str, output: str) -> List[Dict[str, Any]]:
+    name = resolve_command(command)
+    if name is None:
+        raise TemplateError(f"No template for '{command}'")
+    return get_template(name).parse(output)
+
+def parse_batch(items: Iterable[Tuple[str, str]]) -> List[Dict[str, Any]]:
+    # コンパイル済みのテンプレートを使い回して、複数の出力を一度に処理する
+    results = []
+    for command, output in items:
+        try:
+            results.append({"command": command, "template": resolve_command(command),
+                            "records": parse_output(command, output)})
+        except TemplateError as e:
+            results.append({"command": command, "template": None, "records": [], "error": str(e)})
+    return results
+
+# 既存のAPIモデルへの変換
+def interfaces_from_records(brief: List[Dict[str, Any]],
+                            details: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Dict[str, str]]:
+    detail_by_name = {record["name"]: record for record in details or []}
+    interfaces = {}
+    for record in brief:
+        detail = detail_by_name.get(record["name"], {})
+        speed = detail.get("speed") or "auto"
+        if speed.lower().startswith("auto"):
+            speed = "auto"
+        interfaces[record["name"]] = {
+            "name": record["name"],
+            "status": record["status"] or detail.get("status") or "unknown",
+            "protocol": record["protocol"] or detail.get("protocol") or "unknown",
+            "ip": record["ip"] or "unassigned",
+            "speed": speed.replace("Mbps", "Mb/s").replace("Gbps", "Gb/s"),
+            "duplex": (detail.get("duplex") or "auto").lower(),
+        }
+    return interfaces
+
+_MODEL_FAMILY = re.compile(r"^C(\d+)")
+
+def router_info_from_version(records: List[Dict[str, Any]]) -> Dict[str, Optional[str]]:
+    # name は機種名 (例: C892FSP-K9 -> Cisco 892)、ホスト名は hostname に入れる
+    record = records[0] if records else {}
+    model = record.get("model")
+    family = _MODEL_FAMILY.match(model) if model else None
+    return {
+        "name": f"Cisco {family.group(1)}" if family else (f"Cisco {model}" if model else None),
+        "hostname": record.get("hostname"),
+        "model": model,
+        "serial_number": record.get("serial_number"),
+        "firmware_version": record.get("version"),
+        "uptime": record.get("uptime"),
+    }
+
+def ping_result_from_records(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    record = records[0] if records else {}
+    sent = int(record.get("sent") or 0)
+    received = int(record.get("received") or 0)
+    return {
+        "success": received > 0,
+        "packet_loss": round(100 * (sent - received) / sent) if sent else 100,
+        "rtt_min": float(record.get("rtt_min") or 0),
+        "rtt_avg": float(record.get("rtt_avg") or 0),
+        "rtt_max": float(record.get("rtt_max") or 0),
+    }
@@ -0,0 +1,158 @@
+# running-configのドリフト検出
+# コンフィグを階層ブロック (interface / ACL / line など) に分けてハッシュし、ハッシュが異なるブロックだけ差分を計算する
+# 分割結果・比較結果・ブロックの差分はいずれもハッシュをキーにキャッシュし、変更の無い機器の再チェックでは再計算しない
+
+import difflib
+import fnmatch
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config_parser import block_digest, iter_blocks
+
+# 子の行が無くてもそれ自体をひとつのブロックとして扱う見出し
+BLOCK_PREFIXES = (
+    "interface ", "ip access-list ", "ipv6 access-list ", "line ", "router ", "banner ",
+    "class-map ", "policy-map ", "vrf definition ", "route-map ",
+)
+
+# ブロック名 -> (ハッシュ, 行)
+Snapshot = Dict[str, Tuple[str, Tuple[str, ...]]]
+
+def block_key(header: str, children: List[str]) -> str:
+    if children or header.startswith(BLOCK_PREFIXES):
+        return header
+    words = header.split()
+    # 番号付きACLは1行ごとに分かれているため、番号単位でまとめる
+    if words[0] == "access-list" and len(words) > 1:
+        return f"access-list {words[1]}"
+    # その他の1行の設定は先頭のキーワードでまとめる (例: hostname / ip route / snmp-server)
+    if words[0] in ("ip", "ipv6", "no") and len(words) > 1:
+        return " ".join(words[:2])
+    return words[0]
+
+def split_config(text: str) -> Snapshot:
+    grouped: Dict[str, List[str]] = {}
+    for header, children in iter_blocks(text.splitlines()):
+        grouped.setdefault(block_key(header, children), []).extend([header] + [f" {line}" for line in children])
+    return {key: (block_digest(key, lines), tuple(lines)) for key, lines in grouped.items()}
+
+def _ignored(key: str, ignore: Sequence[str]) -> bool:
+    return any(fnmatch.fnmatchcase(key, pattern) for pattern in ignore)
+
+def _put(cache: "OrderedDict", key: Any, value: Any, limit: int):
+    cache[key] = value
+    if len(cache) > limit:
+        cache.popitem(last=False)
+
+class DriftEngine:
+    # 返す結果はキャッシュと共有されるため、呼び出し側で変更しないこと
+    def __init__(self, max_snapshots: int = 20000, max_reports: int = 50000, max_diffs: int = 20000,
+                 max_variants: int = 10):
+        self.max_snapshots = max_snapshots
+        self.max_reports = max_reports
+        self.max_diffs = max_diffs
+        # フリート比較で差分を返す亜種の数 (多い順)
+        self.max_variants = max_variants
+        self._snapshots: "OrderedDict[str, Snapshot]" = OrderedDict()
+        self._reports: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._diffs: "OrderedDict[tuple, List[str]]" = OrderedDict()
+        self.stats = {"snapshot_hits": 0, "snapshot_misses": 0, "report_hits": 0, "report_misses": 0,
+                      "diff_hits": 0, "diff_misses": 0}
+
+    def snapshot(self, text: str) -> Tuple[str, Snapshot]:
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        snapshot = self._snapshots.get(digest)
+        if snapshot is not None:
+            self._snapshots.move_to_end(digest)
+            self.stats["snapshot_hits"] += 1
+            return digest, snapshot
+        self.stats["snapshot_misses"] += 1
+        snapshot = split_config(text)
+        _put(self._snapshots, digest, snapshot, self.max_snapshots)
+        return digest, snapshot
+
+    def block_diff(self, key: str, expected: Optional[Tuple[str, Tuple[str, ...]]],
+                   actual: Optional[Tuple[str, Tuple[str, ...]]]) -> List[str]:
+        # 同じ内容の組み合わせは機器が違っても同じ差分になる
+        cache_key = (expected[0] if expected else None, actual[0] if actual else None)
+        diff = self._diffs.get(cache_key)
+        if diff is not None:
+            self._diffs.move_to_end(cache_key)
+            self.stats["diff_hits"] += 1
+            return diff
+        self.stats["diff_misses"] += 1
+        diff = list(difflib.unified_diff(expected[1] if expected else (), actual[1] if actual else (),
+                                         f"expected/{key}", f"actual/{key}", lineterm="", n=1))
+        _put(self._diffs, cache_key, diff, self.max_diffs)
+        return diff
+
+    def compare(self, text: str, golden: str, ignore: Sequence[str] = (), strict: bool = False) -> Dict[str, Any]:
+        # golden にあって機器に無いブロックは missing、機器にだけあるブロックは extra (strict の場合のみドリフト扱い)
+        digest, snapshot = self.snapshot(text)
+        golden_digest, expected = self.snapshot(golden)
+        cache_key = (digest, golden_digest, tuple(ignore), strict)
+        report = self._reports.get(cache_key)
+        if report is not None:
+            self._reports.move_to_end(cache_key)
+            self.stats["report_hits"] += 1
+            return report
+        self.stats["report_misses"] += 1
+        missing, changed, matched = [], [], 0
+        for key, block in expected.items():
+            if _ignored(key, ignore):
+                continue
+            actual = snapshot.get(key)
+            if actual is None:
+                missing.append({"block": key, "diff": self.block_diff(key, block, None)})
+            elif actual[0] != block[0]:
+                changed.append({"block": key, "diff": self.block_diff(key, block, actual)})
+            else:
+                matched += 1
+        extra = [key for key in snapshot if key not in expected and not _ignored(key, ignore)]
+        report = {
+            "digest": digest,
+            "golden_digest": golden_digest,
+            "in_sync": not missing and not changed and not (strict and extra),
+            "blocks": len(snapshot),
+            "matched": matched,
+            "missing": missing,
+            "changed": changed,
+            "extra": extra,
+        }
+        _put(self._reports, cache_key, report, self.max_reports)
+        return report
+
+    def compare_fleet(self, configs: Dict[str, str], ignore: Sequence[str] = ()) -> Dict[str, Any]:
+        # ブロックごとに内容の亜種を集計し、最も多い内容を基準として少数派との差分を返す
+        snapshots = {device: self.snapshot(text)[1] for device, text in configs.items()}
+        variants: Dict[str, Dict[str, List[str]]] = {}
+        for device, snapshot in snapshots.items():
+            for key, (digest, _) in snapshot.items():
+                if not _ignored(key, ignore):
+                    variants.setdefault(key, {}).setdefault(digest, []).append(device)
+        drifted = []
+        for key, by_digest in variants.items():
+            present = sum(len(devices) for devices in by_digest.values())
+            if len(by_digest) == 1 and present == len(snapshots):
+                continue
+            ranked = sorted(by_digest.items(), key=lambda item: (-len(item[1]), item[0]))
+            baseline_digest, baseline_devices = ranked[0]
+            baseline = snapshots[baseline_devices[0]][key]
+            drifted.append({
+                "block": key,
+                "baseline": {"digest": baseline_digest, "devices": len(baseline_devices)},
+                "variant_count": len(ranked) - 1,
+                "variants": [
+                    {"digest": digest, "devices": devices,
+                     "diff": self.block_diff(key, baseline, snapshots[devices[0]][key])}
+                    for digest, devices in ranked[1:1 + self.max_variants]
+                ],
+                "missing": [device for device, snapshot in snapshots.items() if key not in snapshot],
+            })
+        drifted.sort(key=lambda entry: entry["baseline"]["devices"] - len(snapshots))
+        return {"devices": len(snapshots), "blocks": len(variants), "drifted_blocks": drifted}
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "snapshots": len(self._snapshots), "reports": len(self._reports),
+                "diffs": len(self._diffs)}
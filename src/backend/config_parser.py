@@ -0,0 +1,347 @@
+# IOS running-configのストリーミングパーサー
+# 1行ずつ読み込み、トップレベルのブロック単位で解析する
+# 解析結果はブロック内容とコンフィグ全体のハッシュでキャッシュし、変更の無い部分は再解析しない
+
+import hashlib
+import re
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# 解析対象外の行
+SKIP_PATTERNS = (
+    re.compile(r"^Building configuration"),
+    re.compile(r"^Current configuration\s*:"),
+    re.compile(r"^Last configuration change"),
+    re.compile(r"^NVRAM config last updated"),
+)
+BANNER_PATTERN = re.compile(r"^banner\s+(\S+)\s+(\S)")
+
+def _empty_model() -> Dict[str, Any]:
+    return {
+        "hostname": None,
+        "version": None,
+        "interfaces": {},
+        "acls": {},
+        "routes": [],
+        "routing": {},
+        "lines": {},
+        "banners": {},
+        "global": [],
+    }
+
+# ブロック単位の解析 - (種別, キー, 値) を返す
+BlockResult = Tuple[str, Optional[str], Any]
+
+def _parse_interface(header: str, children: List[str]) -> BlockResult:
+    name = header.split(None, 1)[1]
+    interface: Dict[str, Any] = {
+        "name": name,
+        "description": None,
+        "ip": None,
+        "mask": None,
+        "secondary": [],
+        "shutdown": False,
+        "speed": None,
+        "duplex": None,
+        "access_groups": {},
+        "other": [],
+    }
+    for line in children:
+        words = line.split()
+        if words[:2] == ["ip", "address"] and len(words) >= 4:
+            if "secondary" in words[4:]:
+                interface["secondary"].append({"ip": words[2], "mask": words[3]})
+            else:
+                interface["ip"], interface["mask"] = words[2], words[3]
+        elif words[:2] == ["ip", "address"] and len(words) == 3 and words[2] == "dhcp":
+            interface["ip"] = "dhcp"
+        elif words[:3] == ["no", "ip", "address"]:
+            interface["ip"] = None
+        elif words[0] == "shutdown":
+            interface["shutdown"] = True
+        elif words[0] == "description":
+            interface["description"] = line.split(None, 1)[1] if len(words) > 1 else ""
+        elif words[0] in ("speed", "duplex") and len(words) > 1:
+            interface[words[0]] = words[1]
+        elif words[:2] == ["ip", "access-group"] and len(words) >= 4:
+            interface["access_groups"][words[3]] = words[2]
+        else:
+            interface["other"].append(line)
+    return "interface", name, interface
+
+def _parse_named_acl(header: str, children: List[str]) -> BlockResult:
+    words = header.split()
+    acl_type, name = words[2], words[3]
+    entries = [line for line in children if not line.startswith("remark")]
+    return "acl", name, {"name": name, "type": acl_type, "entries": entries}
+
+def _parse_numbered_acl(header: str, children: List[str]) -> BlockResult:
+    words = header.split()
+    number = words[1]
+    acl_type = "standard" if number.isdigit() and (int(number) < 100 or 1300 <= int(number) < 2000) else "extended"
+    entry = " ".join(words[2:])
+    return "acl_entry", number, {"name": number, "type": acl_type, "entry": entry}
+
+def _parse_route(header: str, children: List[str]) -> BlockResult:
+    words = header.split()
+    route: Dict[str, Any] = {"prefix": None, "mask": None, "next_hop": None, "distance": None, "vrf": None}
+    pos = 2
+    if words[pos:pos + 1] == ["vrf"] and len(words) > pos + 1:
+        route["vrf"] = words[pos + 1]
+        pos += 2
+    if len(words) >= pos + 3:
+        route["prefix"], route["mask"], route["next_hop"] = words[pos], words[pos + 1], words[pos + 2]
+        if len(words) > pos + 3 and words[pos + 3].isdigit():
+            route["distance"] = int(words[pos + 3])
+    return "route", None, route
+
+def _parse_router(header: str, children: List[str]) -> BlockResult:
+    words = header.split()
+    protocol = words[1]
+    process_id = words[2] if len(words) > 2 else None
+    key = f"{protocol} {process_id}" if process_id else protocol
+    networks = [line.split(None, 1)[1] for line in children if line.startswith("network ")]
+    neighbors = [line.split(None, 1)[1] for line in children if line.startswith("neighbor ")]
+    return "routing", key, {
+        "protocol": protocol,
+        "process_id": process_id,
+        "networks": networks,
+        "neighbors": neighbors,
+        "config": children,
+    }
+
+def _parse_line(header: str, children: List[str]) -> BlockResult:
+    name = header.split(None, 1)[1]
+    line_config: Dict[str, Any] = {"name": name, "transport_input": None, "login": None,
+                                   "exec_timeout": None, "access_class": None, "config": []}
+    for line in children:
+        words = line.split()
+        if words[:2] == ["transport", "input"]:
+            line_config["transport_input"] = words[2:]
+        elif words[0] == "login":
+            line_config["login"] = words[1] if len(words) > 1 else "line"
+        elif words[0] == "exec-timeout":
+            line_config["exec_timeout"] = " ".join(words[1:])
+        elif words[0] == "access-class" and len(words) >= 3:
+            line_config["access_class"] = {"name": words[1], "direction": words[2]}
+        elif words[0] == "password":
+            # パスワードは結果に含めない
+            line_config["config"].append("password <removed>")
+            continue
+        else:
+            line_config["config"].append(line)
+    return "line", name, line_config
+
+# 結果に含めない認証情報 (line ブロックのパスワードと同じく <removed> に置き換える)
+# 置き換えるのは暗号化の種別 (0/5/7 など) と秘密の値で、前後の設定はそのまま残す
+SECRET_PATTERNS = (
+    re.compile(r"^(\s*enable\s+(?:secret|password)(?:\s+level\s+\d+)?)\s+.*$"),
+    re.compile(r"^(\s*username\s+\S+(?:\s+\S+)*?\s+(?:password|secret))\s+.*$"),
+    re.compile(r"^(\s*snmp-server\s+community)\s+\S+"),
+    re.compile(r"^(\s*snmp-server\s+user\s+.*?\s+auth)\s+.*$"),
+    re.compile(r"^(\s*(?:tacacs-server|radius-server|crypto\s+isakmp)\s+key)(?:\s+\d)?\s+\S+"),
+    re.compile(r"^(\s*key-string)\s+.*$"),
+    # key chain の "key 1" (鍵の番号) は残し、サーバー定義の中の "key 7 ..." などを置き換える
+    re.compile(r"^(\s*key)(?:\s+\d)?\s+(?!\d+\s*$)\S+"),
+)
+
+def _redact_secrets(line: str) -> str:
+    for pattern in SECRET_PATTERNS:
+        match = pattern.match(line)
+        if match is not None:
+            return f"{match.group(1)} <removed>{line[match.end():]}"
+    return line
+
+def _parse_block(header: str, children: List[str]) -> BlockResult:
+    words = header.split()
+    if words[0] == "interface" and len(words) > 1:
+        return _parse_interface(header, children)
+    if words[:2] == ["ip", "access-list"] and len(words) >= 4 and words[2] in ("standard", "extended"):
+        return _parse_named_acl(header, children)
+    if words[0] == "access-list" and len(words) >= 3:
+        return _parse_numbered_acl(header, children)
+    if words[:2] == ["ip", "route"]:
+        return _parse_route(header, children)
+    if words[0] == "router" and len(words) > 1:
+        return _parse_router(header, children)
+    if words[0] == "line" and len(words) > 1:
+        return _parse_line(header, children)
+    if words[0] == "hostname" and len(words) > 1:
+        return "hostname", None, words[1]
+    if words[0] == "version" and len(words) > 1:
+        return "version", None, words[1]
+    if words[0] == "banner" and len(words) > 1:
+        return "banner", words[1], "\n".join(children).rstrip("\n")
+    return "global", None, [_redact_secrets(line) for line in [header] + children]
+
+def iter_blocks(lines: Iterable[str]) -> Iterator[Tuple[str, List[str]]]:
+    # トップレベルの行と、それに続くインデントされた行をひとつのブロックとして返す
+    header: Optional[str] = None
+    children: List[str] = []
+    banner_delimiter: Optional[str] = None
+    for raw in lines:
+        line = raw.rstrip("\r\n")
+        if banner_delimiter is not None:
+            # バナーは区切り文字が現れるまでインデント無しで続く
+            if banner_delimiter in line:
+                children.append(line.split(banner_delimiter, 1)[0])
+                yield header, children
+                header, children, banner_delimiter = None, [], None
+            else:
+                children.append(line)
+            continue
+        stripped = line.strip()
+        if not stripped or stripped.startswith("!"):
+            continue
+        if line[0] in " \t":
+            if header is not None:
+                children.append(stripped)
+            continue
+        if header is not None:
+            yield header, children
+            header, children = None, []
+        if stripped == "end" or any(pattern.match(stripped) for pattern in SKIP_PATTERNS):
+            continue
+        banner = BANNER_PATTERN.match(stripped)
+        if banner:
+            delimiter = banner.group(2)
+            # IOSは ^C を2文字で表示する
+            if stripped[banner.start(2):banner.start(2) + 2] == "^C":
+                delimiter = "^C"
+            header = f"banner {banner.group(1)}"
+            rest = stripped[banner.start(2) + len(delimiter):]
+            if delimiter in rest:
+                yield header, [rest.split(delimiter, 1)[0]]
+                header = None
+            else:
+                children = [rest] if rest else []
+                banner_delimiter = delimiter
+            continue
+        header = stripped
+    if header is not None:
+        yield header, children
+
+def block_digest(header: str, children: List[str]) -> str:
+    digest = hashlib.sha1(header.encode())
+    for line in children:
+        digest.update(b"\n")
+        digest.update(line.encode())
+    return digest.hexdigest()
+
+class RunningConfigParser:
+    # ブロック単位とコンフィグ全体の2段階でキャッシュする
+    # 返すモデルはキャッシュと共有されるため、呼び出し側で変更しないこと
+    def __init__(self, max_configs: int = 1024, max_blocks: int = 100000):
+        self.max_configs = max_configs
+        self.max_blocks = max_blocks
+        self._configs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._blocks: "OrderedDict[str, BlockResult]" = OrderedDict()
+        self.stats = {"config_hits": 0, "config_misses": 0, "block_hits": 0, "block_misses": 0}
+
+    def parse(self, source: Union[str, Iterable[str]]) -> Dict[str, Any]:
+        if isinstance(source, str):
+            # 文字列の場合は先にハッシュを計算して、変更が無ければ解析を省略する
+            digest = hashlib.sha256(source.encode()).hexdigest()
+            cached = self._get_config(digest)
+            if cached is not None:
+                return cached
+            return self._parse_lines(source.splitlines(), digest)
+        return self._parse_lines(source, None)
+
+    def _get_config(self, digest: str) -> Optional[Dict[str, Any]]:
+        cached = self._configs.get(digest)
+        if cached is None:
+            return None
+        self._configs.move_to_end(digest)
+        self.stats["config_hits"] += 1
+        return cached
+
+    def _parse_lines(self, lines: Iterable[str], digest: Optional[str]) -> Dict[str, Any]:
+        model = _empty_model()
+        content_hash = hashlib.sha256() if digest is None else None
+        block_hashes: List[str] = []
+        numbered_acls: set = set()
+
+        def hashed(source: Iterable[str]) -> Iterator[str]:
+            # ジェネレーター入力は読み込みながら全体のハッシュを計算する
+            for line in source:
+                content_hash.update(line.rstrip("\r\n").encode())
+                content_hash.update(b"\n")
+                yield line
+
+        for header, children in iter_blocks(hashed(lines) if content_hash is not None else lines):
+            bdigest = block_digest(header, children)
+            block_hashes.append(bdigest)
+            result = self._blocks.get(bdigest)
+            if result is None:
+                result = _parse_block(header, children)
+                self._blocks[bdigest] = result
+                self.stats["block_misses"] += 1
+                if len(self._blocks) > self.max_blocks:
+                    self._blocks.popitem(last=False)
+            else:
+                self._blocks.move_to_end(bdigest)
+                self.stats["block_hits"] += 1
+            self._merge(model, result, numbered_acls)
+
+        if content_hash is not None:
+            digest = content_hash.hexdigest()
+            cached = self._get_config(digest)
+            if cached is not None:
+                return cached
+        self.stats["config_misses"] += 1
+        model["digest"] = digest
+        model["block_digests"] = block_hashes
+        self._configs[digest] = model
+        if len(self._configs) > self.max_configs:
+            self._configs.popitem(last=False)
+        return model
+
+    @staticmethod
+    def _merge(model: Dict[str, Any], result: BlockResult, numbered_acls: set):
+        kind, key, value = result
+        if kind == "interface":
+            model["interfaces"][key] = value
+        elif kind == "acl":
+            model["acls"][key] = value
+        elif kind == "acl_entry":
+            # 番号付きACLは1行ごとのブロックなので、このコンフィグ専用の辞書に集める
+            if key not in numbered_acls:
+                existing = model["acls"].get(key)
+                model["acls"][key] = {
+                    "name": key,
+                    "type": value["type"],
+                    "entries": list(existing["entries"]) if existing else []
+                }
+                numbered_acls.add(key)
+            model["acls"][key]["entries"].append(value["entry"])
+        elif kind == "route":
+            model["routes"].append(value)
+        elif kind == "routing":
+            model["routing"][key] = value
+        elif kind == "line":
+            model["lines"][key] = value
+        elif kind == "banner":
+            model["banners"][key] = value
+        elif kind in ("hostname", "version"):
+            model[kind] = value
+        else:
+            model["global"].extend(value)
+
+def interfaces_from_config(model: Dict[str, Any]) -> Dict[str, Dict[str, str]]:
+    # コンフィグから分かる範囲でInterfaceInfo形式に変換する (運用状態は show コマンドで補う)
+    interfaces = {}
+    for name, interface in model["interfaces"].items():
+        down = interface["shutdown"]
+        interfaces[name] = {
+            "name": name,
+            "status": "administratively down" if down else "up",
+            "protocol": "down" if down else "up",
+            "ip": interface["ip"] or "unassigned",
+            "speed": f"{interface['speed']}Mb/s" if (interface["speed"] or "").isdigit() else (interface["speed"] or "auto"),
+            "duplex": interface["duplex"] or "auto",
+        }
+    return interfaces
+
+def acls_from_config(model: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"name": acl["name"], "entries": list(acl["entries"])} for acl in model["acls"].values()]
@@ -0,0 +1,200 @@
+# ルールベースの診断エンジン
+# ルーターの状態 (ファクト) から診断項目を導出し、入力が変化したルールだけを再評価する
+
+import logging
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ファクトのキーは "種別:名前" の形式 (例: "interface:GigabitEthernet1", "ping:10.0.0.2")
+Facts = Dict[str, Any]
+Issue = Dict[str, str]
+
+_MISSING = object()
+
+SEVERITY_ORDER = {"critical": 0, "high": 1, "medium": 2, "low": 3}
+STATUS_ORDER = {"healthy": 0, "warning": 1, "error": 2}
+
+# 問題の種類ごとの全体ステータスと要約
+ISSUE_STATUS = {
+    "interface_down": "error",
+    "ip_mismatch": "error",
+    "acl_too_restrictive": "warning",
+    "destination_unreachable": "warning",
+}
+ISSUE_SUMMARY = {
+    "interface_down": "インターフェースダウンを検出しました",
+    "ip_mismatch": "IP設定エラーを検出しました",
+    "acl_too_restrictive": "アクセスコントロールリストの問題を検出しました",
+    "destination_unreachable": "到達性の問題を検出しました",
+}
+HEALTHY_SUMMARY = "全てのシステムは正常に動作しています"
+
+class Rule:
+    def __init__(self, rule_id: str, inputs: Tuple[str, ...], check: Callable[..., List[Issue]]):
+        self.rule_id = rule_id
+        self.inputs = inputs
+        self.check = check
+
+    def evaluate(self, facts: Facts) -> List[Issue]:
+        return self.check(*(facts.get(key) for key in self.inputs))
+
+# ルール定義
+def _interface_down(interface: Optional[Dict[str, Any]]) -> List[Issue]:
+    # 管理上のshutdownは意図的なものなので対象外
+    if not interface or interface.get("status") != "down":
+        return []
+    name = interface.get("name", "")
+    return [{
+        "type": "interface_down",
+        "severity": "critical",
+        "description": f"{name} がダウンしています",
+        "recommendation": "物理接続を確認するか、'no shutdown'コマンドでインターフェースを有効にしてください"
+    }]
+
+def _ip_mismatch(interface: Optional[Dict[str, Any]], expected: Optional[Dict[str, Any]]) -> List[Issue]:
+    if not interface or not expected:
+        return []
+    expected_ip = expected.get("ip")
+    actual_ip = interface.get("ip")
+    if expected_ip in (None, "unassigned") or actual_ip == expected_ip:
+        return []
+    name = interface.get("name", "")
+    mask = expected.get("mask", "255.255.255.0")
+    return [{
+        "type": "ip_mismatch",
+        "severity": "high",
+        "description": f"{name}のIPアドレスが不一致: 期待値 {expected_ip}, 実際の値 {actual_ip}",
+        "recommendation": f"'ip address {expected_ip} {mask}'コマンドで正しいIPアドレスを設定してください"
+    }]
+
+def _acl_too_restrictive(name: str) -> Callable[[Optional[List[str]]], List[Issue]]:
+    def check(entries: Optional[List[str]]) -> List[Issue]:
+        if not entries:
+            return []
+        # 最初に全体を拒否するエントリがあれば、それ以降のpermitは評価されない
+        for entry in entries:
+            words = entry.split()
+            if words[:1] == ["permit"]:
+                return []
+            if words[:4] == ["deny", "ip", "any", "any"]:
+                return [{
+                    "type": "acl_too_restrictive",
+                    "severity": "high",
+                    "description": f"ACL '{name}'がすべてのトラフィックをブロックしています",
+                    "recommendation": "必要なトラフィックを許可するようにACL設定を見直して更新してください"
+                }]
+        return []
+    return check
+
+def _destination_unreachable(target: str) -> Callable[..., List[Issue]]:
+    def check(ping_result: Optional[Dict[str, Any]], hops: Optional[List[Dict[str, Any]]]) -> List[Issue]:
+        if not ping_result or ping_result.get("success", True):
+            return []
+        description = f"{target} への到達性がありません (パケットロス {ping_result.get('packet_loss', 100)}%)"
+        responding = [hop for hop in (hops or []) if hop.get("ip") not in (None, "*")]
+        if responding:
+            last = responding[-1]
+            description += f"。最後に応答したホップ: {last['hop']} ({last['ip']})"
+        return [{
+            "type": "destination_unreachable",
+            "severity": "medium",
+            "description": description,
+            "recommendation": "経路上のインターフェース状態、IP設定、ACLを確認してください"
+        }]
+    return check
+
+def build_rules(fact_key: str) -> List[Rule]:
+    # ファクトの種類に応じて、そのファクトを入力とするルールを生成する
+    kind, _, name = fact_key.partition(":")
+    if kind in ("interface", "expected_ip"):
+        return [
+            Rule(f"interface_down:{name}", (f"interface:{name}",), _interface_down),
+            Rule(f"ip_mismatch:{name}", (f"interface:{name}", f"expected_ip:{name}"), _ip_mismatch),
+        ]
+    if kind == "acl":
+        return [Rule(f"acl_too_restrictive:{name}", (fact_key,), _acl_too_restrictive(name))]
+    if kind in ("ping", "traceroute"):
+        return [Rule(f"destination_unreachable:{name}", (f"ping:{name}", f"traceroute:{name}"),
+                     _destination_unreachable(name))]
+    return []
+
+class _TargetState:
+    def __init__(self):
+        self.facts: Facts = {}
+        self.rules: Dict[str, Rule] = {}
+        self.issues: Dict[str, List[Issue]] = {}
+        self.index: Dict[str, Set[str]] = {}
+
+class DiagnosticEngine:
+    # 診断対象 (ルーターとシナリオの組など) ごとにファクトとルールの評価結果を保持する
+    def __init__(self, rule_factory: Callable[[str], List[Rule]] = build_rules):
+        self.rule_factory = rule_factory
+        self._targets: Dict[Any, _TargetState] = {}
+        self.evaluations = 0
+
+    def _state(self, target: Any) -> _TargetState:
+        state = self._targets.get(target)
+        if state is None:
+            state = _TargetState()
+            self._targets[target] = state
+        return state
+
+    def _register_rules(self, state: _TargetState, fact_key: str) -> Set[str]:
+        added = set()
+        for rule in self.rule_factory(fact_key):
+            if rule.rule_id in state.rules:
+                continue
+            state.rules[rule.rule_id] = rule
+            for key in rule.inputs:
+                state.index.setdefault(key, set()).add(rule.rule_id)
+            added.add(rule.rule_id)
+        return added
+
+    def update_facts(self, target: Any, changes: Facts, removed: Optional[List[str]] = None) -> Dict[str, Any]:
+        # 変化したファクトだけを受け取り、影響するルールのみ再評価する
+        state = self._state(target)
+        dirty: Set[str] = set()
+        for key, value in changes.items():
+            if key not in state.facts:
+                dirty |= self._register_rules(state, key)
+            elif state.facts[key] is value or state.facts[key] == value:
+                continue
+            state.facts[key] = value
+            dirty |= state.index.get(key, set())
+        for key in removed or []:
+            if state.facts.pop(key, _MISSING) is not _MISSING:
+                dirty |= state.index.get(key, set())
+        for rule_id in dirty:
+            state.issues[rule_id] = state.rules[rule_id].evaluate(state.facts)
+            self.evaluations += 1
+        if dirty:
+            logger.debug(f"Re-evaluated {len(dirty)} rule(s) for {target}")
+        return self.result(target)
+
+    def evaluate(self, target: Any, facts: Facts) -> Dict[str, Any]:
+        # 全ファクトを受け取り、前回との差分から再評価するルールを決める
+        state = self._state(target)
+        removed = [key for key in state.facts if key not in facts]
+        return self.update_facts(target, facts, removed)
+
+    def result(self, target: Any) -> Dict[str, Any]:
+        state = self._state(target)
+        # ルールの登録順 (ファクトの到着順) に依存しないよう、深刻度・ステータス・ルールIDの順に並べる
+        issues = [issue for rule_id in sorted(state.rules) for issue in state.issues.get(rule_id, [])]
+        if not issues:
+            return {"status": "healthy", "summary": HEALTHY_SUMMARY, "issues": []}
+        issues.sort(key=lambda issue: (SEVERITY_ORDER.get(issue["severity"], len(SEVERITY_ORDER)),
+                                       -STATUS_ORDER[ISSUE_STATUS.get(issue["type"], "warning")]))
+        status = max((ISSUE_STATUS.get(issue["type"], "warning") for issue in issues), key=STATUS_ORDER.get)
+        return {"status": status, "summary": ISSUE_SUMMARY.get(issues[0]["type"], issues[0]["description"]), "issues": issues}
+
+    def forget(self, target: Any):
+        self._targets.pop(target, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "targets": len(self._targets),
+            "rules": sum(len(state.rules) for state in self._targets.values()),
+            "evaluations": self.evaluations,
+        }
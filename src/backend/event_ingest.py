@@ -0,0 +1,523 @@
+# syslog (RFC 3164 / 5424) とSNMPv2cトラップの受信
+# 受信時はキューに積むだけにし、専用のタスクがまとめて解析・集約してから状態の更新を呼び出す
+# キューは上限付きで、溢れた場合や解析できない場合は理由ごとに破棄した件数を数える
+
+import asyncio
+import logging
+import os
+import re
+import socket
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (送信元アドレス, メッセージ中のホスト名またはアドレス) -> ルーターのIP
+Resolver = Callable[[str, Optional[str]], Optional[str]]
+BatchHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+class IngestError(Exception):
+    # reason は破棄した理由として集計する (parse_error / auth / unsupported)
+    def __init__(self, reason: str, message: str = ""):
+        super().__init__(message or reason)
+        self.reason = reason
+
+# syslog
+SYSLOG_PRI = re.compile(r"<(\d{1,3})>")
+RFC5424_HEADER = re.compile(r"(\d{1,2}) (\S+) (\S+) (\S+) (\S+) (\S+) ")
+RFC3164_HEADER = re.compile(r"([A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d) (\S+) ")
+# Ciscoのメッセージ (例: %LINK-3-UPDOWN: Interface GigabitEthernet0/1, changed state to down)
+CISCO_MESSAGE = re.compile(r"%([A-Z0-9_]+)-(\d)-([A-Z0-9_]+): (.*)")
+LINK_STATE = re.compile(r"Interface (\S+), changed state to (administratively down|up|down)")
+LINEPROTO_STATE = re.compile(r"Line protocol on Interface (\S+), changed state to (up|down)")
+ACL_LOG = re.compile(r"list (\S+) (permitted|denied) .*?(\d+) packets?")
+
+def _skip_structured_data(text: str) -> str:
+    # RFC 5424 の構造化データ ("-" または [...] の並び) を読み飛ばす
+    if text.startswith("-"):
+        return text[2:]
+    depth = 0
+    escaped = False
+    for index, char in enumerate(text):
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+        elif depth == 0:
+            return text[index + 1:] if char == " " else text[index:]
+    return ""
+
+def parse_syslog(data: bytes) -> Optional[Dict[str, Any]]:
+    # 状態に関係するメッセージは {"kind", "host", ...} を返し、それ以外はNoneを返す
+    text = data.decode("utf-8", "replace").rstrip("\r\n\x00")
+    pri = SYSLOG_PRI.match(text)
+    if pri is None:
+        raise IngestError("parse_error", "Missing syslog priority")
+    rest = text[pri.end():]
+    host = None
+    header = RFC5424_HEADER.match(rest)
+    if header is not None:
+        host = header.group(3)
+        rest = _skip_structured_data(rest[header.end():])
+    else:
+        header = RFC3164_HEADER.match(rest)
+        # ホスト名の無い形式 (Cisco既定: "<189>12: *Mar  1 00:00:01: %LINK-...") はそのまま本文とする
+        if header is not None and not header.group(2).startswith("%"):
+            host = header.group(2)
+            rest = rest[header.end():]
+    if host == "-":
+        host = None
+    message = CISCO_MESSAGE.search(rest)
+    if message is None:
+        return None
+    facility, severity, mnemonic, body = message.groups()
+    event: Dict[str, Any] = {"host": host, "severity": int(severity)}
+    if facility == "LINK" and mnemonic in ("UPDOWN", "CHANGED"):
+        match = LINK_STATE.match(body)
+        if match is None:
+            return None
+        changes = {"status": match.group(2)}
+        if match.group(2) != "up":
+            changes["protocol"] = "down"
+        return {**event, "kind": "interface", "interface": match.group(1), "changes": changes}
+    if facility == "LINEPROTO" and mnemonic == "UPDOWN":
+        match = LINEPROTO_STATE.match(body)
+        if match is None:
+            return None
+        return {**event, "kind": "interface", "interface": match.group(1), "changes": {"protocol": match.group(2)}}
+    if facility == "SEC" and mnemonic.startswith("IPACCESSLOG"):
+        match = ACL_LOG.search(body)
+        if match is None:
+            return None
+        return {**event, "kind": "acl_hit", "acl": match.group(1), "action": match.group(2),
+                "packets": int(match.group(3))}
+    if facility == "SYS" and mnemonic == "CONFIG_I":
+        return {**event, "kind": "config_changed"}
+    return None
+
+# SNMP (BER)
+SNMP_TRAP_OID = "1.3.6.1.6.3.1.1.4.1.0"
+SNMP_TRAP_ADDRESS = "1.3.6.1.6.3.18.1.3.0"
+LINK_DOWN = "1.3.6.1.6.3.1.1.5.3"
+LINK_UP = "1.3.6.1.6.3.1.1.5.4"
+CISCO_CONFIG_EVENT = "1.3.6.1.4.1.9.9.43.2.0.1"
+IF_TABLE = "1.3.6.1.2.1.2.2.1."
+IF_INDEX, IF_DESCR, IF_ADMIN_STATUS, IF_OPER_STATUS = "1", "2", "7", "8"
+SNMPV2_TRAP_PDU = 0xA7
+
+def _read_tlv(data: bytes, pos: int) -> Tuple[int, int, int]:
+    # (タグ, 値の開始位置, 値の終了位置)
+    try:
+        tag = data[pos]
+        length = data[pos + 1]
+        pos += 2
+        if length & 0x80:
+            size = length & 0x7F
+            length = int.from_bytes(data[pos:pos + size], "big")
+            pos += size
+    except IndexError:
+        raise IngestError("parse_error", "Truncated BER data")
+    if pos + length > len(data):
+        raise IngestError("parse_error", "Truncated BER data")
+    return tag, pos, pos + length
+
+# トラップのOIDはほぼ同じものが繰り返されるため、デコード結果を再利用する
+_oid_cache: Dict[bytes, str] = {}
+OID_CACHE_SIZE = 4096
+
+def _decode_oid(value: bytes) -> str:
+    cached = _oid_cache.get(value)
+    if cached is not None:
+        return cached
+    if not value:
+        raise IngestError("parse_error", "Empty OID")
+    arcs = [str(value[0] // 40), str(value[0] % 40)]
+    current = 0
+    for byte in value[1:]:
+        current = (current << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(str(current))
+            current = 0
+    if len(_oid_cache) >= OID_CACHE_SIZE:
+        _oid_cache.clear()
+    oid = _oid_cache[value] = ".".join(arcs)
+    return oid
+
+def _decode_value(tag: int, value: bytes) -> Any:
+    if tag == 0x02:  # INTEGER
+        return int.from_bytes(value, "big", signed=True)
+    if tag == 0x04:  # OCTET STRING
+        return value.decode("utf-8", "replace")
+    if tag == 0x06:  # OBJECT IDENTIFIER
+        return _decode_oid(value)
+    if tag == 0x40:  # IpAddress
+        return ".".join(str(byte) for byte in value)
+    if tag in (0x41, 0x42, 0x43, 0x46):  # Counter32 / Gauge32 / TimeTicks / Counter64
+        return int.from_bytes(value, "big")
+    return None
+
+def parse_trap(data: bytes, community: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    tag, pos, end = _read_tlv(data, 0)
+    if tag != 0x30:
+        raise IngestError("parse_error", "Not an SNMP message")
+    tag, start, pos = _read_tlv(data, pos)
+    if tag != 0x02:
+        raise IngestError("parse_error", "Missing SNMP version")
+    if int.from_bytes(data[start:pos], "big") != 1:
+        raise IngestError("unsupported", "Only SNMPv2c traps are supported")
+    tag, start, pos = _read_tlv(data, pos)
+    if tag != 0x04:
+        raise IngestError("parse_error", "Missing SNMP community")
+    if community is not None and data[start:pos].decode("utf-8", "replace") != community:
+        raise IngestError("auth", "Community mismatch")
+    tag, pos, end = _read_tlv(data, pos)
+    if tag != SNMPV2_TRAP_PDU:
+        raise IngestError("unsupported", f"Unsupported PDU type 0x{tag:02x}")
+    # request-id / error-status / error-index を読み飛ばす
+    for _ in range(3):
+        _, _, pos = _read_tlv(data, pos)
+    tag, pos, end = _read_tlv(data, pos)
+    varbinds: Dict[str, Any] = {}
+    while pos < end:
+        _, start, pos = _read_tlv(data, pos)
+        _, oid_start, oid_end = _read_tlv(data, start)
+        value_tag, value_start, value_end = _read_tlv(data, oid_end)
+        varbinds[_decode_oid(data[oid_start:oid_end])] = _decode_value(value_tag, data[value_start:value_end])
+
+    trap_oid = varbinds.get(SNMP_TRAP_OID)
+    host = varbinds.get(SNMP_TRAP_ADDRESS)
+    event: Dict[str, Any] = {"host": str(host) if host is not None else None}
+    if trap_oid in (LINK_DOWN, LINK_UP):
+        interface = None
+        admin = None
+        for oid, value in varbinds.items():
+            if not oid.startswith(IF_TABLE):
+                continue
+            column, _, index = oid[len(IF_TABLE):].partition(".")
+            if column == IF_DESCR and value is not None:
+                # 機器によっては文字列以外の型で送られるため、名前として扱えるよう文字列にする
+                interface = str(value)
+            elif column == IF_INDEX and interface is None:
+                interface = f"ifIndex:{value}"
+            elif column == IF_ADMIN_STATUS:
+                admin = value
+            if interface is None and index:
+                interface = f"ifIndex:{index}"
+        if interface is None:
+            raise IngestError("parse_error", "Link trap without interface")
+        state = "up" if trap_oid == LINK_UP else "down"
+        status = "administratively down" if admin == 2 else state
+        return {**event, "kind": "interface", "interface": interface,
+                "changes": {"status": status, "protocol": state}}
+    if trap_oid == CISCO_CONFIG_EVENT:
+        return {**event, "kind": "config_changed"}
+    return None
+
+def _tlv(tag: int, payload: bytes) -> bytes:
+    length = len(payload)
+    if length < 0x80:
+        return bytes([tag, length]) + payload
+    size = (length.bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + length.to_bytes(size, "big") + payload
+
+def _encode_oid(oid: str) -> bytes:
+    arcs = [int(arc) for arc in oid.split(".")]
+    encoded = bytearray([arcs[0] * 40 + arcs[1]])
+    for arc in arcs[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        encoded.extend(reversed(chunk))
+    return _tlv(0x06, bytes(encoded))
+
+def _encode_int(value: int, tag: int = 0x02) -> bytes:
+    return _tlv(tag, value.to_bytes(max(1, (value.bit_length() + 8) // 8), "big", signed=True))
+
+def encode_trap(community: str, trap_oid: str, varbinds: Sequence[Tuple[str, Any]] = (),
+                uptime: int = 0, request_id: int = 1) -> bytes:
+    # 再送ツールと動作確認用のSNMPv2cトラップ (値は int / str / ("oid", str) / ("ip", str))
+    def value(item: Any) -> bytes:
+        if isinstance(item, tuple) and item[0] == "oid":
+            return _encode_oid(item[1])
+        if isinstance(item, tuple) and item[0] == "ip":
+            return _tlv(0x40, bytes(int(part) for part in item[1].split(".")))
+        if isinstance(item, int):
+            return _encode_int(item)
+        return _tlv(0x04, str(item).encode())
+
+    bindings = [("1.3.6.1.2.1.1.3.0", None), (SNMP_TRAP_OID, ("oid", trap_oid)), *varbinds]
+    encoded = b"".join(
+        _tlv(0x30, _encode_oid(oid) + (_encode_int(uptime, 0x43) if item is None else value(item)))
+        for oid, item in bindings
+    )
+    pdu = _tlv(SNMPV2_TRAP_PDU, _encode_int(request_id) + _encode_int(0) + _encode_int(0) + _tlv(0x30, encoded))
+    return _tlv(0x30, _encode_int(1) + _tlv(0x04, community.encode()) + pdu)
+
+# インターフェース名の照合
+INTERFACE_NAME = re.compile(r"([A-Za-z\-]+)(.*)")
+
+def match_interface(name: str, names: Sequence[str]) -> Optional[str]:
+    # 完全一致、ifIndex (インターフェースの並び順)、省略形 (例: Gi0/1 -> GigabitEthernet0/1) の順に探す
+    if name in names:
+        return name
+    if name.startswith("ifIndex:"):
+        try:
+            index = int(name[len("ifIndex:"):])
+        except ValueError:
+            return None
+        return names[index - 1] if 0 < index <= len(names) else None
+    match = INTERFACE_NAME.match(name)
+    if match is None:
+        return None
+    prefix, suffix = match.group(1).lower(), match.group(2)
+    for candidate in names:
+        parts = INTERFACE_NAME.match(candidate)
+        if parts is not None and parts.group(2) == suffix and parts.group(1).lower().startswith(prefix):
+            return candidate
+    return None
+
+def summarize(events: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    # 1回分の解析結果をルーター単位にまとめる - 同じインターフェースの変化は後のもので上書きする
+    interfaces: Dict[str, Dict[str, Dict[str, str]]] = {}
+    acl_hits: Dict[str, Dict[str, Dict[str, int]]] = {}
+    config_changed: Dict[str, None] = {}
+    for event in events:
+        router = event["router"]
+        kind = event["kind"]
+        if kind == "interface":
+            interfaces.setdefault(router, {}).setdefault(event["interface"], {}).update(event["changes"])
+        elif kind == "acl_hit":
+            counts = acl_hits.setdefault(router, {}).setdefault(event["acl"], {})
+            counts[event["action"]] = counts.get(event["action"], 0) + event["packets"]
+        elif kind == "config_changed":
+            config_changed[router] = None
+    return {"interfaces": interfaces, "acl_hits": acl_hits, "config_changed": list(config_changed)}
+
+class _Listener(asyncio.DatagramProtocol):
+    def __init__(self, ingestor: "EventIngestor", kind: str):
+        self.ingestor = ingestor
+        self.kind = kind
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.ingestor.submit(self.kind, data, addr[0])
+
+    def error_received(self, exc: Exception):
+        logger.warning(f"{self.kind} listener error: {exc}")
+
+class EventIngestor:
+    def __init__(
+        self,
+        resolve: Resolver,
+        handler: BatchHandler,
+        max_queue: int = 65536,
+        batch_size: int = 4096,
+        linger: float = 0.01,
+        max_delay: float = 0.5,
+        community: Optional[str] = None,
+        receive_buffer: int = 4 * 1024 * 1024,
+        read_burst: int = 1024,
+    ):
+        self.resolve = resolve
+        self.handler = handler
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        # 受信を待ってまとめる時間と、受信が続いている間に解析結果をためておく最大の時間 (秒)
+        self.linger = linger
+        self.max_delay = max_delay
+        self.community = community
+        self.receive_buffer = receive_buffer
+        # 1回の通知で読む最大の件数 (他の処理を待たせすぎないため)
+        self.read_burst = read_burst
+        self._queue: Deque[Tuple[str, bytes, str]] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sockets: Dict[str, socket.socket] = {}
+        self._transports: Dict[str, asyncio.DatagramTransport] = {}
+        self.received = {"syslog": 0, "trap": 0}
+        self.dropped = {"queue_full": 0, "parse_error": 0, "auth": 0, "unsupported": 0, "unknown_router": 0}
+        self.events = 0
+        self.ignored = 0
+        self.batches = 0
+        self.flushes = 0
+        self.handler_errors = 0
+        self.max_depth = 0
+        self.busy_time = 0.0
+
+    def _bind(self, host: str, port: int) -> socket.socket:
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            # 瞬間的な大量受信でカーネル側で捨てられないよう受信バッファを広げる (上限は net.core.rmem_max)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+            except OSError as e:
+                logger.warning(f"Could not enlarge receive buffer: {e}")
+            sock.bind((host, port))
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    async def start(self, host: str, syslog_port: Optional[int] = None, trap_port: Optional[int] = None):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        for kind, port in (("syslog", syslog_port), ("trap", trap_port)):
+            if not port or kind in self._sockets:
+                continue
+            sock = self._bind(host, port)
+            try:
+                # asyncio標準のUDPトランスポートは1回の通知で1件しか読まないため、通知ごとに溜まっている分をまとめて読む
+                loop.add_reader(sock.fileno(), self._read_ready, kind, sock)
+            except NotImplementedError:
+                # add_readerの無いイベントループ (WindowsのProactor) では標準のトランスポートを使う
+                transport, _ = await loop.create_datagram_endpoint(lambda kind=kind: _Listener(self, kind), sock=sock)
+                self._transports[kind] = transport
+            self._sockets[kind] = sock
+            logger.info(f"Listening for {kind} on {host}:{sock.getsockname()[1]}")
+
+    def _read_ready(self, kind: str, sock: socket.socket):
+        recvfrom = sock.recvfrom
+        for _ in range(self.read_burst):
+            try:
+                data, addr = recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.warning(f"{kind} listener error: {e}")
+                return
+            self.submit(kind, data, addr[0])
+
+    def address(self, kind: str) -> Optional[Tuple[str, int]]:
+        sock = self._sockets.get(kind)
+        return sock.getsockname() if sock is not None else None
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        for kind, sock in self._sockets.items():
+            transport = self._transports.pop(kind, None)
+            if transport is not None:
+                transport.close()
+            else:
+                loop.remove_reader(sock.fileno())
+                sock.close()
+        self._sockets.clear()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def submit(self, kind: str, data: bytes, source: str):
+        # 受信コールバックから呼ばれる - 解析はせずに積むだけ
+        self.received[kind] += 1
+        if len(self._queue) >= self.max_queue:
+            self.dropped["queue_full"] += 1
+            return
+        self._queue.append((kind, data, source))
+        if len(self._queue) > self.max_depth:
+            self.max_depth = len(self._queue)
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def parse_batch(self, batch: Sequence[Tuple[str, bytes, str]]) -> List[Dict[str, Any]]:
+        events = []
+        dropped = self.dropped
+        community = self.community
+        for kind, data, source in batch:
+            try:
+                event = parse_syslog(data) if kind == "syslog" else parse_trap(data, community)
+            except IngestError as e:
+                dropped[e.reason] += 1
+                continue
+            if event is None:
+                self.ignored += 1
+                continue
+            router = self.resolve(source, event["host"])
+            if router is None:
+                dropped["unknown_router"] += 1
+                continue
+            event["router"] = router
+            events.append(event)
+        self.events += len(events)
+        return events
+
+    async def _run(self):
+        queue = self._queue
+        while True:
+            if not queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            # 1件ずつ反映すると1件あたりの処理が重くなるため、少し待って続けて届いた分とまとめる
+            if len(queue) < self.batch_size:
+                await asyncio.sleep(self.linger)
+            window_started = time.perf_counter()
+            events: List[Dict[str, Any]] = []
+            while True:
+                started = time.perf_counter()
+                batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+                events.extend(self.parse_batch(batch))
+                self.batches += 1
+                self.busy_time += time.perf_counter() - started
+                # 受信が続いている間は max_delay までまとめてから反映する
+                # (負荷が高いほど同じインターフェースの変化が1回の更新にまとまる)
+                if not queue or started - window_started >= self.max_delay:
+                    break
+                await asyncio.sleep(0)
+            started = time.perf_counter()
+            summary = summarize(events)
+            self.flushes += 1
+            if summary["interfaces"] or summary["acl_hits"] or summary["config_changed"]:
+                try:
+                    await self.handler(summary)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.handler_errors += 1
+                    logger.error(f"Applying ingested events failed: {e}")
+            self.busy_time += time.perf_counter() - started
+
+    def socket_drops(self) -> Dict[str, int]:
+        # 読み取りが追いつかずにカーネルの受信バッファで捨てられた件数 (Linuxのみ、/proc/net/udp の drops 列)
+        inodes = {}
+        for kind, sock in self._sockets.items():
+            try:
+                inodes[str(os.fstat(sock.fileno()).st_ino)] = kind
+            except OSError:
+                continue
+        drops: Dict[str, int] = {}
+        for path in ("/proc/net/udp", "/proc/net/udp6"):
+            try:
+                with open(path) as f:
+                    next(f, None)
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) > 12 and fields[9] in inodes:
+                            drops[inodes[fields[9]]] = int(fields[12])
+            except OSError:
+                continue
+        return drops
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "listeners": {kind: list(sock.getsockname()[:2]) for kind, sock in self._sockets.items()},
+            "received": dict(self.received),
+            "dropped": dict(self.dropped),
+            "socket_dropped": self.socket_drops(),
+            "events": self.events,
+            "ignored": self.ignored,
+            "batches": self.batches,
+            "flushes": self.flushes,
+            "handler_errors": self.handler_errors,
+            "queue_depth": len(self._queue),
+            "max_queue_depth": self.max_depth,
+            "max_queue": self.max_queue,
+            "busy_time": round(self.busy_time, 6),
+        }
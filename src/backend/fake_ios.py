@@ -0,0 +1,250 @@
+# テスト用の疑似Cisco IOSサーバー
+# 実機を使わずにトランスポート層 (SSH/Telnet) を検証するためのインプロセスサーバー
+
+import asyncio
+import logging
+from typing import Callable, Dict, Optional, Union
+
+try:
+    import asyncssh
+except ImportError:  # asyncsshが無い環境ではTelnetサーバーのみ利用可能
+    asyncssh = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUTS = {
+    "show version": "Cisco IOS Software, C800 Software (C800-UNIVERSALK9-M), Version 15.7(3)M2\n"
+                    "ROM: System Bootstrap, Version 15.7(3r)M2\n"
+                    "Router uptime is 10 days, 4 hours, 32 minutes",
+    "show ip interface brief": "Interface              IP-Address      OK? Method Status                Protocol\n"
+                               "GigabitEthernet0       192.168.1.1     YES NVRAM  up                    up\n"
+                               "GigabitEthernet1       10.0.0.1        YES NVRAM  up                    up\n"
+                               "GigabitEthernet2       172.16.0.1      YES NVRAM  up                    up\n"
+                               "GigabitEthernet3       unassigned      YES NVRAM  administratively down down",
+}
+
+# コマンド -> 出力 の辞書、またはコマンドを受け取り出力を返す関数
+CommandHandler = Union[Dict[str, str], Callable[[str], str]]
+
+class FakeIOSShell:
+    # IOSの対話シェル (ログイン、enable、コマンド応答) を模倣する
+    def __init__(
+        self,
+        reader,
+        writer,
+        hostname: str,
+        username: Optional[str],
+        password: Optional[str],
+        enable_password: Optional[str],
+        handler: CommandHandler,
+        cli_login: bool,
+        response_delay: float = 0.0,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.enable_password = enable_password
+        self.handler = handler
+        self.cli_login = cli_login
+        self.response_delay = response_delay
+        self.privileged = enable_password is None
+
+    @property
+    def prompt(self) -> str:
+        return f"{self.hostname}{'#' if self.privileged else '>'}"
+
+    async def _send(self, text: str):
+        self.writer.write(text.replace("\n", "\r\n"))
+        if hasattr(self.writer, "drain"):
+            await self.writer.drain()
+
+    async def _readline(self) -> Optional[str]:
+        line = await self.reader.readline()
+        if not line:
+            return None
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        return line.rstrip("\r\n")
+
+    async def run(self):
+        if self.cli_login and not await self._login():
+            await self._send("% Authentication failed\n")
+            return
+        await self._send(f"\n{self.prompt}")
+        while True:
+            line = await self._readline()
+            if line is None:
+                return
+            command = line.strip()
+            if command in ("exit", "logout", "quit"):
+                return
+            if not command:
+                await self._send(f"\n{self.prompt}")
+                continue
+            if command == "enable":
+                await self._handle_enable()
+                continue
+            if command == "disable":
+                self.privileged = False
+                await self._send(f"\n{self.prompt}")
+                continue
+            if self.response_delay:
+                await asyncio.sleep(self.response_delay)
+            output = self._output_for(command)
+            await self._send(f"\n{output}\n{self.prompt}" if output else f"\n{self.prompt}")
+
+    async def _login(self) -> bool:
+        await self._send("\nUser Access Verification\n\nUsername: ")
+        username = await self._readline()
+        await self._send("Password: ")
+        password = await self._readline()
+        return username == self.username and password == self.password
+
+    async def _handle_enable(self):
+        if self.privileged:
+            await self._send(f"\n{self.prompt}")
+            return
+        await self._send("\nPassword: ")
+        password = await self._readline()
+        if password == self.enable_password:
+            self.privileged = True
+            await self._send(f"\n{self.prompt}")
+        else:
+            await self._send(f"\n% Access denied\n\n{self.prompt}")
+
+    def _output_for(self, command: str) -> str:
+        if command.startswith("terminal "):
+            return ""
+        if command.startswith(("show run", "show startup")) and not self.privileged:
+            return "% Invalid input detected at '^' marker."
+        if callable(self.handler):
+            return self.handler(command)
+        for key, output in self.handler.items():
+            if command.startswith(key):
+                return output
+        return "% Invalid input detected at '^' marker."
+
+class FakeIOSServer:
+    # 同じシェルをTelnet (平文TCP) とSSHの両方で提供する
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        hostname: str = "Router",
+        username: Optional[str] = "admin",
+        password: Optional[str] = "cisco",
+        enable_password: Optional[str] = "enable",
+        handler: Optional[CommandHandler] = None,
+        response_delay: float = 0.0,
+    ):
+        self.host = host
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.enable_password = enable_password
+        self.handler = handler if handler is not None else DEFAULT_OUTPUTS
+        self.response_delay = response_delay
+        self.telnet_port: Optional[int] = None
+        self.ssh_port: Optional[int] = None
+        self.connections = 0
+        self._telnet_server: Optional[asyncio.AbstractServer] = None
+        self._telnet_writers: set = set()
+        self._ssh_server = None
+        self.host_key = None
+
+    def _shell(self, reader, writer, cli_login: bool) -> FakeIOSShell:
+        self.connections += 1
+        return FakeIOSShell(
+            reader, writer, self.hostname, self.username, self.password,
+            self.enable_password, self.handler, cli_login, self.response_delay,
+        )
+
+    async def start_telnet(self, port: int = 0) -> int:
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            text_writer = _TextStreamWriter(writer)
+            self._telnet_writers.add(writer)
+            try:
+                await self._shell(reader, text_writer, cli_login=True).run()
+            except ConnectionError:
+                pass
+            finally:
+                self._telnet_writers.discard(writer)
+                writer.close()
+
+        self._telnet_server = await asyncio.start_server(handle, self.host, port)
+        self.telnet_port = self._telnet_server.sockets[0].getsockname()[1]
+        logger.info(f"Fake IOS telnet server listening on {self.host}:{self.telnet_port}")
+        return self.telnet_port
+
+    async def start_ssh(self, port: int = 0) -> int:
+        if asyncssh is None:
+            raise RuntimeError("Fake SSH server requires the asyncssh package")
+        server = self
+
+        class _Server(asyncssh.SSHServer):
+            def begin_auth(self, username: str) -> bool:
+                return True
+
+            def password_auth_supported(self) -> bool:
+                return True
+
+            def validate_password(self, username: str, password: str) -> bool:
+                return username == server.username and password == server.password
+
+        async def handle(process):
+            try:
+                await self._shell(process.stdin, process.stdout, cli_login=False).run()
+            except (asyncssh.Error, ConnectionError):
+                pass
+            finally:
+                process.exit(0)
+
+        self.host_key = asyncssh.generate_private_key("ssh-ed25519")
+        self._ssh_server = await asyncssh.create_server(
+            _Server, self.host, port, server_host_keys=[self.host_key], process_factory=handle,
+        )
+        self.ssh_port = self._ssh_server.sockets[0].getsockname()[1]
+        logger.info(f"Fake IOS SSH server listening on {self.host}:{self.ssh_port}")
+        return self.ssh_port
+
+    def known_hosts_entry(self) -> str:
+        # クライアント側の known_hosts に追加する行
+        public_key = self.host_key.export_public_key("openssh").decode().strip()
+        return f"[{self.host}]:{self.ssh_port} {public_key}\n"
+
+    async def close(self):
+        if self._telnet_server is not None:
+            # 接続中のセッションを先に閉じてハンドラーを終了させる
+            for writer in list(self._telnet_writers):
+                writer.close()
+            self._telnet_server.close()
+            await self._telnet_server.wait_closed()
+            self._telnet_server = None
+        if self._ssh_server is not None:
+            self._ssh_server.close()
+            await self._ssh_server.wait_closed()
+            self._ssh_server = None
+
+class _TextStreamWriter:
+    # asyncssh のプロセス出力と同じく str を受け付けるようにする
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+
+    def write(self, text: str):
+        self._writer.write(text.encode())
+
+    async def drain(self):
+        await self._writer.drain()
+
+if __name__ == "__main__":
+    # ローカル検証用: python fake_ios.py で起動する
+    async def main():
+        server = FakeIOSServer()
+        await server.start_telnet(2323)
+        if asyncssh is not None:
+            await server.start_ssh(2222)
+        await asyncio.Event().wait()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,182 @@
+# syslog / SNMPトラップの記録と再送
+# 受信したメッセージをそのままファイルに記録し、記録した順に指定の速度 (既定は上限なし) で送り直す
+# 記録が無い場合は擬似フリート (SIM_ROUTERS と同じ生成規則) のホスト名とインターフェースでメッセージを生成できる
+#
+# 使い方:
+#   python ingest_replay.py generate --routers 5000 --count 200000 --output events.jsonl
+#   python ingest_replay.py send events.jsonl --syslog-port 5514 --trap-port 5162 --rate 0 --repeat 5
+#   python ingest_replay.py capture --syslog-port 5514 --trap-port 5162 --duration 60 --output captured.jsonl
+# ファイルは1行1メッセージのJSON ({"kind": "syslog" | "trap", "data": base64}) とする
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import socket
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from event_ingest import (CISCO_CONFIG_EVENT, IF_TABLE, LINK_DOWN, LINK_UP, SNMP_TRAP_ADDRESS, EventIngestor,
+                          encode_trap)
+from simulator import FleetSimulator
+
+def load_capture(path: str) -> List[Tuple[str, bytes]]:
+    messages = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                messages.append((entry["kind"], base64.b64decode(entry["data"])))
+    return messages
+
+def write_capture(path: str, messages: List[Tuple[str, bytes]]):
+    with open(path, "w") as f:
+        for kind, data in messages:
+            f.write(json.dumps({"kind": kind, "data": base64.b64encode(data).decode()}) + "\n")
+
+def generate_messages(routers: int, count: int, trap_ratio: float = 0.2, community: str = "public",
+                      seed: int = 0) -> List[Tuple[str, bytes]]:
+    # インターフェースの上下・ACLのログ・コンフィグ変更を混ぜて生成する
+    fleet = FleetSimulator(size=routers, seed=seed)
+    devices = [(ip, data["hostname"], list(data["interfaces"])) for ip, data in fleet.routers.items()]
+    rng = random.Random(seed)
+    messages = []
+    for sequence in range(count):
+        ip, hostname, interfaces = rng.choice(devices)
+        index = rng.randrange(len(interfaces))
+        interface = interfaces[index]
+        state = rng.choice(("up", "down"))
+        if rng.random() < trap_ratio:
+            if rng.random() < 0.05:
+                data = encode_trap(community, CISCO_CONFIG_EVENT, [(SNMP_TRAP_ADDRESS, ("ip", ip))], request_id=sequence)
+            else:
+                data = encode_trap(community, LINK_UP if state == "up" else LINK_DOWN, [
+                    (f"{IF_TABLE}1.{index + 1}", index + 1),
+                    (f"{IF_TABLE}2.{index + 1}", interface),
+                    (f"{IF_TABLE}7.{index + 1}", 1),
+                    (f"{IF_TABLE}8.{index + 1}", 1 if state == "up" else 2),
+                    (SNMP_TRAP_ADDRESS, ("ip", ip)),
+                ], uptime=sequence, request_id=sequence)
+            messages.append(("trap", data))
+            continue
+        choice = rng.random()
+        if choice < 0.4:
+            text = f"%LINK-3-UPDOWN: Interface {interface}, changed state to {state}"
+        elif choice < 0.8:
+            text = f"%LINEPROTO-5-UPDOWN: Line protocol on Interface {interface}, changed state to {state}"
+        elif choice < 0.98:
+            action = rng.choice(("permitted", "denied"))
+            text = (f"%SEC-6-IPACCESSLOGP: list ACL_IN {action} tcp 192.0.2.{rng.randrange(1, 255)}(40000) -> "
+                    f"{ip}(22), {rng.randrange(1, 20)} packets")
+        else:
+            text = "%SYS-5-CONFIG_I: Configured from console by admin on vty0"
+        messages.append(("syslog", f"<189>{time.strftime('%b %d %H:%M:%S')} {hostname} {sequence}: {text}".encode()))
+    return messages
+
+def send_messages(messages: List[Tuple[str, bytes]], host: str, ports: Dict[str, int], rate: float = 0.0,
+                  repeat: int = 1) -> Dict[str, float]:
+    # rate はメッセージ/秒 (0 は上限なし) - 送信が遅れた分は次の送信で取り戻す
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+    targets = {kind: (host, port) for kind, port in ports.items() if port}
+    sendto = sock.sendto
+    sent = skipped = errors = 0
+    started = time.perf_counter()
+    try:
+        for _ in range(repeat):
+            for kind, data in messages:
+                address = targets.get(kind)
+                if address is None:
+                    skipped += 1
+                    continue
+                if rate:
+                    wait = started + sent / rate - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                try:
+                    sendto(data, address)
+                    sent += 1
+                except OSError:
+                    errors += 1
+    finally:
+        sock.close()
+    elapsed = time.perf_counter() - started
+    return {"sent": sent, "skipped": skipped, "errors": errors, "elapsed": round(elapsed, 3),
+            "rate": round(sent / elapsed, 1) if elapsed else 0.0}
+
+async def capture_messages(host: str, ports: Dict[str, int], duration: float,
+                           limit: Optional[int] = None) -> List[Tuple[str, bytes]]:
+    messages: List[Tuple[str, bytes]] = []
+    done = asyncio.Event()
+
+    class Recorder(EventIngestor):
+        # 解析せずに受信した順に記録する
+        def submit(self, kind: str, data: bytes, source: str):
+            self.received[kind] += 1
+            messages.append((kind, data))
+            if limit and len(messages) >= limit:
+                done.set()
+
+    async def ignore(summary):
+        pass
+
+    recorder = Recorder(lambda source, host: None, ignore)
+    await recorder.start(host, ports.get("syslog"), ports.get("trap"))
+    try:
+        await asyncio.wait_for(done.wait(), duration)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        await recorder.close()
+    return messages
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Record and replay syslog messages and SNMP traps")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="generate messages for the simulated fleet")
+    generate.add_argument("--routers", type=int, default=100, help="number of simulated routers (SIM_ROUTERS)")
+    generate.add_argument("--seed", type=int, default=0, help="fleet seed (SIM_SEED)")
+    generate.add_argument("--count", type=int, default=10000)
+    generate.add_argument("--trap-ratio", type=float, default=0.2)
+    generate.add_argument("--community", default="public")
+    generate.add_argument("--output", required=True)
+
+    send = commands.add_parser("send", help="replay a capture file")
+    send.add_argument("file")
+    send.add_argument("--host", default="127.0.0.1")
+    send.add_argument("--syslog-port", type=int, default=514)
+    send.add_argument("--trap-port", type=int, default=162)
+    send.add_argument("--rate", type=float, default=0.0, help="messages per second (0 = as fast as possible)")
+    send.add_argument("--repeat", type=int, default=1)
+
+    capture = commands.add_parser("capture", help="record received messages to a capture file")
+    capture.add_argument("--host", default="0.0.0.0")
+    capture.add_argument("--syslog-port", type=int, default=514)
+    capture.add_argument("--trap-port", type=int, default=162)
+    capture.add_argument("--duration", type=float, default=60.0)
+    capture.add_argument("--limit", type=int, help="stop after this many messages")
+    capture.add_argument("--output", required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        messages = generate_messages(args.routers, args.count, args.trap_ratio, args.community, args.seed)
+        write_capture(args.output, messages)
+        print(f"Wrote {len(messages)} messages to {args.output}")
+    elif args.command == "send":
+        messages = load_capture(args.file)
+        result = send_messages(messages, args.host, {"syslog": args.syslog_port, "trap": args.trap_port},
+                               args.rate, args.repeat)
+        print(f"Sent {result['sent']} messages in {result['elapsed']}s ({result['rate']} msg/s), "
+              f"skipped {result['skipped']}, errors {result['errors']}")
+    else:
+        ports = {"syslog": args.syslog_port, "trap": args.trap_port}
+        messages = asyncio.run(capture_messages(args.host, ports, args.duration, args.limit))
+        write_capture(args.output, messages)
+        print(f"Captured {len(messages)} messages to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
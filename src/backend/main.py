@@ -1,12 +1,43 @@
-from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict, Optional, Union, Any
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Dict, Optional, Union, Any, Deque, AsyncIterator, Awaitable, Callable, Tuple
+from collections import deque
 import asyncio
-import random
 import json
+import copy
+import uuid
 import logging
+import time
+import fnmatch
+import os
 from datetime import datetime
+from transport import SessionPool, DeviceParams, TransportError, AuthenticationError
+from diagnostics import DiagnosticEngine
+from acl import compile_acl, ACLParseError
+from config_parser import RunningConfigParser, acls_from_config
+from config_drift import DriftEngine
+from cli_templates import (parse_batch, parse_output, interfaces_from_records, router_info_from_version,
+                           get_template, ping_result_from_records)
+from timeseries import TimeSeriesStore
+from poller import PollingScheduler
+from state_feed import StateFeed
+from response_cache import ResponseCache, CachedResponse
+from metrics import MetricsRegistry, MetricsMiddleware, SlowRequestProfiler
+from sweep import TokenBucket, expand_targets, sweep
+from topology import TopologyGraph, CORE
+from shared_state import create_backend
+from sessions import SessionStore, SessionLimitError
+from result_history import ResultHistory
+import ws_codec
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+from event_ingest import EventIngestor, match_interface
+from simulator import (FleetSimulator, LatencyModel, SCENARIOS, default_traceroute, render_show_version,
+                       render_ip_interface_brief, render_running_config, simulate_ping)
 
 # ロギングの設定
 logging.basicConfig(
@@ -26,6 +57,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# メトリクス - 常時有効にしておけるよう、リクエストごとの処理は整数の加算のみ
+metrics = MetricsRegistry()
+# 低速リクエストのプロファイラー (PROFILE_SLOW_MS を指定した場合のみ起動時に有効化する)
+PROFILE_SLOW_MS = os.environ.get("PROFILE_SLOW_MS")
+profiler = SlowRequestProfiler(threshold=float(PROFILE_SLOW_MS or 500) / 1000)
+app.add_middleware(MetricsMiddleware, registry=metrics, profiler=profiler)
+
 # データモデル
 class RouterInfo(BaseModel):
     ip: str
@@ -33,10 +71,22 @@ class RouterInfo(BaseModel):
     password: Optional[str] = None
     enable_password: Optional[str] = None
     connection_type: str = "ssh"  # ssh, telnet, snmp
+    port: Optional[int] = None
 
 class CommandRequest(BaseModel):
     command: str
 
+class BatchCommandRequest(BaseModel):
+    commands: List[str]
+
+class FanoutCommandRequest(BaseModel):
+    commands: List[str]
+    routers: List[str] = []
+    selector: Optional[str] = None
+    max_concurrency: int = 50
+    per_site_concurrency: int = 10
+    timeout: float = 30.0  # 1台あたり
+
 class InterfaceInfo(BaseModel):
     name: str
     status: str
@@ -61,6 +111,26 @@ class ACLEntry(BaseModel):
     name: str
     entries: List[str]
 
+class CommandOutput(BaseModel):
+    command: str
+    output: str
+
+class ParseRequest(BaseModel):
+    items: List[CommandOutput]
+
+class FlowQuery(BaseModel):
+    protocol: Union[str, int] = "tcp"
+    src: str
+    dst: str
+    src_port: Optional[int] = Field(None, ge=0, le=65535)
+    dst_port: Optional[int] = Field(None, ge=0, le=65535)
+    established: bool = False
+    icmp_type: Optional[int] = Field(None, ge=0, le=255)
+    icmp_code: Optional[int] = Field(None, ge=0, le=255)
+
+class FlowBatchRequest(BaseModel):
+    flows: List[FlowQuery]
+
 class DiagnosticIssue(BaseModel):
     type: str
     severity: str  # critical, high, medium, low
@@ -72,262 +142,967 @@ class DiagnosticResult(BaseModel):
     summary: str
     issues: List[DiagnosticIssue]
 
+class BulkDiagnosticsRequest(BaseModel):
+    routers: List[str] = []
+    selector: Optional[str] = None  # 例: "*" / "10.0.*"
+    max_concurrency: int = 200
+    per_site_concurrency: int = 20
+    session_id: Optional[str] = None
+
+class GoldenConfigRequest(BaseModel):
+    config: Optional[str] = None
+    source: Optional[str] = None  # configの代わりにこのルーターの現在のコンフィグを登録する
+    ignore: List[str] = []  # 比較しないブロック 例: "hostname" / "interface *"
+
+class DriftRequest(BaseModel):
+    routers: List[str] = []
+    selector: Optional[str] = None
+    golden: Optional[str] = None  # 省略した場合はフリート内で多数派の内容と比較する
+    ignore: List[str] = []
+    strict: bool = False
+    max_concurrency: int = 50
+
+class SweepRequest(BaseModel):
+    cidr: Optional[str] = None  # 例: "10.0.0.0/22"
+    targets: List[str] = []
+    max_concurrency: int = 256
+    rate: Optional[float] = None  # このスイープだけに適用する上限 (回/秒)
+    session_id: Optional[str] = None
+
+class WebSocketCommand(BaseModel):
+    # WebSocketで受け付けるコマンド (null は省略した場合と同じに扱う)
+    command: Optional[str] = None
+    request_id: Optional[Union[str, int]] = None
+    target: Optional[str] = None
+    router: Optional[str] = None
+    routers: Optional[List[str]] = None
+    selector: Optional[str] = None
+    max_concurrency: Optional[int] = None
+    per_site_concurrency: Optional[int] = None
+    cidr: Optional[str] = None
+    targets: Optional[List[str]] = None
+    rate: Optional[float] = None
+    interfaces: Optional[List[str]] = None
+    since: Optional[int] = None
+    scenario: Optional[str] = None
+
 class ConnectionResponse(BaseModel):
     success: bool
     message: str
     session_id: Optional[str] = None
 
-# 擬似データベース - 実際のシステムではデータベースを使用
-connected_routers = {}
-router_data = {
-    "192.168.1.1": {
-        "info": {
-            "name": "Cisco 892",
-            "model": "C892FSP-K9",
-            "serial_number": "FTX1840ABCD",
-            "firmware_version": "15.7(3)M2",
-            "uptime": "10 days, 4 hours, 32 minutes"
-        },
-        "interfaces": {
-            "GigabitEthernet0": {
-                "name": "GigabitEthernet0",
-                "status": "up", 
-                "protocol": "up", 
-                "ip": "192.168.1.1",
-                "speed": "1000Mb/s",
-                "duplex": "full"
-            },
-            "GigabitEthernet1": {
-                "name": "GigabitEthernet1",
-                "status": "up", 
-                "protocol": "up", 
-                "ip": "10.0.0.1",
-                "speed": "1000Mb/s",
-                "duplex": "full"
-            },
-            "GigabitEthernet2": {
-                "name": "GigabitEthernet2",
-                "status": "up", 
-                "protocol": "up", 
-                "ip": "172.16.0.1",
-                "speed": "1000Mb/s",
-                "duplex": "full"
-            },
-            "GigabitEthernet3": {
-                "name": "GigabitEthernet3",
-                "status": "administratively down", 
-                "protocol": "down", 
-                "ip": "unassigned",
-                "speed": "auto",
-                "duplex": "auto"
-            }
-        },
-        "acls": [
-            {
-                "name": "ALLOW_WEB",
-                "entries": [
-                    "permit tcp any any eq 80",
-                    "permit tcp any any eq 443"
-                ]
-            },
-            {
-                "name": "BLOCK_TELNET",
-                "entries": [
-                    "deny tcp any any eq 23",
-                    "permit ip any any"
-                ]
-            }
-        ]
-    }
-}
+# ワーカー間で共有する状態 - 既定はプロセス内のみ
+# uvicorn --workers N で動かす場合は STATE_BACKEND=sqlite (STATE_DB にファイルのパス) を指定する
+shared_state = create_backend(os.environ.get("STATE_BACKEND", "memory"), os.environ.get("STATE_DB"))
+
+# 接続中のセッション (session_id -> 接続情報) - 共有状態のミラーで、作成・変更・削除は session_store で行う
+connected_routers = shared_state.items("connections")
+# 最終利用から SESSION_IDLE_TTL 秒、作成から SESSION_ABSOLUTE_TTL 秒で失効する
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", 1800))
+SESSION_ABSOLUTE_TTL = float(os.environ.get("SESSION_ABSOLUTE_TTL", 86400))
+SESSION_MAX_PER_USER = int(os.environ.get("SESSION_MAX_PER_USER", 20))
+session_store = SessionStore(
+    shared_state,
+    idle_ttl=SESSION_IDLE_TTL,
+    absolute_ttl=SESSION_ABSOLUTE_TTL,
+    max_per_user=SESSION_MAX_PER_USER,
+    on_expire=lambda session_id: scenario_state.clear_session(session_id)
+)
+# 仮想ルーター群 - 台数・シード・障害率・遅延分布は環境変数で指定する
+# (SIM_ROUTERS=0 の場合はデモ用ルーターのみ、SIM_LATENCY=zero で遅延なし)
+fleet = FleetSimulator(
+    size=int(os.environ.get("SIM_ROUTERS", "0")),
+    seed=int(os.environ.get("SIM_SEED", "0")),
+    routers_per_site=int(os.environ.get("SIM_ROUTERS_PER_SITE", "50")),
+    fault_rate=float(os.environ.get("SIM_FAULT_RATE", "0"))
+)
+latency = LatencyModel(
+    distribution=os.environ.get("SIM_LATENCY", "fixed"),
+    scale=float(os.environ.get("SIM_LATENCY_SCALE", "1.0")),
+    jitter=float(os.environ.get("SIM_LATENCY_JITTER", "0.25")),
+    seed=int(os.environ.get("SIM_SEED", "0"))
+)
+router_data = fleet.routers
 
 # シナリオ定義
-scenarios = {
-    "healthy": {
-        "interfaces": {
-            "GigabitEthernet0": {"status": "up", "protocol": "up"},
-            "GigabitEthernet1": {"status": "up", "protocol": "up"},
-            "GigabitEthernet2": {"status": "up", "protocol": "up"},
-            "GigabitEthernet3": {"status": "administratively down", "protocol": "down"}
-        },
-        "ping_results": {
-            "10.0.0.2": {"success": True, "packet_loss": 0, "rtt_min": 1.1, "rtt_avg": 2.3, "rtt_max": 3.7}
-        },
-        "traceroute_results": {
-            "10.0.0.2": [
-                {"hop": 1, "ip": "192.168.1.1", "rtt": 0.5},
-                {"hop": 2, "ip": "10.0.0.1", "rtt": 1.2},
-                {"hop": 3, "ip": "10.0.0.2", "rtt": 2.1}
-            ]
-        },
-        "acls": [
-            {"name": "ALLOW_WEB", "entries": ["permit tcp any any eq 80", "permit tcp any any eq 443"]},
-            {"name": "BLOCK_TELNET", "entries": ["deny tcp any any eq 23", "permit ip any any"]}
-        ],
-        "diagnostic_result": {
-            "status": "healthy",
-            "summary": "全てのシステムは正常に動作しています",
-            "issues": []
-        }
-    },
-    "interface_down": {
-        "interfaces": {
-            "GigabitEthernet0": {"status": "up", "protocol": "up"},
-            "GigabitEthernet1": {"status": "down", "protocol": "down"},
-            "GigabitEthernet2": {"status": "up", "protocol": "up"},
-            "GigabitEthernet3": {"status": "administratively down", "protocol": "down"}
-        },
-        "ping_results": {
-            "10.0.0.2": {"success": False, "packet_loss": 100, "rtt_min": 0, "rtt_avg": 0, "rtt_max": 0}
-        },
-        "traceroute_results": {
-            "10.0.0.2": [
-                {"hop": 1, "ip": "192.168.1.1", "rtt": 0.5},
-                {"hop": 2, "ip": "*", "rtt": None},
-                {"hop": 3, "ip": "*", "rtt": None}
-            ]
-        },
-        "acls": [
-            {"name": "ALLOW_WEB", "entries": ["permit tcp any any eq 80", "permit tcp any any eq 443"]},
-            {"name": "BLOCK_TELNET", "entries": ["deny tcp any any eq 23", "permit ip any any"]}
-        ],
-        "diagnostic_result": {
-            "status": "error",
-            "summary": "インターフェースダウンを検出しました",
-            "issues": [
-                {
-                    "type": "interface_down",
-                    "severity": "critical",
-                    "description": "GigabitEthernet1 がダウンしています",
-                    "recommendation": "物理接続を確認するか、'no shutdown'コマンドでインターフェースを有効にしてください"
-                }
-            ]
-        }
-    },
-    "ip_misconfigured": {
-        "interfaces": {
-            "GigabitEthernet0": {"status": "up", "protocol": "up"},
-            "GigabitEthernet1": {"status": "up", "protocol": "up", "ip": "10.0.0.254"},
-            "GigabitEthernet2": {"status": "up", "protocol": "up"},
-            "GigabitEthernet3": {"status": "administratively down", "protocol": "down"}
-        },
-        "ping_results": {
-            "10.0.0.2": {"success": False, "packet_loss": 100, "rtt_min": 0, "rtt_avg": 0, "rtt_max": 0}
-        },
-        "traceroute_results": {
-            "10.0.0.2": [
-                {"hop": 1, "ip": "192.168.1.1", "rtt": 0.5},
-                {"hop": 2, "ip": "10.0.0.254", "rtt": 1.3},
-                {"hop": 3, "ip": "*", "rtt": None}
-            ]
-        },
-        "acls": [
-            {"name": "ALLOW_WEB", "entries": ["permit tcp any any eq 80", "permit tcp any any eq 443"]},
-            {"name": "BLOCK_TELNET", "entries": ["deny tcp any any eq 23", "permit ip any any"]}
-        ],
-        "diagnostic_result": {
-            "status": "error",
-            "summary": "IP設定エラーを検出しました",
-            "issues": [
-                {
-                    "type": "ip_mismatch",
-                    "severity": "high",
-                    "description": "GigabitEthernet1のIPアドレスが不一致: 期待値 10.0.0.1, 実際の値 10.0.0.254",
-                    "recommendation": "'ip address 10.0.0.1 255.255.255.0'コマンドで正しいIPアドレスを設定してください"
-                }
-            ]
-        }
-    },
-    "acl_misconfigured": {
-        "interfaces": {
-            "GigabitEthernet0": {"status": "up", "protocol": "up"},
-            "GigabitEthernet1": {"status": "up", "protocol": "up"},
-            "GigabitEthernet2": {"status": "up", "protocol": "up"},
-            "GigabitEthernet3": {"status": "administratively down", "protocol": "down"}
-        },
-        "ping_results": {
-            "10.0.0.2": {"success": False, "packet_loss": 100, "rtt_min": 0, "rtt_avg": 0, "rtt_max": 0}
-        },
-        "traceroute_results": {
-            "10.0.0.2": [
-                {"hop": 1, "ip": "192.168.1.1", "rtt": 0.5},
-                {"hop": 2, "ip": "10.0.0.1", "rtt": 1.2},
-                {"hop": 3, "ip": "*", "rtt": None}
-            ]
-        },
-        "acls": [
-            {"name": "ALLOW_WEB", "entries": ["permit tcp any any eq 80", "permit tcp any any eq 443"]},
-            {"name": "BLOCK_ALL", "entries": ["deny ip any any"]}
-        ],
-        "diagnostic_result": {
-            "status": "warning",
-            "summary": "アクセスコントロールリストの問題を検出しました",
-            "issues": [
-                {
-                    "type": "acl_too_restrictive",
-                    "severity": "high",
-                    "description": "ACL 'BLOCK_ALL'がすべてのトラフィックをブロックしています",
-                    "recommendation": "必要なトラフィックを許可するようにACL設定を見直して更新してください"
-                }
-            ]
-        }
-    }
-}
+scenarios = SCENARIOS
 
 # 現在のシナリオ（デモ用）
-current_scenario = "healthy"
+# ルーター・セッション単位の指定がない場合のデフォルトとして使用する
+DEFAULT_SCENARIO = "healthy"
+
+# シナリオ状態管理 - セッション単位 > ルーター単位 > 注入した障害 > デフォルトの順で解決する
+# 障害以外は共有状態に置き、どのワーカーで変更しても全ワーカーに反映される
+class ScenarioState:
+    def __init__(self, backend, sessions: SessionStore):
+        self.backend = backend
+        self.sessions = sessions
+        # 注入した障害はシードから決まり全ワーカーで同じになるため共有しない
+        self.faults: Dict[str, str] = {}
+
+    def resolve(self, ip: Optional[str] = None, session_id: Optional[str] = None) -> str:
+        if session_id is not None:
+            # セッションを指定したリクエストはセッションの利用として期限を延長する
+            self.sessions.touch(session_id)
+            scenario_name = self.backend.get("session_scenario", session_id)
+            if scenario_name is not None:
+                return scenario_name
+        if ip is not None:
+            scenario_name = self.backend.get("router_scenario", ip) or self.faults.get(ip)
+            if scenario_name is not None:
+                return scenario_name
+        return self.backend.get("scenario", "default", DEFAULT_SCENARIO)
+
+    def set_fault(self, ip: str, scenario_name: str):
+        self.faults[ip] = scenario_name
+
+    async def set_default(self, scenario_name: str):
+        await self.backend.set("scenario", "default", scenario_name)
+
+    async def set_for_router(self, ip: str, scenario_name: str):
+        await self.backend.set("router_scenario", ip, scenario_name)
+
+    async def set_for_session(self, session_id: str, scenario_name: str):
+        await self.backend.set("session_scenario", session_id, scenario_name)
+
+    async def clear_session(self, session_id: str):
+        if self.backend.get("session_scenario", session_id) is not None:
+            await self.backend.delete("session_scenario", session_id)
+
+scenario_state = ScenarioState(shared_state, session_store)
+
+# シミュレーターが注入した障害はルーター単位のシナリオとして扱う
+for fault_ip, fault in fleet.faults.items():
+    scenario_state.set_fault(fault_ip, fault)
+
+# 実効デバイスビューのキャッシュ - (ip, シナリオ) ごとに一度だけ構築する
+# router_data は変更せず、構築済みのビューは読み取り専用として扱う
+class EffectiveViewCache:
+    def __init__(self):
+        # ip -> シナリオ -> ビュー (1台分の無効化を他のルーターの数に依存させない)
+        self._views: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    def get(self, ip: str, scenario_name: str) -> Dict[str, Any]:
+        views = self._views.setdefault(ip, {})
+        view = views.get(scenario_name)
+        if view is None:
+            view = build_effective_view(ip, scenario_name)
+            views[scenario_name] = view
+        return view
+
+    def invalidate(self, ip: Optional[str] = None, scenario_name: Optional[str] = None):
+        # 基本データまたはシナリオ定義が変更された場合のみ呼び出す
+        if ip is None and scenario_name is None:
+            self._views.clear()
+            return
+        if scenario_name is None:
+            self._views.pop(ip, None)
+            return
+        for views_ip in [ip] if ip is not None else list(self._views):
+            self._views.get(views_ip, {}).pop(scenario_name, None)
+
+    def update_interfaces(self, ip: str, changes: Dict[str, Dict[str, Any]]):
+        # 受信したイベントでインターフェースの状態だけが変わった場合は、構築済みのビューを作り直さずに差し替える
+        views = self._views.get(ip, {})
+        for scenario_name, view in views.items():
+            interfaces = view["interfaces"]
+            changed = {name: {**interfaces[name], **change} for name, change in changes.items() if name in interfaces}
+            views[scenario_name] = {**view, "interfaces": {**interfaces, **changed}}
+
+# syslog / SNMPトラップで受信したインターフェースの状態 (ip -> インターフェース -> 変化)
+# 機器から実際に届いた状態としてシナリオより優先し、シナリオを切り替えた場合は破棄する
+observed_interfaces: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+def build_effective_view(ip: str, scenario_name: str) -> Dict[str, Any]:
+    base_data = copy.deepcopy(router_data.get(ip, {}))
+    scenario_data = fleet.scenario(ip, scenario_name)
+
+    # インターフェース設定を適用
+    if "interfaces" in base_data and "interfaces" in scenario_data:
+        for interface, changes in scenario_data["interfaces"].items():
+            if interface in base_data["interfaces"]:
+                base_data["interfaces"][interface].update(changes)
+
+    # ACL設定を適用 - 同名のACLは置き換え、無いものは追加する
+    if "acls" in scenario_data or "remove_acls" in scenario_data:
+        acls = {acl["name"]: acl for acl in base_data.get("acls", [])}
+        for acl in scenario_data.get("acls", []):
+            acls[acl["name"]] = copy.deepcopy(acl)
+        for name in scenario_data.get("remove_acls", []):
+            acls.pop(name, None)
+        base_data["acls"] = list(acls.values())
+
+    for interface, changes in observed_interfaces.get(ip, {}).items():
+        if interface in base_data.get("interfaces", {}):
+            base_data["interfaces"][interface].update(changes)
+
+    return base_data
+
+view_cache = EffectiveViewCache()
+
+# running-configパーサー - 内容のハッシュで解析結果をキャッシュする
+config_parser = RunningConfigParser()
+
+# コンフィグのドリフト検出 - ブロックのハッシュで比較し、差分は異なるブロックだけ計算する
+drift_engine = DriftEngine()
+
+# 診断エンジン - (ip, シナリオ) ごとにルールの評価結果を保持する
+diagnostic_engine = DiagnosticEngine()
 
 # WebSocketクライアント管理
+# 低速クライアントのキューが溢れた場合の方針
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# まとめて送る場合の待ち時間の上限 (ミリ秒) と1フレームあたりのメッセージ数の上限
+MAX_BATCH_WINDOW_MS = 1000
+MAX_BATCH_MESSAGES = 256
+
+class ClientChannel:
+    # クライアントごとの送信キューと専用の送信タスク
+    # キューの要素は (種類, 内容, 統合キー, エンコード結果のメモ)
+    # 種類: json (辞書) / encoded (エンコード済みのJSON文字列) / text (文字列)
+    def __init__(self, websocket: WebSocket, client_id: str, max_queue_size: int, policy: str,
+                 codec: Optional[ws_codec.Codec] = None, batch_window: float = 0.0):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self.codec = codec or ws_codec.CODECS[ws_codec.DEFAULT_CODEC]
+        # 0より大きい場合は最初のメッセージから batch_window 秒の間に溜まったメッセージを1フレームで送る
+        self.batch_window = batch_window
+        self.compression = False
+        self.queue: Deque[tuple] = deque()
+        self.ready = asyncio.Event()
+        # キューが溢れる前に送るため、半分まで溜まった時点で待ち時間の途中でも送る
+        self.batch_limit = max(1, min(MAX_BATCH_MESSAGES, max_queue_size // 2))
+        self.batch_full = asyncio.Event()
+        self.closed = False
+        self.writer_task: Optional[asyncio.Task] = None
+        # 統計カウンター
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.frames = 0
+        self.payload_size = 0
+
+    def enqueue(self, kind: str, payload: Any, coalesce_key: Optional[str] = None,
+                memo: Optional[Dict[str, Any]] = None) -> bool:
+        # disconnect方針でキューが満杯の場合はFalseを返し、切断を呼び出し元に委ねる
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue_size:
+            if self.policy == "disconnect":
+                return False
+            if self.policy == "coalesce" and coalesce_key is not None:
+                for i, (_, _, key, _) in enumerate(self.queue):
+                    if key == coalesce_key:
+                        # 同じ種類の未送信メッセージを破棄し、最新の内容を末尾に積む
+                        del self.queue[i]
+                        self.queue.append((kind, payload, coalesce_key, memo))
+                        self.coalesced += 1
+                        return True
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append((kind, payload, coalesce_key, memo))
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.ready.set()
+        if len(self.queue) >= self.batch_limit:
+            self.batch_full.set()
+        return True
+
+    def _encode(self, kind: str, payload: Any, memo: Optional[Dict[str, Any]]) -> Union[str, bytes]:
+        # メッセージ1件を配列の要素としてエンコードする
+        if kind == "encoded" and not (memo and self.codec.name in memo):
+            if self.codec.name == "json":
+                return payload
+            payload = json.loads(payload)
+        return self.codec.encode(payload, memo)
+
+    def _frame(self, messages: List[tuple]) -> Union[str, bytes]:
+        if len(messages) == 1:
+            kind, payload, _, memo = messages[0]
+            # JSON形式の文字列メッセージは従来どおりそのまま送る
+            if kind == "text" and not self.codec.binary:
+                return payload
+            return self._encode(kind, payload, memo)
+        return self.codec.join([self._encode(kind, payload, memo) for kind, payload, _, memo in messages])
+
+    async def run_writer(self, on_error):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                if self.batch_window > 0:
+                    # 短い間に届いた進行状況などの小さなメッセージをまとめる
+                    if len(self.queue) < self.batch_limit:
+                        self.batch_full.clear()
+                        try:
+                            await asyncio.wait_for(self.batch_full.wait(), self.batch_window)
+                        except asyncio.TimeoutError:
+                            pass
+                    if self.closed or not self.queue:
+                        continue
+                count = min(len(self.queue), self.batch_limit) if self.batch_window > 0 else 1
+                frame = self._frame([self.queue.popleft() for _ in range(count)])
+                if isinstance(frame, bytes):
+                    await self.websocket.send_bytes(frame)
+                else:
+                    await self.websocket.send_text(frame)
+                self.sent += count
+                self.frames += 1
+                self.payload_size += len(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Send to client {self.client_id} failed: {e}")
+            on_error(self.client_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": len(self.queue),
+            "max_queue_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "frames": self.frames,
+            "payload_size": self.payload_size,
+            "codec": self.codec.name,
+            "batch_window": self.batch_window,
+            "compression": self.compression,
+            "policy": self.policy
+        }
+
 class ConnectionManager:
-    def __init__(self):
+    # broadcastとこのワーカーに接続していないクライアント宛てのメッセージは共有のバスを経由する
+    def __init__(self, bus, max_queue_size: int = 256, slow_consumer_policy: str = "drop_oldest"):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.bus = bus
+        bus.subscribe("ws.broadcast", self._on_broadcast)
+        bus.subscribe("ws.client", self._on_client_message)
+        self._report_task: Optional[asyncio.Task] = None
         self.active_connections: Dict[str, WebSocket] = {}
+        self.channels: Dict[str, ClientChannel] = {}
+        self.max_queue_size = max_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.slow_consumer_disconnects = 0
+        # 切断済みクライアントの送信統計 (メトリクスのカウンターが減らないよう累積しておく)
+        self.closed_totals = {"sent": 0, "dropped": 0, "coalesced": 0}
+        self.closed_frames = {"frames": 0, "payload_size": 0}
 
     async def connect(self, websocket: WebSocket, client_id: str):
-        await websocket.accept()
+        # メッセージ形式はサブプロトコルで、まとめて送る待ち時間はクエリの batch_ms で指定する
+        # どちらも無いクライアントには従来どおり1メッセージ1フレームのJSONを送る
+        codec, subprotocol = ws_codec.negotiate(websocket.scope.get("subprotocols") or [])
+        try:
+            batch_ms = min(float(websocket.query_params.get("batch_ms", 0)), MAX_BATCH_WINDOW_MS)
+        except ValueError:
+            batch_ms = 0.0
+        await websocket.accept(subprotocol=subprotocol)
+        # 同じIDで再接続した場合は古いチャネルを破棄する
+        self._close_channel(client_id)
+        channel = ClientChannel(websocket, client_id, self.max_queue_size, self.slow_consumer_policy,
+                                codec, max(0.0, batch_ms) / 1000)
+        # permessage-deflate はサーバー (uvicorn) がハンドシェイクで合意する - クライアントの申し出の有無を記録する
+        channel.compression = "permessage-deflate" in websocket.headers.get("sec-websocket-extensions", "")
+        channel.writer_task = asyncio.create_task(channel.run_writer(self._on_send_error))
         self.active_connections[client_id] = websocket
+        self.channels[client_id] = channel
+        self._schedule_report()
         logger.info(f"Client {client_id} connected. Total connections: {len(self.active_connections)}")
 
     def disconnect(self, client_id: str):
+        self._close_channel(client_id)
         if client_id in self.active_connections:
             del self.active_connections[client_id]
+            self._schedule_report()
             logger.info(f"Client {client_id} disconnected. Total connections: {len(self.active_connections)}")
 
-    async def send_personal_message(self, message: str, client_id: str):
-        if client_id in self.active_connections:
-            await self.active_connections[client_id].send_text(message)
+    def _schedule_report(self):
+        # 接続数の共有は1秒ごとにまとめて書き込む
+        if self._report_task is None or self._report_task.done():
+            self._report_task = asyncio.create_task(self._report())
+
+    async def _report(self):
+        await asyncio.sleep(1.0)
+        try:
+            await self.bus.set("workers", self.bus.worker_id, {
+                "pid": os.getpid(),
+                "connections": len(self.active_connections),
+                "updated": time.time()
+            })
+        except Exception as e:
+            logger.warning(f"Reporting connection count failed: {e}")
+
+    def _close_channel(self, client_id: str):
+        channel = self.channels.pop(client_id, None)
+        if channel is None:
+            return
+        channel.closed = True
+        self.closed_totals["sent"] += channel.sent
+        self.closed_totals["dropped"] += channel.dropped
+        self.closed_totals["coalesced"] += channel.coalesced
+        self.closed_frames["frames"] += channel.frames
+        self.closed_frames["payload_size"] += channel.payload_size
+        if channel.writer_task is not None and channel.writer_task is not asyncio.current_task():
+            channel.writer_task.cancel()
+
+    def _on_send_error(self, client_id: str):
+        self.disconnect(client_id)
+
+    def _enqueue(self, client_id: str, kind: str, payload: Any, coalesce_key: Optional[str] = None,
+                 memo: Optional[Dict[str, Any]] = None):
+        channel = self.channels.get(client_id)
+        if channel is None:
+            return
+        if not channel.enqueue(kind, payload, coalesce_key, memo):
+            # disconnect方針: 追いつけないクライアントは切断する
+            self.slow_consumer_disconnects += 1
+            logger.warning(f"Client {client_id} is too slow (queue depth {len(channel.queue)}). Disconnecting.")
+            websocket = channel.websocket
+            self.disconnect(client_id)
+            asyncio.create_task(self._close_socket(websocket))
+
+    async def _close_socket(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def _send(self, client_id: str, kind: str, payload: Any, coalesce_key: Optional[str],
+                    memo: Optional[Dict[str, Any]] = None):
+        if client_id in self.channels or not self.bus.shared:
+            self._enqueue(client_id, kind, payload, coalesce_key, memo)
+        else:
+            # 他のワーカーに接続しているクライアント
+            await self.bus.publish("ws.client", {"client_id": client_id, "kind": kind,
+                                                 "payload": payload, "coalesce_key": coalesce_key})
+
+    async def _on_client_message(self, message: Dict[str, Any]):
+        if message["client_id"] in self.channels:
+            self._enqueue(message["client_id"], message["kind"], message["payload"], message["coalesce_key"])
+
+    def broadcast_local(self, kind: str, payload: Any, coalesce_key: Optional[str] = None):
+        # 各クライアントのキューに積むだけで、送信は各送信タスクが並行して行う
+        # エンコード結果はメモで共有し、同じ形式のクライアントの間では1回だけエンコードする
+        memo: Dict[str, Any] = {}
+        for client_id in list(self.channels):
+            self._enqueue(client_id, kind, payload, coalesce_key, memo)
+
+    async def _on_broadcast(self, message: Dict[str, Any]):
+        self.broadcast_local(message["kind"], message["payload"], message["coalesce_key"])
+
+    async def send_personal_message(self, message: str, client_id: str, coalesce_key: Optional[str] = None):
+        await self._send(client_id, "text", message, coalesce_key)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections.values():
-            await connection.send_text(message)
+        # 全ワーカーのクライアントに届ける
+        await self.bus.publish("ws.broadcast", {"kind": "text", "payload": message, "coalesce_key": None})
+
+    async def broadcast_json(self, data: Dict):
+        await self.bus.publish("ws.broadcast", {"kind": "json", "payload": data, "coalesce_key": self._coalesce_key(data)})
 
     async def send_json(self, data: Dict, client_id: str):
-        if client_id in self.active_connections:
-            await self.active_connections[client_id].send_json(data)
+        await self._send(client_id, "json", data, self._coalesce_key(data))
+
+    async def send_encoded_json(self, encoded: str, client_id: str, coalesce_key: Optional[str] = None,
+                                memo: Optional[Dict[str, Any]] = None):
+        # エンコード済みのJSON - JSON形式のクライアントにはそのまま、他の形式のクライアントには変換して送る
+        await self._send(client_id, "encoded", encoded, coalesce_key, memo)
+
+    @staticmethod
+    def _coalesce_key(data: Dict) -> Optional[str]:
+        # 別のコマンドの進行状況や別ルーターの状態が統合されないようrequest_id・routerも含める
+        scope = [str(data[key]) for key in ("request_id", "router") if key in data]
+        if scope:
+            return ":".join([str(data.get("type")), *scope])
+        return data.get("type")
+
+    def message_totals(self) -> Dict[str, int]:
+        totals = dict(self.closed_totals)
+        for channel in self.channels.values():
+            totals["sent"] += channel.sent
+            totals["dropped"] += channel.dropped
+            totals["coalesced"] += channel.coalesced
+        return totals
+
+    def frame_totals(self) -> Dict[str, int]:
+        totals = dict(self.closed_frames)
+        for channel in self.channels.values():
+            totals["frames"] += channel.frames
+            totals["payload_size"] += channel.payload_size
+        return totals
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_connections": len(self.active_connections),
+            "slow_consumer_policy": self.slow_consumer_policy,
+            "slow_consumer_disconnects": self.slow_consumer_disconnects,
+            "protocols": ws_codec.available(),
+            "codecs": ws_codec.stats(),
+            "clients": {client_id: channel.stats() for client_id, channel in self.channels.items()}
+        }
+
+manager = ConnectionManager(shared_state)
+
+# 実機への接続 - 認証済みセッションをデバイスごとにプールして再利用する
+session_pool = SessionPool()
+device_params: Dict[str, DeviceParams] = {}
+# パスワードは共有状態 (SQLiteの場合はディスク) に平文で置かず、接続を受けたワーカーのメモリーに保持する
+# DEVICE_CREDENTIAL_KEY (Fernetの鍵) を全ワーカーに指定した場合のみ、暗号化して他のワーカーと共有する
+device_credentials: Dict[str, Tuple[str, Optional[str]]] = {}
+DEVICE_CREDENTIAL_KEY = os.environ.get("DEVICE_CREDENTIAL_KEY")
+if DEVICE_CREDENTIAL_KEY and Fernet is None:
+    logger.warning("DEVICE_CREDENTIAL_KEY requires the cryptography package; credentials stay local to each worker")
+credential_cipher = Fernet(DEVICE_CREDENTIAL_KEY) if DEVICE_CREDENTIAL_KEY and Fernet is not None else None
+
+def seal_credentials(password: str, enable_password: Optional[str]) -> Optional[str]:
+    if credential_cipher is None:
+        return None
+    return credential_cipher.encrypt(json.dumps([password, enable_password]).encode()).decode()
+
+def open_credentials(secret: Optional[str]) -> Optional[Tuple[str, Optional[str]]]:
+    if secret is None or credential_cipher is None:
+        return None
+    try:
+        password, enable_password = json.loads(credential_cipher.decrypt(secret.encode()))
+    except (InvalidToken, ValueError) as e:
+        logger.warning(f"Could not decrypt shared device credentials: {e}")
+        return None
+    return password, enable_password
 
-manager = ConnectionManager()
+# インターフェースカウンターとPing RTTの履歴
+history_store = TimeSeriesStore()
+
+# 診断・Ping・Traceroute・コマンド実行の結果の永続化 (HISTORY_DB にファイルのパス)
+# 保存期間は HISTORY_RETENTION_DAYS 日、件数の上限は HISTORY_MAX_ROWS
+result_history = ResultHistory(
+    os.environ.get("HISTORY_DB", "result_history.db"),
+    retention_days=float(os.environ.get("HISTORY_RETENTION_DAYS", 30)),
+    max_rows=int(os.environ.get("HISTORY_MAX_ROWS", 2000000))
+)
+
+# 時系列として記録するインターフェースカウンター
+INTERFACE_COUNTERS = ("input_packets", "input_errors", "output_packets", "output_errors")
 
 # ヘルパー関数
-def apply_scenario(ip: str, scenario_name: str):
-    global current_scenario
-    current_scenario = scenario_name
-    
-    # 基本データを取得
-    base_data = router_data.get(ip, {}).copy()
-    
-    # シナリオデータを適用
-    scenario_data = scenarios.get(scenario_name, {})
-    
-    # インターフェース設定を更新
-    if "interfaces" in base_data and "interfaces" in scenario_data:
-        for interface, changes in scenario_data["interfaces"].items():
-            if interface in base_data["interfaces"]:
-                base_data["interfaces"][interface].update(changes)
-    
-    # ACL設定を更新
-    if "acls" in scenario_data:
-        base_data["acls"] = scenario_data["acls"]
+def record_ping_history(ip: str, target: str, result: Dict[str, Any]):
+    series = f"ping:{target}"
+    history_store.record(ip, series, "packet_loss", result.get("packet_loss", 100))
+    if result.get("rtt_avg") is not None:
+        history_store.record(ip, series, "rtt_avg", result["rtt_avg"])
+
+def record_interface_history(ip: str, interfaces: Dict[str, Dict[str, Any]],
+                             details: Optional[List[Dict[str, Any]]] = None):
+    for name, interface in interfaces.items():
+        history_store.record(ip, name, "oper_up", 1 if interface.get("protocol") == "up" else 0)
+    for record in details or []:
+        for counter in INTERFACE_COUNTERS:
+            if record.get(counter) is not None:
+                history_store.record(ip, record["name"], counter, int(record[counter]))
+
+async def collect_router_state(ip: str) -> Dict[str, Any]:
+    # ポーリングで1台分の状態 (情報・インターフェース・ACL) をまとめて収集する
+    if ip in device_params:
+        params = device_params[ip]
+        # デバイスへの負荷を抑えるため、コマンドは順に実行する
+        version = await session_pool.run(params, "show version")
+        brief = await session_pool.run(params, "show ip interface brief")
+        details = await session_pool.run(params, "show interfaces")
+        config = await session_pool.run(params, "show running-config")
+        detail_records = parse_output("show interfaces", details)
+        interfaces = interfaces_from_records(parse_output("show ip interface brief", brief), detail_records)
+        record_interface_history(ip, interfaces, detail_records)
+        return {
+            "scenario": None,
+            "info": router_info_from_version(parse_output("show version", version)),
+            "interfaces": interfaces,
+            "acls": acls_from_config(config_parser.parse(config)),
+        }
     
-    return base_data
+    await latency.delay("poll")  # シミュレーション遅延
+    state = simulated_state(ip)
+    record_interface_history(ip, state["interfaces"])
+    return state
+
+def simulated_state(ip: str) -> Dict[str, Any]:
+    scenario_name = scenario_state.resolve(ip)
+    view = view_cache.get(ip, scenario_name)
+    return {
+        "scenario": scenario_name,
+        "info": view["info"],
+        "interfaces": view["interfaces"],
+        "acls": view.get("acls", []),
+    }
+
+def get_polled_state(ip: str, session_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    state = poller.latest(ip)
+    if state is None:
+        return None
+    # セッション単位のシナリオが収集時のシナリオと異なる場合は使わない
+    if ip not in device_params and state.data["scenario"] != scenario_state.resolve(ip, session_id):
+        return None
+    return state.data
+
+# 購読中のクライアントへ状態の差分を配信する
+state_feed = StateFeed()
+
+# インターフェースのサブネットとTracerouteから組み立てたトポロジー
+topology = TopologyGraph()
+
+def build_topology():
+    for ip in router_data:
+        view = view_cache.get(ip, scenario_state.resolve(ip))
+        topology.update_device(ip, view["interfaces"], view.get("masks"), get_router_site(ip))
+    for link in fleet.links:
+        if link["b_interface"] is None:
+            topology.add_link(link["a"], link["a_interface"], link["b"])
+
+async def publish_router_state(ip: str, data: Dict[str, Any]):
+    # 収集した状態でインターフェースが変化していれば、トポロジーの該当する辺だけを更新する
+    topology.update_device(ip, data["interfaces"], router_data.get(ip, {}).get("masks"))
+    version = state_feed.version(ip)
+    # 同じ内容のフレームはエンコード済みの文字列を共有して各クライアントのキューに積む
+    # (JSON以外の形式のクライアント向けの変換結果もフレームごとのメモで共有する)
+    memos: Dict[int, Dict[str, Any]] = {}
+    for client_id, frame in state_feed.publish(ip, data):
+        memo = memos.setdefault(id(frame), {})
+        await manager.send_encoded_json(frame, client_id, coalesce_key=f"state_delta:{ip}", memo=memo)
+    if state_feed.version(ip) != version:
+        response_cache.invalidate(ip)
+
+# 読み取りAPIのシリアライズ済みレスポンス
+response_cache = ResponseCache()
+
+def response_key(ip: str, resource: str, session_id: Optional[str] = None) -> tuple:
+    # 擬似ルーターの内容はシナリオで、実機の内容は収集した状態の版で決まる
+    scenario_name = None if ip in device_params else scenario_state.resolve(ip, session_id)
+    return (ip, resource, scenario_name, state_feed.version(ip))
+
+def cached_response(request: Request, entry: CachedResponse) -> Response:
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if entry.matches(request.headers.get("if-none-match")):
+        response_cache.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+# 全ルーターの状態を定期的に収集し、読み取りAPIは収集済みの状態から返す
+POLL_INTERVAL = 30.0
+POLL_MAX_CONCURRENCY = 50
+poll_duration = metrics.histogram(
+    "router_poll_duration_seconds", "Duration of router state polls", ("outcome",))
+
+def observe_poll(ip: str, duration: float, succeeded: bool):
+    poll_duration.observe(duration, "success" if succeeded else "failure")
+
+poller = PollingScheduler(
+    collect_router_state,
+    interval=POLL_INTERVAL,
+    max_concurrency=POLL_MAX_CONCURRENCY,
+    on_update=publish_router_state,
+    on_poll=observe_poll
+)
+
+# スクレイプ時に読み取る現在値
+def collect_runtime_metrics():
+    channels = list(manager.channels.values())
+    depths = [len(channel.queue) for channel in channels]
+    totals = manager.message_totals()
+    yield ("websocket_connections", "gauge", "Active WebSocket connections",
+           [({}, len(manager.active_connections))])
+    yield ("websocket_queue_depth", "gauge", "Messages waiting in outbound WebSocket queues",
+           [({"stat": "sum"}, sum(depths)), ({"stat": "max"}, max(depths, default=0))])
+    yield ("websocket_messages_total", "counter", "Outbound WebSocket messages by outcome",
+           [({"outcome": outcome}, count) for outcome, count in totals.items()])
+    frames = manager.frame_totals()
+    yield ("websocket_frames_total", "counter", "Outbound WebSocket frames (batched messages share a frame)",
+           [({}, frames["frames"])])
+    yield ("websocket_payload_size_total", "counter", "Outbound WebSocket payload size before compression",
+           [({}, frames["payload_size"])])
+    yield ("websocket_slow_consumer_disconnects_total", "counter", "Clients disconnected for falling behind",
+           [({}, manager.slow_consumer_disconnects)])
+    yield ("connected_routers", "gauge", "Routers with an active connection", [({}, len(connected_routers))])
+
+def collect_cache_metrics():
+    cache = response_cache.stats()
+    lookups = cache["hits"] + cache["misses"]
+    yield ("response_cache_requests_total", "counter", "Response cache lookups by result",
+           [({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"]),
+            ({"result": "not_modified"}, cache["not_modified"])])
+    yield ("response_cache_hit_ratio", "gauge", "Response cache hit ratio since start",
+           [({}, cache["hits"] / lookups if lookups else 0.0)])
+    yield ("response_cache_evictions_total", "counter", "Response cache evictions", [({}, cache["evictions"])])
+    yield ("response_cache_entries", "gauge", "Entries in the response cache", [({}, cache["entries"])])
+    yield ("response_cache_bytes", "gauge", "Bytes held by the response cache", [({}, cache["bytes"])])
+    parser = config_parser.stats
+    yield ("config_parser_cache_requests_total", "counter", "Running-config parser cache lookups",
+           [({"level": level, "result": result}, parser[f"{level}_{key}"])
+            for level in ("config", "block") for result, key in (("hit", "hits"), ("miss", "misses"))])
+    yield ("diagnostic_rule_evaluations_total", "counter", "Diagnostic rule evaluations",
+           [({}, diagnostic_engine.stats()["evaluations"])])
+
+def collect_poller_metrics():
+    targets = list(poller.targets.values())
+    yield ("router_poll_targets", "gauge", "Routers registered with the poller", [({}, len(targets))])
+    yield ("router_poll_in_flight", "gauge", "Router polls currently running",
+           [({}, sum(1 for target in targets if target.in_flight))])
+    yield ("router_poll_failures_total", "counter", "Failed router polls", [({}, sum(target.failures for target in targets))])
+    yield ("router_poll_last_duration_seconds", "gauge", "Duration of the last poll per router",
+           [({"router": target.ip}, target.last_duration) for target in targets if target.last_duration is not None])
+    yield ("router_poll_interval_seconds", "gauge", "Current adaptive poll interval per router",
+           [({"router": target.ip}, target.interval) for target in targets])
+    yield ("transport_sessions", "gauge", "Pooled device sessions by state",
+           [({"device": device, "state": state}, pool[state])
+            for device, pool in session_pool.stats().items() for state in ("idle", "in_use")])
+    yield ("state_feed_subscriptions", "gauge", "Active router state subscriptions",
+           [({}, state_feed.stats()["subscriptions"])])
+    yield ("history_series", "gauge", "Time series held in the history store", [({}, history_store.stats()["series"])])
+
+metrics.register_collector(collect_runtime_metrics)
+metrics.register_collector(collect_cache_metrics)
+metrics.register_collector(collect_poller_metrics)
+
+# 共有状態の変更 (自分と他のワーカーの両方) をこのワーカーに反映する
+def on_default_scenario_changed(key: str, scenario_name: Optional[str]):
+    if observed_interfaces:
+        observed_interfaces.clear()
+        view_cache.invalidate()
+    response_cache.invalidate()
+    for ip in router_data:
+        poller.poll_soon(ip)
+    manager.broadcast_local("json", {"type": "scenario_changed", "scenario": scenario_name or DEFAULT_SCENARIO})
+
+def on_router_scenario_changed(ip: str, scenario_name: Optional[str]):
+    if observed_interfaces.pop(ip, None) is not None:
+        view_cache.invalidate(ip)
+    response_cache.invalidate(ip)
+    poller.poll_soon(ip)
+    data = {"type": "scenario_changed", "router": ip, "scenario": scenario_state.resolve(ip)}
+    manager.broadcast_local("json", data, ConnectionManager._coalesce_key(data))
+
+def on_device_changed(ip: str, params: Optional[Dict[str, Any]]):
+    if params is None:
+        device_params.pop(ip, None)
+        device_credentials.pop(ip, None)
+        poller.unregister(ip)
+        return
+    params = dict(params)
+    # 以前の形式で平文のパスワードが残っている記録は使わない
+    params.pop("password", None)
+    params.pop("enable_password", None)
+    credentials = open_credentials(params.pop("secret", None)) or device_credentials.get(ip)
+    if credentials is None:
+        # 認証情報を持たないワーカーではこのデバイスに接続しない
+        logger.warning(f"No credentials for device {ip} on this worker; connect through this worker to poll it")
+        return
+    device_credentials[ip] = credentials
+    device_params[ip] = DeviceParams(**params, password=credentials[0], enable_password=credentials[1])
+    poller.register(ip)
+
+shared_state.watch("scenario", on_default_scenario_changed)
+shared_state.watch("router_scenario", on_router_scenario_changed)
+shared_state.watch("devices", on_device_changed)
+
+async def run_device_command(ip: str, command: str) -> str:
+    try:
+        return await session_pool.run(device_params[ip], command)
+    except AuthenticationError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except TransportError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+def collect_diagnostic_facts(ip: str, scenario_name: str) -> Dict[str, Any]:
+    view = view_cache.get(ip, scenario_name)
+    scenario_data = fleet.scenario(ip, scenario_name)
+    facts: Dict[str, Any] = {}
+    for name, interface in view.get("interfaces", {}).items():
+        facts[f"interface:{name}"] = interface
+    # 擬似データベースの設定値を期待値とする
+    masks = router_data.get(ip, {}).get("masks", {})
+    for name, interface in router_data.get(ip, {}).get("interfaces", {}).items():
+        facts[f"expected_ip:{name}"] = {"ip": interface["ip"], "mask": masks.get(name, "255.255.255.0")}
+    for acl in view.get("acls", []):
+        facts[f"acl:{acl['name']}"] = acl["entries"]
+    for target, result in scenario_data.get("ping_results", {}).items():
+        facts[f"ping:{target}"] = result
+    for target, hops in scenario_data.get("traceroute_results", {}).items():
+        facts[f"traceroute:{target}"] = hops
+    return facts
+
+def evaluate_router(ip: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+    # 現在の状態からファクトを集め、変化したルールだけを再評価する
+    scenario_name = scenario_state.resolve(ip, session_id)
+    facts = collect_diagnostic_facts(ip, scenario_name)
+    return diagnostic_engine.evaluate((ip, scenario_name), facts)
+
+def get_router_site(ip: str) -> str:
+    # サイト情報が無いルーターは/24単位で同じサイトとみなす
+    site = router_data.get(ip, {}).get("info", {}).get("site")
+    return site or ip.rsplit(".", 1)[0]
+
+def select_routers(routers: List[str], selector: Optional[str]) -> List[str]:
+    selected = list(dict.fromkeys(routers))
+    if selector:
+        seen = set(selected)
+        selected += [ip for ip in router_data if fnmatch.fnmatch(ip, selector) and ip not in seen]
+    return selected
+
+def get_effective_view(ip: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+    return view_cache.get(ip, scenario_state.resolve(ip, session_id))
+
+def get_scenario_data(ip: Optional[str] = None, session_id: Optional[str] = None) -> Dict[str, Any]:
+    return fleet.scenario(ip, scenario_state.resolve(ip, session_id))
+
+# syslog / SNMPトラップの受信 (INGEST_SYSLOG_PORT / INGEST_TRAP_PORT を指定した場合のみ待ち受ける)
+# 受信したワーカーが解析・集約した結果を共有状態のバスで配り、各ワーカーがポーリングを待たずに状態へ反映する
+INGEST_HOST = os.environ.get("INGEST_HOST", "0.0.0.0")
+INGEST_SYSLOG_PORT = int(os.environ.get("INGEST_SYSLOG_PORT", 0))
+INGEST_TRAP_PORT = int(os.environ.get("INGEST_TRAP_PORT", 0))
+
+router_hostnames = {data["hostname"]: ip for ip, data in router_data.items() if data.get("hostname")}
+
+def resolve_event_router(source: str, host: Optional[str]) -> Optional[str]:
+    # メッセージ中のホスト名・アドレスを優先し、無ければ送信元アドレスで探す
+    for address in (host, source):
+        if address is None:
+            continue
+        if address in router_data or address in device_params:
+            return address
+        ip = router_hostnames.get(address)
+        if ip is not None:
+            return ip
+    # 管理アドレス以外のインターフェースから送られた場合
+    for address in (host, source):
+        try:
+            resolved = topology.resolve(address) if address else None
+        except ValueError:
+            continue
+        if resolved is not None and resolved["type"] == "device":
+            return resolved["device"]
+    return None
+
+async def publish_ingested(summary: Dict[str, Any]):
+    await shared_state.publish("ingest.updates", {**summary, "origin": shared_state.worker_id})
+
+event_ingestor = EventIngestor(resolve_event_router, publish_ingested,
+                               max_queue=int(os.environ.get("INGEST_QUEUE", 65536)),
+                               community=os.environ.get("INGEST_COMMUNITY"))
+
+# ルーター -> ACL -> 動作 -> パケット数 (ACLのログから集計)
+acl_hits: Dict[str, Dict[str, Dict[str, int]]] = {}
+# 受信したイベントで再評価した診断結果の状態 (変化した場合のみ通知する) - キーは (ip, シナリオ)
+ingested_diagnostics: Dict[tuple, str] = {}
+INGEST_YIELD_EVERY = 64
+ingest_applied = {"interfaces": 0, "routers": 0, "unknown_interfaces": 0, "config_changes": 0,
+                  "diagnostics_changed": 0}
+
+def apply_interface_events(ip: str, changes: Dict[str, Dict[str, str]]) -> Optional[Tuple[Dict[str, Any], List[str]]]:
+    # 変化後の状態と変化したインターフェースを返す (変化が無い場合はNone)
+    # 状態の辞書は配信済みのスナップショットと共有されているため、変更せずに置き換える
+    polled = poller.latest(ip) if ip in device_params else None
+    if ip in device_params:
+        if polled is None:
+            return None
+        interfaces = polled.data["interfaces"]
+    else:
+        interfaces = view_cache.get(ip, scenario_state.resolve(ip))["interfaces"]
+    names = list(interfaces)
+    updated = {}
+    for name, change in changes.items():
+        matched = match_interface(name, names)
+        if matched is None:
+            ingest_applied["unknown_interfaces"] += 1
+            continue
+        current = interfaces[matched]
+        if any(current.get(key) != value for key, value in change.items()):
+            updated[matched] = change
+    if not updated:
+        return None
+    ingest_applied["interfaces"] += len(updated)
+    if polled is not None:
+        state = {**polled.data, "interfaces": {**interfaces,
+                                               **{name: {**interfaces[name], **change} for name, change in updated.items()}}}
+    else:
+        observed = observed_interfaces.setdefault(ip, {})
+        for name, change in updated.items():
+            observed[name] = {**observed.get(name, {}), **change}
+        view_cache.update_interfaces(ip, updated)
+        state = simulated_state(ip)
+    record_interface_history(ip, {name: state["interfaces"][name] for name in updated})
+    poller.set_state(ip, state)
+    return state, list(updated)
+
+def notify_diagnostics(ip: str, state: Dict[str, Any], names: List[str], record: bool):
+    # 変化したインターフェースのファクトだけを渡して、影響するルールのみ再評価する
+    target = (ip, state["scenario"])
+    result = diagnostic_engine.update_facts(target, {f"interface:{name}": state["interfaces"][name] for name in names})
+    previous = ingested_diagnostics.get(target)
+    ingested_diagnostics[target] = result["status"]
+    if previous == result["status"]:
+        return
+    ingest_applied["diagnostics_changed"] += 1
+    data = {"type": "diagnostics_changed", "router": ip, "status": result["status"], "previous": previous,
+            "summary": result["summary"], "issues": result["issues"]}
+    manager.broadcast_local("json", data, ConnectionManager._coalesce_key(data))
+    # 履歴は受信したワーカーだけが記録する
+    if record:
+        result_history.record(ip, "diagnostics", result, site=get_router_site(ip), status=result["status"],
+                              issues=result["issues"])
+
+async def on_ingested(summary: Dict[str, Any]):
+    record = summary.get("origin") == shared_state.worker_id
+    for ip, acls in summary["acl_hits"].items():
+        counts = acl_hits.setdefault(ip, {})
+        for name, actions in acls.items():
+            acl = counts.setdefault(name, {})
+            for action, packets in actions.items():
+                acl[action] = acl.get(action, 0) + packets
+    for ip in summary["config_changed"]:
+        # コンフィグの変更は内容が分からないため収集し直す
+        ingest_applied["config_changes"] += 1
+        poller.poll_soon(ip)
+    for count, (ip, changes) in enumerate(summary["interfaces"].items(), 1):
+        if count % INGEST_YIELD_EVERY == 0:
+            # 多数のルーターを反映する間も受信を止めないよう、定期的にイベントループに制御を返す
+            await asyncio.sleep(0)
+        try:
+            diagnosed = ip in router_data and ip not in device_params
+            if diagnosed:
+                target = (ip, scenario_state.resolve(ip))
+                if target not in ingested_diagnostics:
+                    # 全ファクトで一度評価し、変化の前の状態を基準にする
+                    ingested_diagnostics[target] = evaluate_router(ip)["status"]
+            applied = apply_interface_events(ip, changes)
+            if applied is None:
+                continue
+            state, names = applied
+            ingest_applied["routers"] += 1
+            await publish_router_state(ip, state)
+            if diagnosed:
+                notify_diagnostics(ip, state, names, record)
+        except Exception as e:
+            # 1台の反映に失敗しても同じバッチの他のルーターは反映する
+            logger.error(f"Failed to apply ingested events for {ip}: {e}")
+
+shared_state.subscribe("ingest.updates", on_ingested)
+
+def collect_ingest_metrics():
+    stats = event_ingestor.stats()
+    yield ("ingest_messages_total", "counter", "Received syslog messages and SNMP traps",
+           [({"kind": kind}, count) for kind, count in stats["received"].items()])
+    yield ("ingest_dropped_total", "counter", "Received messages dropped by reason",
+           [({"reason": reason}, count) for reason, count in stats["dropped"].items()])
+    yield ("ingest_socket_dropped_total", "counter", "Messages dropped by the kernel before they were read",
+           [({"kind": kind}, count) for kind, count in stats["socket_dropped"].items()])
+    yield ("ingest_events_total", "counter", "State events extracted from received messages", [({}, stats["events"])])
+    yield ("ingest_queue_depth", "gauge", "Messages waiting to be parsed", [({}, stats["queue_depth"])])
+    yield ("ingest_interface_updates_total", "counter", "Interface state changes applied from events",
+           [({}, ingest_applied["interfaces"])])
+
+metrics.register_collector(collect_ingest_metrics)
 
 # APIエンドポイント
 @app.get("/")
@@ -336,18 +1111,65 @@ async def root():
 
 @app.post("/connect", response_model=ConnectionResponse)
 async def connect_router(router: RouterInfo):
-    logger.info(f"Connection request: {router}")
-    
-    # 実際のシステムではここでルーターへの接続処理を実装
-    # テスト用に成功を返す
-    session_id = f"session-{random.randint(1000, 9999)}"
-    connected_routers[session_id] = {
-        "ip": router.ip,
-        "connected_at": datetime.now().isoformat(),
-        "scenario": current_scenario
-    }
+    logger.info(f"Connection request: {router.ip} ({router.connection_type})")
+    
+    # 擬似データベースに無いルーターは実機としてSSH/Telnetで接続する
+    if router.ip not in router_data:
+        if router.connection_type not in ("ssh", "telnet"):
+            raise HTTPException(status_code=400, detail=f"Unsupported connection type: {router.connection_type}")
+        params = DeviceParams(
+            router.ip,
+            username=router.username,
+            password=router.password,
+            enable_password=router.enable_password,
+            connection_type=router.connection_type,
+            port=router.port
+        )
+        try:
+            await session_pool.verify(params)
+        except AuthenticationError as e:
+            raise HTTPException(status_code=401, detail=str(e))
+        except TransportError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+        # 他のワーカーでも同じデバイスを扱えるよう接続情報を共有する (パスワードは暗号化した場合のみ共有する)
+        device_credentials[router.ip] = (params.password, params.enable_password)
+        shared = {
+            "host": params.host,
+            "username": params.username,
+            "connection_type": params.connection_type,
+            "port": params.port
+        }
+        secret = seal_credentials(params.password, params.enable_password)
+        if secret is not None:
+            shared["secret"] = secret
+        await shared_state.set("devices", router.ip, shared)
+        try:
+            session_id = await session_store.create({
+                "ip": router.ip,
+                "connected_at": datetime.now().isoformat(),
+                "transport": router.connection_type
+            }, user=router.username)
+        except SessionLimitError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        return {
+            "success": True,
+            "message": f"Successfully connected to {router.ip}",
+            "session_id": session_id
+        }
+    
+    # デモ用ルーターはシミュレーションで成功を返す
+    scenario_name = scenario_state.resolve(router.ip)
+    try:
+        session_id = await session_store.create({
+            "ip": router.ip,
+            "connected_at": datetime.now().isoformat(),
+            "scenario": scenario_name
+        }, user=router.username)
+    except SessionLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    await scenario_state.set_for_session(session_id, scenario_name)
     
-    await asyncio.sleep(1)  # シミュレーション遅延
+    await latency.delay("connect")  # シミュレーション遅延
     
     return {
         "success": True,
@@ -355,255 +1177,1047 @@ async def connect_router(router: RouterInfo):
         "session_id": session_id
     }
 
+@app.post("/disconnect")
+async def disconnect_router(session_id: str):
+    if not await session_store.close(session_id):
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    return {"message": f"Session {session_id} disconnected"}
+
+@app.get("/sessions")
+async def get_session_stats():
+    return session_store.stats()
+
+@app.get("/connections")
+async def get_connections():
+    workers = shared_state.items("workers")
+    return {
+        **manager.stats(),
+        "worker_id": shared_state.worker_id,
+        "workers": workers,
+        "total_connections": sum(worker["connections"] for worker in workers.values())
+    }
+
+@app.get("/shared-state")
+async def get_shared_state_stats():
+    return shared_state.stats()
+
+@app.get("/transport/sessions")
+async def get_transport_sessions():
+    return session_pool.stats()
+
+@app.get("/polling")
+async def get_polling_stats():
+    return poller.stats()
+
+@app.get("/ingest")
+async def get_ingest_stats():
+    return {**event_ingestor.stats(), "applied": ingest_applied}
+
+@app.get("/subscriptions")
+async def get_subscription_stats():
+    return state_feed.stats()
+
+@app.get("/cache")
+async def get_cache_stats():
+    return response_cache.stats()
+
+@app.get("/simulator")
+async def get_simulator_stats():
+    return {
+        **fleet.stats(),
+        "latency": {"distribution": latency.distribution, "scale": latency.scale, "jitter": latency.jitter}
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/profiler")
+async def get_profiler():
+    return profiler.stats()
+
+@app.post("/profiler")
+async def set_profiler(enabled: bool, threshold_ms: Optional[float] = None, interval_ms: Optional[float] = None):
+    # プロファイラーの有効・無効を切り替える (無効化すると採取済みのサンプルは破棄される)
+    if enabled:
+        profiler.start(
+            interval=interval_ms / 1000 if interval_ms is not None else None,
+            threshold=threshold_ms / 1000 if threshold_ms is not None else None
+        )
+    else:
+        profiler.stop()
+    return profiler.stats()
+
+@app.get("/profiler/stacks")
+async def get_profiler_stacks(reset: bool = False):
+    # flamegraph.pl や speedscope にそのまま渡せる折りたたみ形式
+    folded = profiler.folded()
+    if reset:
+        profiler.reset()
+    return PlainTextResponse(folded)
+
 @app.get("/scenarios")
 async def get_scenarios():
     return {"scenarios": list(scenarios.keys())}
 
 @app.post("/scenario/{scenario_name}")
-async def set_scenario(scenario_name: str):
-    global current_scenario
+async def set_scenario(scenario_name: str, ip: Optional[str] = None, session_id: Optional[str] = None):
     if scenario_name not in scenarios:
         raise HTTPException(status_code=404, detail=f"Scenario {scenario_name} not found")
     
-    current_scenario = scenario_name
+    # セッション・ルーター単位で指定された場合は他のクライアントに影響させない
+    if session_id is not None:
+        if await session_store.update(session_id, scenario=scenario_name) is None:
+            raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+        await scenario_state.set_for_session(session_id, scenario_name)
+        return {"message": f"Scenario set to {scenario_name} for session {session_id}"}
+    # キャッシュの無効化と再収集は、全ワーカーで on_*_scenario_changed が行う
+    if ip is not None:
+        if ip not in router_data:
+            raise HTTPException(status_code=404, detail=f"Router {ip} not found")
+        await scenario_state.set_for_router(ip, scenario_name)
+        return {"message": f"Scenario set to {scenario_name} for router {ip}"}
+    
+    await scenario_state.set_default(scenario_name)
     return {"message": f"Scenario set to {scenario_name}"}
 
+@app.post("/parse")
+async def parse_command_outputs(request: ParseRequest):
+    # 複数のshowコマンド出力をまとめて構造化する
+    return {"results": parse_batch((item.command, item.output) for item in request.items)}
+
 @app.get("/router/{ip}/info")
-async def get_router_info(ip: str):
+async def get_router_info(ip: str, request: Request):
+    key = response_key(ip, "info")
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached_response(request, cached)
+    
+    polled = get_polled_state(ip)
+    if polled is not None:
+        return cached_response(request, response_cache.put(key, polled["info"]))
+    
+    if ip in device_params:
+        output = await run_device_command(ip, "show version")
+        return router_info_from_version(parse_output("show version", output))
+    
     if ip not in router_data:
         raise HTTPException(status_code=404, detail=f"Router {ip} not found")
     
-    await asyncio.sleep(0.5)  # シミュレーション遅延
+    await latency.delay("info")  # シミュレーション遅延
     
-    return router_data[ip]["info"]
+    return cached_response(request, response_cache.put(key, router_data[ip]["info"]))
 
 @app.get("/router/{ip}/interfaces")
-async def get_interfaces(ip: str):
+async def get_interfaces(ip: str, request: Request, session_id: Optional[str] = None):
+    key = response_key(ip, "interfaces", session_id)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached_response(request, cached)
+    
+    polled = get_polled_state(ip, session_id)
+    if polled is not None:
+        return cached_response(request, response_cache.put(key, polled["interfaces"]))
+    
+    if ip in device_params:
+        brief, details = await asyncio.gather(
+            run_device_command(ip, "show ip interface brief"),
+            run_device_command(ip, "show interfaces")
+        )
+        detail_records = parse_output("show interfaces", details)
+        # 履歴はポーリングとイベントによる状態更新でのみ記録する (読み取りの回数で系列が歪まないように)
+        return interfaces_from_records(parse_output("show ip interface brief", brief), detail_records)
+    
     if ip not in router_data:
         raise HTTPException(status_code=404, detail=f"Router {ip} not found")
     
     # 現在のシナリオに基づいてデータを取得
-    router_with_scenario = apply_scenario(ip, current_scenario)
+    router_with_scenario = get_effective_view(ip, session_id)
     
-    await asyncio.sleep(0.5)  # シミュレーション遅延
+    await latency.delay("interfaces")  # シミュレーション遅延
     
-    return router_with_scenario["interfaces"]
+    return cached_response(request, response_cache.put(key, router_with_scenario["interfaces"]))
 
 @app.get("/router/{ip}/ping")
-async def ping(ip: str, target: str):
+async def ping(ip: str, target: str, session_id: Optional[str] = None):
     if ip not in router_data:
         raise HTTPException(status_code=404, detail=f"Router {ip} not found")
     
-    await asyncio.sleep(1.5)  # シミュレーション遅延
+    await latency.delay("ping")  # シミュレーション遅延
     
     # 現在のシナリオからPing結果を取得
-    scenario_data = scenarios.get(current_scenario, {})
+    scenario_data = get_scenario_data(ip, session_id)
     ping_results = scenario_data.get("ping_results", {})
     
     if target in ping_results:
-        return ping_results[target]
+        result = ping_results[target]
     else:
         # デフォルトの成功結果
-        return {
+        result = {
             "success": True,
             "packet_loss": 0,
             "rtt_min": 0.5,
             "rtt_avg": 1.2,
             "rtt_max": 2.1
         }
+    record_ping_history(ip, target, result)
+    result_history.record(ip, "ping", result, site=get_router_site(ip), target=target,
+                          status="success" if result.get("success") else "failed")
+    return result
+
+@app.get("/router/{ip}/history")
+async def get_history(
+    ip: str,
+    series: str,
+    metric: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    resolution: str = "auto"
+):
+    # series はインターフェース名、またはPing宛先の "ping:<target>"
+    try:
+        return {"router": ip, "series": series, "metric": metric,
+                **history_store.query(ip, series, metric, start, end, resolution)}
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.get("/router/{ip}/history/series")
+async def get_history_series(ip: str):
+    return history_store.series(ip)
+
+@app.get("/history/stats")
+async def get_history_stats():
+    return history_store.stats()
 
 @app.get("/router/{ip}/traceroute")
-async def traceroute(ip: str, target: str):
+async def traceroute(ip: str, target: str, session_id: Optional[str] = None):
     if ip not in router_data:
         raise HTTPException(status_code=404, detail=f"Router {ip} not found")
     
-    await asyncio.sleep(2)  # シミュレーション遅延
+    await latency.delay("traceroute")  # シミュレーション遅延
     
     # 現在のシナリオからTraceroute結果を取得
-    scenario_data = scenarios.get(current_scenario, {})
+    scenario_data = get_scenario_data(ip, session_id)
     traceroute_results = scenario_data.get("traceroute_results", {})
     
     if target in traceroute_results:
-        return traceroute_results[target]
+        hops = traceroute_results[target]
     else:
-        # デフォルトの結果
-        return [
-            {"hop": 1, "ip": "192.168.1.1", "rtt": 0.5},
-            {"hop": 2, "ip": "10.0.0.1", "rtt": 1.2},
-            {"hop": 3, "ip": target, "rtt": 2.1}
-        ]
+        # デフォルトの結果 (ルーターのアドレスから経路を作る)
+        hops = default_traceroute(router_data[ip], target)
+    topology.add_traceroute(ip, hops)
+    result_history.record(ip, "traceroute", hops, site=get_router_site(ip), target=target)
+    return hops
+
+# 1ページの最大件数
+RESULT_PAGE_LIMIT = 1000
+
+# 保存済みの結果の一覧 - 新しい順に返し、続きは next_cursor を cursor に指定して取得する
+@app.get("/results")
+async def get_results(
+    router: Optional[str] = None,
+    site: Optional[str] = None,
+    kind: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 100,
+    cursor: Optional[str] = None
+):
+    filters = {"router": router, "site": site, "kind": kind, "status": status}
+    try:
+        return await result_history.results(filters, since, until, max(1, min(limit, RESULT_PAGE_LIMIT)), cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+# 診断で検出された問題の一覧 (例: site と severity=critical と since で直近の重大な問題)
+@app.get("/results/issues")
+async def get_result_issues(
+    router: Optional[str] = None,
+    site: Optional[str] = None,
+    type: Optional[str] = None,
+    severity: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 100,
+    cursor: Optional[str] = None
+):
+    filters = {"router": router, "site": site, "type": type, "severity": severity}
+    try:
+        return await result_history.issues(filters, since, until, max(1, min(limit, RESULT_PAGE_LIMIT)), cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.get("/results/stats")
+async def get_result_history_stats():
+    return await result_history.stats()
+
+@app.get("/topology")
+async def get_topology_stats():
+    return topology.stats()
+
+@app.get("/topology/resolve/{address}")
+async def resolve_address(address: str):
+    try:
+        resolved = topology.resolve(address)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if resolved is None:
+        raise HTTPException(status_code=404, detail=f"{address} is not in any known subnet")
+    return resolved
+
+@app.get("/topology/path")
+async def get_topology_path(source: str, target: str):
+    try:
+        return topology.path(source, target)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Unknown node: {e.args[0]}")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.get("/topology/reachability")
+async def get_topology_reachability(source: str = CORE):
+    try:
+        return topology.reachability(source)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Unknown node: {e.args[0]}")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.get("/topology/impact")
+async def get_topology_impact(router: str, interface: str, root: str = CORE):
+    # 例: GigabitEthernet1 が落ちた場合に到達できなくなる拠点
+    try:
+        return topology.impact(router, interface, root)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Unknown router, interface or root: {e.args[0]}")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 @app.get("/router/{ip}/acls")
-async def get_acls(ip: str):
+async def get_acls(ip: str, request: Request, session_id: Optional[str] = None):
+    key = response_key(ip, "acls", session_id)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached_response(request, cached)
+    
+    polled = get_polled_state(ip, session_id)
+    if polled is not None:
+        return cached_response(request, response_cache.put(key, polled["acls"]))
+    
+    if ip in device_params:
+        return acls_from_config(config_parser.parse(await run_device_command(ip, "show running-config")))
+    
     if ip not in router_data:
         raise HTTPException(status_code=404, detail=f"Router {ip} not found")
     
     # 現在のシナリオに基づいてデータを取得
-    router_with_scenario = apply_scenario(ip, current_scenario)
+    router_with_scenario = get_effective_view(ip, session_id)
     
-    await asyncio.sleep(0.5)  # シミュレーション遅延
+    await latency.delay("acls")  # シミュレーション遅延
     
-    return router_with_scenario.get("acls", [])
+    return cached_response(request, response_cache.put(key, router_with_scenario.get("acls", [])))
 
-@app.get("/router/{ip}/diagnostics")
-async def run_diagnostics(ip: str):
+@app.post("/router/{ip}/acls/{acl_name}/evaluate")
+async def evaluate_acl(ip: str, acl_name: str, request: FlowBatchRequest, session_id: Optional[str] = None):
     if ip not in router_data:
         raise HTTPException(status_code=404, detail=f"Router {ip} not found")
     
-    await asyncio.sleep(3)  # シミュレーション遅延
+    acls = get_effective_view(ip, session_id).get("acls", [])
+    acl = next((acl for acl in acls if acl["name"] == acl_name), None)
+    if acl is None:
+        raise HTTPException(status_code=404, detail=f"ACL {acl_name} not found on {ip}")
+    
+    # 同じ内容のACLはコンパイル済みのものを再利用する
+    try:
+        compiled = compile_acl(acl_name, acl["entries"])
+    except ACLParseError as e:
+        raise HTTPException(status_code=422, detail=f"ACL {acl_name}: {e}")
     
-    # 現在のシナリオからDiagnostic結果を取得
-    scenario_data = scenarios.get(current_scenario, {})
-    diagnostic_result = scenario_data.get("diagnostic_result", {})
+    results = []
+    for index, flow in enumerate(request.flows):
+        try:
+            results.append(compiled.evaluate(flow.model_dump()))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"Flow {index}: {e}")
     
-    return diagnostic_result
+    return {
+        "acl": acl_name,
+        "total": len(results),
+        "permitted": sum(1 for result in results if result["action"] == "permit"),
+        "results": results
+    }
 
-@app.post("/router/{ip}/execute")
-async def execute_command(ip: str, command_req: CommandRequest):
+@app.get("/router/{ip}/acls/hits")
+async def get_acl_hits(ip: str):
+    if ip not in router_data and ip not in device_params:
+        raise HTTPException(status_code=404, detail=f"Router {ip} not found")
+    return {"router": ip, "acls": acl_hits.get(ip, {})}
+
+@app.get("/router/{ip}/diagnostics")
+async def run_diagnostics(ip: str, session_id: Optional[str] = None):
     if ip not in router_data:
         raise HTTPException(status_code=404, detail=f"Router {ip} not found")
     
-    await asyncio.sleep(1)  # シミュレーション遅延
+    return await diagnose_router(ip, session_id)
+
+async def diagnose_router(ip: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+    await latency.delay("diagnostics")  # シミュレーション遅延
+    result = evaluate_router(ip, session_id)
+    result_history.record(ip, "diagnostics", result, site=get_router_site(ip), status=result["status"],
+                          issues=result["issues"])
+    return result
+
+async def iter_fleet(
+    ips: List[str],
+    job: Callable[[str, Dict[str, Any]], Awaitable[None]],
+    max_concurrency: int,
+    per_site_concurrency: int
+) -> AsyncIterator[Dict[str, Any]]:
+    # 全体とサイトごとのセマフォで同時実行数を制限し、完了順に結果を返す
+    # job はルーターごとの結果 (entry) に result または error を書き込む
+    global_limit = asyncio.Semaphore(max(1, max_concurrency))
+    site_limits: Dict[str, asyncio.Semaphore] = {}
+    started = time.perf_counter()
     
-    command = command_req.command
-    output = ""
+    async def run_one(ip: str) -> Dict[str, Any]:
+        site = get_router_site(ip)
+        site_limit = site_limits.setdefault(site, asyncio.Semaphore(max(1, per_site_concurrency)))
+        queued_at = time.perf_counter()
+        # サイトの枠を先に確保する (全体の枠を持ったまま混雑したサイトを待つと他のサイトが止まる)
+        async with site_limit, global_limit:
+            start = time.perf_counter()
+            entry: Dict[str, Any] = {"type": "result", "ip": ip, "site": site}
+            await job(ip, entry)
+            end = time.perf_counter()
+        entry["timing"] = {
+            "queued": round(start - queued_at, 6),
+            "duration": round(end - start, 6),
+            "finished_at": round(end - started, 6)
+        }
+        return entry
+    
+    tasks = [asyncio.create_task(run_one(ip)) for ip in ips]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def stream_fleet_diagnostics(
+    ips: List[str],
+    max_concurrency: int,
+    per_site_concurrency: int,
+    session_id: Optional[str] = None
+):
+    started = time.perf_counter()
+    
+    async def diagnose(ip: str, entry: Dict[str, Any]):
+        if ip not in router_data:
+            entry["error"] = f"Router {ip} not found"
+            return
+        try:
+            entry["result"] = await diagnose_router(ip, session_id)
+        except Exception as e:
+            entry["error"] = str(e)
+    
+    timings: Dict[str, Dict[str, float]] = {}
+    status_counts: Dict[str, int] = {}
+    async for entry in iter_fleet(ips, diagnose, max_concurrency, per_site_concurrency):
+        timings[entry["ip"]] = entry["timing"]
+        status = entry["result"].get("status", "unknown") if "result" in entry else "failed"
+        status_counts[status] = status_counts.get(status, 0) + 1
+        yield entry
+    
+    yield {
+        "type": "summary",
+        "total": len(ips),
+        "status_counts": status_counts,
+        "wall_time": round(time.perf_counter() - started, 6),
+        "device_time": round(sum(t["duration"] for t in timings.values()), 6),
+        "timings": timings
+    }
+
+@app.post("/diagnostics/bulk")
+async def run_bulk_diagnostics(request: BulkDiagnosticsRequest):
+    ips = select_routers(request.routers, request.selector)
+    if not ips:
+        raise HTTPException(status_code=400, detail="No routers selected")
+    
+    async def ndjson():
+        async for entry in stream_fleet_diagnostics(
+            ips, request.max_concurrency, request.per_site_concurrency, request.session_id
+        ):
+            yield json.dumps(entry, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+# Pingスイープのレート制限 (回/秒) - ルーターごとの上限と全ルーター合計の上限
+SWEEP_ROUTER_RATE = 500.0
+SWEEP_GLOBAL_RATE = 2000.0
+SWEEP_MAX_CONCURRENCY = 256
+sweep_global_limiter = TokenBucket(SWEEP_GLOBAL_RATE)
+sweep_router_limiters: Dict[str, TokenBucket] = {}
+
+async def probe_target(ip: str, target: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+    # スイープの結果は宛先の数だけ系列が増えるため、Pingの履歴には記録しない
+    if ip in device_params:
+        output = await run_device_command(ip, f"ping {target} repeat 1 timeout 1")
+        return ping_result_from_records(get_template("ping").parse(output))
+    scenario_name = scenario_state.resolve(ip, session_id)
+    result = simulate_ping(view_cache.get(ip, scenario_name), fleet.scenario(ip, scenario_name), target, fleet.seed)
+    # 応答の無い宛先はタイムアウトまで待つ
+    await latency.delay("sweep_probe" if result["success"] else "sweep_timeout")
+    return result
+
+def start_sweep(ip: str, targets: List[str], max_concurrency: int, rate: Optional[float] = None,
+                session_id: Optional[str] = None):
+    router_limiter = sweep_router_limiters.get(ip)
+    if router_limiter is None:
+        router_limiter = sweep_router_limiters[ip] = TokenBucket(SWEEP_ROUTER_RATE)
+    limiters = [router_limiter, sweep_global_limiter]
+    if rate is not None and rate > 0:
+        limiters.insert(0, TokenBucket(rate))
+    return sweep(
+        targets,
+        lambda target: probe_target(ip, target, session_id),
+        limiters,
+        max(1, min(max_concurrency, SWEEP_MAX_CONCURRENCY))
+    )
+
+@app.post("/router/{ip}/sweep")
+async def run_sweep(ip: str, request: SweepRequest):
+    if ip not in router_data and ip not in device_params:
+        raise HTTPException(status_code=404, detail=f"Router {ip} not found")
+    try:
+        targets = expand_targets(request.cidr, request.targets)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not targets:
+        raise HTTPException(status_code=400, detail="No targets specified")
+    
+    async def ndjson():
+        async for entry in start_sweep(ip, targets, request.max_concurrency, request.rate, request.session_id):
+            yield json.dumps(entry, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+async def fetch_running_config(ip: str) -> str:
+    if ip in device_params:
+        return await run_device_command(ip, "show running-config")
+    if ip in router_data:
+        return render_running_config(view_cache.get(ip, scenario_state.resolve(ip)))
+    raise HTTPException(status_code=404, detail=f"Router {ip} not found")
+
+@app.get("/router/{ip}/config")
+async def get_running_config(ip: str):
+    output = await fetch_running_config(ip)
+    
+    # 前回と同じ内容であれば解析済みの結果がそのまま返る
+    return config_parser.parse(output)
+
+# ゴールデンコンフィグ (名前 -> コンフィグと除外パターン) - 全ワーカーで共有する
+golden_configs = shared_state.items("golden_configs")
+
+def get_golden(name: str) -> Dict[str, Any]:
+    golden = golden_configs.get(name)
+    if golden is None:
+        raise HTTPException(status_code=404, detail=f"Golden config {name} not found")
+    return golden
+
+@app.get("/config/golden")
+async def list_golden_configs():
+    return {name: {"ignore": golden["ignore"], "updated": golden["updated"],
+                   "blocks": len(drift_engine.snapshot(golden["config"])[1])}
+            for name, golden in golden_configs.items()}
+
+@app.get("/config/golden/{name}")
+async def get_golden_config(name: str):
+    return get_golden(name)
+
+@app.put("/config/golden/{name}")
+async def put_golden_config(name: str, request: GoldenConfigRequest):
+    if (request.config is None) == (request.source is None):
+        raise HTTPException(status_code=400, detail="Specify either config or source")
+    config = request.config if request.config is not None else await fetch_running_config(request.source)
+    golden = {"config": config, "ignore": request.ignore, "updated": time.time()}
+    await shared_state.set("golden_configs", name, golden)
+    return {"name": name, "blocks": len(drift_engine.snapshot(config)[1]), "ignore": request.ignore}
+
+@app.delete("/config/golden/{name}")
+async def delete_golden_config(name: str):
+    get_golden(name)
+    await shared_state.delete("golden_configs", name)
+    return {"name": name, "deleted": True}
+
+@app.get("/router/{ip}/config/drift")
+async def get_config_drift(ip: str, golden: str, strict: bool = False):
+    template = get_golden(golden)
+    config = await fetch_running_config(ip)
+    return {"router": ip, "golden": golden, **drift_engine.compare(config, template["config"], template["ignore"], strict)}
+
+@app.post("/config/drift")
+async def run_fleet_drift(request: DriftRequest):
+    # ゴールデンコンフィグとの比較、または (golden 省略時) フリート内のブロックごとの亜種の集計
+    ips = select_routers(request.routers, request.selector)
+    if not ips:
+        raise HTTPException(status_code=400, detail="No routers selected")
+    template = get_golden(request.golden) if request.golden else None
+    limit = asyncio.Semaphore(max(1, request.max_concurrency))
+    started = time.perf_counter()
+    
+    async def fetch(ip: str) -> Union[str, Exception]:
+        async with limit:
+            try:
+                return await fetch_running_config(ip)
+            except HTTPException as e:
+                return Exception(e.detail)
+            except Exception as e:
+                return e
+    
+    outputs = await asyncio.gather(*(fetch(ip) for ip in ips))
+    configs = {ip: output for ip, output in zip(ips, outputs) if isinstance(output, str)}
+    errors = {ip: str(output) for ip, output in zip(ips, outputs) if not isinstance(output, str)}
+    fetched = time.perf_counter()
+    
+    if template is None:
+        result = drift_engine.compare_fleet(configs, request.ignore)
+    else:
+        ignore = list(template["ignore"]) + request.ignore
+        reports = {ip: drift_engine.compare(config, template["config"], ignore, request.strict)
+                   for ip, config in configs.items()}
+        drifted = {ip: report for ip, report in reports.items() if not report["in_sync"]}
+        result = {"golden": request.golden, "devices": len(reports),
+                  "in_sync": len(reports) - len(drifted), "drifted": drifted}
+    return {
+        **result,
+        "errors": errors,
+        "timing": {
+            "fetch": round(fetched - started, 6),
+            "compare": round(time.perf_counter() - fetched, 6)
+        }
+    }
+
+@app.get("/config/drift/stats")
+async def get_drift_stats():
+    return drift_engine.cache_stats()
+
+def render_command_output(ip: str, command: str) -> str:
+    view = view_cache.get(ip, scenario_state.resolve(ip))
     
     # 簡単なコマンド出力シミュレーション
     if "show version" in command:
-        output = f"""Cisco IOS Software, C800 Software (C800-UNIVERSALK9-M), Version 15.7(3)M2
-ROM: System Bootstrap, Version 15.7(3r)M2
-Router uptime is 10 days, 4 hours, 32 minutes"""
+        return render_show_version(view)
     elif "show ip interface brief" in command:
-        output = """Interface              IP-Address      OK? Method Status                Protocol
-GigabitEthernet0       192.168.1.1     YES NVRAM  up                    up
-GigabitEthernet1       10.0.0.1        YES NVRAM  up                    up
-GigabitEthernet2       172.16.0.1      YES NVRAM  up                    up
-GigabitEthernet3       unassigned      YES NVRAM  administratively down down"""
+        return render_ip_interface_brief(view)
     elif "show run" in command:
-        output = """Building configuration...
-
-Current configuration : 1278 bytes
-!
-version 15.7
-service timestamps debug datetime msec
-service timestamps log datetime msec
-no service password-encryption
-!
-hostname Router
-!
-interface GigabitEthernet0
- ip address 192.168.1.1 255.255.255.0
- duplex full
- speed 1000
-!
-interface GigabitEthernet1
- ip address 10.0.0.1 255.255.255.0
- duplex full
- speed 1000
-!
-interface GigabitEthernet2
- ip address 172.16.0.1 255.255.255.0
- duplex full
- speed 1000
-!
-interface GigabitEthernet3
- no ip address
- shutdown
-!
-ip access-list extended ALLOW_WEB
- permit tcp any any eq 80
- permit tcp any any eq 443
-!
-ip access-list extended BLOCK_TELNET
- deny tcp any any eq 23
- permit ip any any
-!
-end"""
-    else:
-        output = f"Command executed: {command}"
+        return render_running_config(view)
+    return f"Command executed: {command}"
+
+@app.post("/router/{ip}/execute")
+async def execute_command(ip: str, command_req: CommandRequest):
+    if ip in device_params:
+        output = await run_device_command(ip, command_req.command)
+        result_history.record(ip, "execute", {"output": output}, target=command_req.command)
+        return {"output": output}
+    
+    if ip not in router_data:
+        raise HTTPException(status_code=404, detail=f"Router {ip} not found")
     
+    await latency.delay("execute")  # シミュレーション遅延
+    
+    command = command_req.command
+    output = render_command_output(ip, command)
+    result_history.record(ip, "execute", {"output": output}, site=get_router_site(ip), target=command)
     return {"output": output}
 
+# 1回のバッチで実行できるコマンド数の上限
+MAX_BATCH_COMMANDS = 100
+
+def validate_commands(commands: List[str]):
+    if not commands:
+        raise HTTPException(status_code=400, detail="No commands specified")
+    if len(commands) > MAX_BATCH_COMMANDS:
+        raise HTTPException(status_code=400, detail=f"Too many commands: {len(commands)} (limit {MAX_BATCH_COMMANDS})")
+
+async def iter_command_outputs(ip: str, commands: List[str]) -> AsyncIterator[Tuple[str, str]]:
+    # 1台に対してコマンドを順に実行し、完了したものから (コマンド, 出力) を返す
+    # 実機は1つのセッションを確保したまま続けて実行し、コマンドごとの接続・認証を省く
+    if ip in device_params:
+        async for command, output in session_pool.run_batch(device_params[ip], commands):
+            result_history.record(ip, "execute", {"output": output}, target=command)
+            yield command, output
+        return
+    if ip not in router_data:
+        raise HTTPException(status_code=404, detail=f"Router {ip} not found")
+    await latency.delay("execute")  # シミュレーション遅延 (セッションの確立と最初のコマンド)
+    site = get_router_site(ip)
+    for index, command in enumerate(commands):
+        if index:
+            await latency.delay("execute_pipelined")
+        output = render_command_output(ip, command)
+        result_history.record(ip, "execute", {"output": output}, site=site, target=command)
+        yield command, output
+
+def command_error(e: Exception) -> str:
+    if isinstance(e, HTTPException):
+        return str(e.detail)
+    return str(e) or type(e).__name__
+
+@app.post("/router/{ip}/execute/batch")
+async def execute_batch(ip: str, request: BatchCommandRequest):
+    # コマンドごとの出力を完了順 (= 指定順) にNDJSONで返す - 失敗した場合は以降のコマンドを実行しない
+    if ip not in device_params and ip not in router_data:
+        raise HTTPException(status_code=404, detail=f"Router {ip} not found")
+    validate_commands(request.commands)
+    
+    async def ndjson():
+        started = time.perf_counter()
+        last = started
+        completed = 0
+        error = None
+        try:
+            async for command, output in iter_command_outputs(ip, request.commands):
+                now = time.perf_counter()
+                yield json.dumps({"type": "result", "index": completed, "command": command, "output": output,
+                                  "duration": round(now - last, 6)}, ensure_ascii=False) + "\n"
+                last = now
+                completed += 1
+        except (TransportError, HTTPException) as e:
+            error = command_error(e)
+            yield json.dumps({"type": "error", "index": completed, "command": request.commands[completed],
+                              "error": error}, ensure_ascii=False) + "\n"
+        yield json.dumps({"type": "summary", "total": len(request.commands), "completed": completed,
+                          "error": error, "wall_time": round(time.perf_counter() - started, 6)}) + "\n"
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@app.post("/execute/fanout")
+async def execute_fanout(request: FanoutCommandRequest):
+    # 同じコマンド群を複数のルーターで実行し、ルーターごとの結果を完了順にNDJSONで返す
+    ips = select_routers(request.routers, request.selector)
+    if not ips:
+        raise HTTPException(status_code=400, detail="No routers selected")
+    validate_commands(request.commands)
+    
+    async def run(ip: str, entry: Dict[str, Any]):
+        results: List[Dict[str, str]] = []
+        entry["results"] = results
+        
+        async def collect():
+            async for command, output in iter_command_outputs(ip, request.commands):
+                results.append({"command": command, "output": output})
+        
+        try:
+            await asyncio.wait_for(collect(), request.timeout)
+        except asyncio.TimeoutError:
+            entry["error"] = f"Timed out after {request.timeout}s"
+            entry["timed_out"] = True
+        except Exception as e:
+            entry["error"] = command_error(e)
+    
+    async def ndjson():
+        started = time.perf_counter()
+        succeeded = failed = timed_out = 0
+        device_time = 0.0
+        async for entry in iter_fleet(ips, run, request.max_concurrency, request.per_site_concurrency):
+            if "error" not in entry:
+                succeeded += 1
+            elif entry.get("timed_out"):
+                timed_out += 1
+            else:
+                failed += 1
+            device_time += entry["timing"]["duration"]
+            yield json.dumps(entry, ensure_ascii=False) + "\n"
+        yield json.dumps({
+            "type": "summary",
+            "total": len(ips),
+            "commands": len(request.commands),
+            "succeeded": succeeded,
+            "failed": failed,
+            "timed_out": timed_out,
+            "wall_time": round(time.perf_counter() - started, 6),
+            "device_time": round(device_time, 6)
+        }) + "\n"
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+# WebSocketコマンド実行
+# 1クライアントあたりの同時実行コマンド数の上限
+MAX_CONCURRENT_COMMANDS = 8
+
+async def run_ping_command(client_id: str, request_id: str, target: str):
+    await manager.send_json({
+        "type": "command_start",
+        "request_id": request_id,
+        "command": f"ping {target}"
+    }, client_id)
+    
+    # 現在のシナリオからPing結果を取得
+    scenario_data = get_scenario_data(session_id=client_id)
+    ping_results = scenario_data.get("ping_results", {})
+    result = ping_results.get(target, {"success": True, "packet_loss": 0})
+    
+    # Ping進行状況をシミュレート
+    for i in range(5):
+        await manager.send_json({
+            "type": "ping_progress",
+            "request_id": request_id,
+            "sequence": i + 1,
+            "success": result["success"]
+        }, client_id)
+        await latency.delay("ping_probe")
+    
+    await manager.send_json({
+        "type": "command_result",
+        "request_id": request_id,
+        "command": "ping",
+        "result": result
+    }, client_id)
+
+async def run_bulk_diagnostics_command(client_id: str, request_id: str, ips: List[str],
+                                       max_concurrency: int, per_site_concurrency: int):
+    await manager.send_json({
+        "type": "command_start",
+        "request_id": request_id,
+        "command": f"diagnostics ({len(ips)} routers)"
+    }, client_id)
+    
+    async for entry in stream_fleet_diagnostics(ips, max_concurrency, per_site_concurrency, client_id):
+        frame_type = "diagnostics_progress" if entry["type"] == "result" else "command_result"
+        await manager.send_json({
+            **entry,
+            "type": frame_type,
+            "request_id": request_id,
+            "command": "bulk_diagnostics"
+        }, client_id)
+
+async def run_sweep_command(client_id: str, request_id: str, ip: str, targets: List[str],
+                            max_concurrency: int, rate: Optional[float]):
+    await manager.send_json({
+        "type": "command_start",
+        "request_id": request_id,
+        "command": f"sweep ({len(targets)} targets via {ip})"
+    }, client_id)
+    
+    async for entry in start_sweep(ip, targets, max_concurrency, rate, client_id):
+        frame_type = "sweep_progress" if entry["type"] == "result" else "command_result"
+        await manager.send_json({
+            **entry,
+            "type": frame_type,
+            "request_id": request_id,
+            "command": "sweep"
+        }, client_id)
+
+async def run_traceroute_command(client_id: str, request_id: str, target: str):
+    await manager.send_json({
+        "type": "command_start",
+        "request_id": request_id,
+        "command": f"traceroute {target}"
+    }, client_id)
+    
+    # 現在のシナリオからTraceroute結果を取得
+    scenario_data = get_scenario_data(session_id=client_id)
+    traceroute_results = scenario_data.get("traceroute_results", {})
+    hops = traceroute_results.get(target, [])
+    
+    # Traceroute進行状況をシミュレート
+    for hop in hops:
+        await manager.send_json({
+            "type": "traceroute_progress",
+            "request_id": request_id,
+            "hop": hop
+        }, client_id)
+        await latency.delay("traceroute_hop")
+    
+    await manager.send_json({
+        "type": "command_result",
+        "request_id": request_id,
+        "command": "traceroute",
+        "result": hops
+    }, client_id)
+
+async def run_subscribe_command(client_id: str, ip: str, interfaces: Optional[List[str]]):
+    if not state_feed.has_state(ip):
+        polled = get_polled_state(ip)
+        state = polled if polled is not None else await collect_router_state(ip)
+        # 取得中に他の購読やポーリングで状態が入った場合はそちらを使う
+        if not state_feed.has_state(ip):
+            state_feed.publish(ip, state)
+    await manager.send_json(state_feed.subscribe(client_id, ip, interfaces), client_id)
+
+class CommandTracker:
+    # クライアントごとに実行中のコマンドをrequest_idで管理する
+    def __init__(self, client_id: str, max_concurrent: int = MAX_CONCURRENT_COMMANDS):
+        self.client_id = client_id
+        self.max_concurrent = max_concurrent
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    async def start(self, request_id: str, coro):
+        if request_id in self.tasks:
+            coro.close()
+            await manager.send_json({
+                "type": "error",
+                "request_id": request_id,
+                "message": f"Request {request_id} is already running"
+            }, self.client_id)
+            return
+        if len(self.tasks) >= self.max_concurrent:
+            coro.close()
+            await manager.send_json({
+                "type": "error",
+                "request_id": request_id,
+                "message": f"Too many concurrent commands (limit {self.max_concurrent})"
+            }, self.client_id)
+            return
+        task = asyncio.create_task(self._run(request_id, coro))
+        self.tasks[request_id] = task
+
+    async def _run(self, request_id: str, coro):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            await manager.send_json({
+                "type": "command_cancelled",
+                "request_id": request_id
+            }, self.client_id)
+            raise
+        except Exception as e:
+            logger.error(f"Command {request_id} for client {self.client_id} failed: {e}")
+            await manager.send_json({
+                "type": "error",
+                "request_id": request_id,
+                "message": str(e)
+            }, self.client_id)
+        finally:
+            self.tasks.pop(request_id, None)
+
+    def cancel(self, request_id: str) -> bool:
+        task = self.tasks.get(request_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    def cancel_all(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
     await manager.connect(websocket, client_id)
+    tracker = CommandTracker(client_id)
     try:
+        codec = manager.channels[client_id].codec
         while True:
-            data = await websocket.receive_text()
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            # バイナリ形式のクライアントもJSONのテキストフレームでコマンドを送れる
+            data = frame.get("text")
+            request_id = None
             try:
-                message = json.loads(data)
-                command = message.get("command")
+                if data is None:
+                    message = codec.decode(frame.get("bytes") or b"")
+                else:
+                    message = json.loads(data)
+                if not isinstance(message, dict):
+                    raise ValueError("Command must be an object")
+                if message.get("request_id") is not None:
+                    request_id = str(message["request_id"])
+                message = WebSocketCommand.model_validate(message)
+                command = message.command
+                request_id = request_id or uuid.uuid4().hex
                 
                 if command == "ping":
-                    # Pingコマンドのシミュレーション
-                    target = message.get("target", "10.0.0.2")
-                    
-                    await manager.send_json({
-                        "type": "command_start",
-                        "command": f"ping {target}"
-                    }, client_id)
-                    
-                    # 現在のシナリオからPing結果を取得
-                    scenario_data = scenarios.get(current_scenario, {})
-                    ping_results = scenario_data.get("ping_results", {})
-                    result = ping_results.get(target, {"success": True, "packet_loss": 0})
-                    
-                    # Ping進行状況をシミュレート
-                    for i in range(5):
-                        if result["success"]:
-                            await manager.send_json({
-                                "type": "ping_progress",
-                                "sequence": i + 1,
-                                "success": True
-                            }, client_id)
-                        else:
-                            await manager.send_json({
-                                "type": "ping_progress",
-                                "sequence": i + 1,
-                                "success": False
-                            }, client_id)
-                        await asyncio.sleep(0.3)
-                    
-                    await manager.send_json({
-                        "type": "command_result",
-                        "command": "ping",
-                        "result": result
-                    }, client_id)
+                    # Pingコマンドは独立したタスクとして実行する
+                    target = message.target or "10.0.0.2"
+                    await tracker.start(request_id, run_ping_command(client_id, request_id, target))
                 
                 elif command == "traceroute":
-                    # Tracerouteコマンドのシミュレーション
-                    target = message.get("target", "10.0.0.2")
-                    
-                    await manager.send_json({
-                        "type": "command_start",
-                        "command": f"traceroute {target}"
-                    }, client_id)
-                    
-                    # 現在のシナリオからTraceroute結果を取得
-                    scenario_data = scenarios.get(current_scenario, {})
-                    traceroute_results = scenario_data.get("traceroute_results", {})
-                    hops = traceroute_results.get(target, [])
-                    
-                    # Traceroute進行状況をシミュレート
-                    for hop in hops:
+                    # Tracerouteコマンドは独立したタスクとして実行する
+                    target = message.target or "10.0.0.2"
+                    await tracker.start(request_id, run_traceroute_command(client_id, request_id, target))
+                
+                elif command == "bulk_diagnostics":
+                    # 複数ルーターの診断を並行実行し、完了順に結果を送信する
+                    ips = select_routers(message.routers or [], message.selector)
+                    await tracker.start(request_id, run_bulk_diagnostics_command(
+                        client_id, request_id, ips,
+                        message.max_concurrency or 200,
+                        message.per_site_concurrency or 20
+                    ))
+                
+                elif command == "sweep":
+                    # ルーター配下のサブネット (または宛先の一覧) にPingを並行して送る
+                    ip = message.router
+                    if ip not in router_data and ip not in device_params:
+                        await manager.send_json({
+                            "type": "error",
+                            "request_id": request_id,
+                            "message": f"Router {ip} not found"
+                        }, client_id)
+                        continue
+                    try:
+                        targets = expand_targets(message.cidr, message.targets or [])
+                    except ValueError as e:
                         await manager.send_json({
-                            "type": "traceroute_progress",
-                            "hop": hop
+                            "type": "error",
+                            "request_id": request_id,
+                            "message": str(e)
                         }, client_id)
-                        await asyncio.sleep(0.5)
-                    
+                        continue
+                    await tracker.start(request_id, run_sweep_command(
+                        client_id, request_id, ip, targets,
+                        message.max_concurrency or SWEEP_MAX_CONCURRENCY,
+                        message.rate
+                    ))
+                
+                elif command == "cancel":
+                    # 実行中のコマンドを取り消す
+                    if not tracker.cancel(request_id):
+                        await manager.send_json({
+                            "type": "error",
+                            "request_id": request_id,
+                            "message": f"No running command with request_id {request_id}"
+                        }, client_id)
+                
+                elif command == "subscribe":
+                    # ルーター (またはその一部のインターフェース) の状態変化を購読する
+                    ip = message.router
+                    if ip not in router_data and ip not in device_params:
+                        await manager.send_json({
+                            "type": "error",
+                            "message": f"Router {ip} not found"
+                        }, client_id)
+                        continue
+                    # 初回の状態取得は受信ループを止めないよう独立したタスクで行う
+                    await tracker.start(request_id, run_subscribe_command(client_id, ip, message.interfaces))
+                
+                elif command == "unsubscribe":
+                    state_feed.unsubscribe(client_id, message.router)
                     await manager.send_json({
-                        "type": "command_result",
-                        "command": "traceroute",
-                        "result": hops
+                        "type": "unsubscribed",
+                        "router": message.router
                     }, client_id)
                 
+                elif command == "resync":
+                    # クライアントが連番の欠落を検出した場合の再同期
+                    frame = state_feed.resync(client_id, message.router, message.since or 0)
+                    if frame is None:
+                        await manager.send_json({
+                            "type": "error",
+                            "message": f"Not subscribed to {message.router}"
+                        }, client_id)
+                    else:
+                        await manager.send_json(frame, client_id)
+                
                 elif command == "set_scenario":
-                    # シナリオ変更
-                    scenario_name = message.get("scenario")
+                    # シナリオ変更 - このクライアントのセッションにのみ適用する
+                    scenario_name = message.scenario
                     if scenario_name in scenarios:
-                        global current_scenario
-                        current_scenario = scenario_name
+                        await scenario_state.set_for_session(client_id, scenario_name)
                         await manager.send_json({
                             "type": "scenario_changed",
                             "scenario": scenario_name
@@ -623,10 +2237,73 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             
             except json.JSONDecodeError:
                 await manager.send_personal_message(f"Invalid JSON: {data}", client_id)
+            except ValidationError as e:
+                # 型の合わない値はその項目名とともにエラーとして返す
+                problems = "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+                                     for error in e.errors())
+                await manager.send_json({
+                    "type": "error",
+                    "request_id": request_id,
+                    "message": f"Invalid message: {problems}"
+                }, client_id)
+            except ValueError as e:
+                await manager.send_json({
+                    "type": "error",
+                    "request_id": request_id,
+                    "message": f"Invalid message: {e}"
+                }, client_id)
+            except Exception as e:
+                # 1つのコマンドの失敗で接続を切らない
+                logger.error(f"Command from client {client_id} failed: {e}")
+                await manager.send_json({
+                    "type": "error",
+                    "request_id": request_id,
+                    "message": str(e)
+                }, client_id)
     
     except WebSocketDisconnect:
+        pass
+    finally:
+        tracker.cancel_all()
+        state_feed.unsubscribe(client_id)
         manager.disconnect(client_id)
+        await scenario_state.clear_session(client_id)
+
+@app.on_event("startup")
+async def startup():
+    await shared_state.start()
+    session_store.start()
+    await result_history.start()
+    # 起動前に他のワーカーが接続したデバイス
+    for ip, params in list(shared_state.items("devices").items()):
+        on_device_changed(ip, params)
+    build_topology()
+    for ip in router_data:
+        poller.register(ip)
+    poller.start()
+    history_store.start()
+    if INGEST_SYSLOG_PORT or INGEST_TRAP_PORT:
+        try:
+            await event_ingestor.start(INGEST_HOST, INGEST_SYSLOG_PORT, INGEST_TRAP_PORT)
+        except OSError as e:
+            # 複数ワーカーの場合は最初に起動したワーカーだけが待ち受ける
+            logger.warning(f"Event ingestion not started: {e}")
+    if PROFILE_SLOW_MS:
+        profiler.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await event_ingestor.close()
+    await poller.close()
+    await history_store.close()
+    await session_pool.close()
+    profiler.stop()
+    await session_store.stop()
+    await result_history.close()
+    await shared_state.delete("workers", shared_state.worker_id)
+    await shared_state.close()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # permessage-deflate はクライアントが申し出た場合に有効になる
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_per_message_deflate=True)
\ No newline at end of file
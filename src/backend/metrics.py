@@ -0,0 +1,297 @@
+# Prometheus形式のメトリクスと低速リクエストのサンプリングプロファイラー
+# 値の更新はすべてイベントループ上で行うため、ロックを使わず整数の加算だけで済ませる
+# 接続数やキャッシュ件数などの現在値はスクレイプ時にコレクターから読み取る
+
+import bisect
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+# コレクターが返すメトリクス: (名前, 種類, 説明, [(ラベル, 値)])
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+# 秒単位のレイテンシー用バケット (1ms - 10s)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+    return repr(value)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self, lines: List[str]):
+        super().render(lines)
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        # 各バケットには累積ではなく区間ごとの件数を持ち、書き出し時に累積する
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelValues, _HistogramValue] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = _HistogramValue(len(self.buckets) + 1)
+            self._values[labels] = entry
+        # 上限が value 以上の最初のバケット (最後の要素は +Inf)
+        entry.counts[bisect.bisect_left(self.buckets, value)] += 1
+        entry.sum += value
+        entry.count += 1
+
+    def render(self, lines: List[str]):
+        super().render(lines)
+        names = (*self.labelnames, "le")
+        for labels, entry in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), entry.counts):
+                cumulative += count
+                bucket_labels = _format_labels(names, (*labels, _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {_format_value(entry.sum)}")
+            lines.append(f"{self.name}_count{suffix} {entry.count}")
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        # ミドルウェアの再構築などで同じ名前が再登録された場合は既存のものを返す
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = cls(name, *args, **kwargs)
+            self._metrics[name] = metric
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def register_collector(self, collector: Callable[[], Iterable[Family]]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            metric.render(lines)
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                # 1つのコレクターの失敗でスクレイプ全体を失敗させない
+                logger.error(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+        lines.append("")
+        return "\n".join(lines)
+
+def _fold_stack(frame, max_depth: int = 128) -> str:
+    # flamegraph.pl / speedscope が読める折りたたみ形式 (根元から末端へ ";" 区切り)
+    names = []
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class SlowRequestProfiler:
+    # 有効化するとイベントループのスレッドのスタックを別スレッドから一定間隔で採取し、
+    # 閾値より遅かったリクエストの実行中に採取したサンプルだけを集計する
+    # コルーチンは同じスレッドで交互に動くため、サンプルは「遅いリクエストの間ループが何をしていたか」を表す
+    def __init__(self, interval: float = 0.005, threshold: float = 0.5,
+                 max_samples: int = 20000, max_stacks: int = 5000):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_stacks = max_stacks
+        self._samples: Deque[Tuple[float, str]] = deque(maxlen=max_samples)
+        self._stacks: Dict[str, int] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._loop_thread: Optional[int] = None
+        self.slow_requests = 0
+        self.dropped_stacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: Optional[float] = None, threshold: Optional[float] = None):
+        # イベントループのスレッドから呼び出すこと (呼び出し元のスレッドを採取対象にする)
+        if interval is not None:
+            self.interval = interval
+        if threshold is not None:
+            self.threshold = threshold
+        if self._thread is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name="slow-request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._samples.clear()
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._samples.append((time.monotonic(), _fold_stack(frame)))
+            del frame
+
+    def request_finished(self, started: float, route: str):
+        # started は time.monotonic() で取得した開始時刻
+        if self._thread is None or time.monotonic() - started < self.threshold:
+            return
+        self.slow_requests += 1
+        # list() でコピーしてから走査する (採取スレッドが並行して追加するため)
+        for sampled_at, stack in reversed(list(self._samples)):
+            if sampled_at < started:
+                break
+            key = f"{route};{stack}"
+            if key in self._stacks:
+                self._stacks[key] += 1
+            elif len(self._stacks) < self.max_stacks:
+                self._stacks[key] = 1
+            else:
+                self.dropped_stacks += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self._stacks.items()))
+
+    def reset(self):
+        self._stacks.clear()
+        self.slow_requests = 0
+        self.dropped_stacks = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "interval_ms": round(self.interval * 1000, 3),
+            "threshold_ms": round(self.threshold * 1000, 3),
+            "samples": len(self._samples),
+            "stacks": len(self._stacks),
+            "slow_requests": self.slow_requests,
+            "dropped_stacks": self.dropped_stacks,
+        }
+
+class MetricsMiddleware:
+    # ルートごとのレイテンシーと処理中のリクエスト数を記録するASGIミドルウェア
+    # ラベルにはパスではなくルートのテンプレート (/router/{ip}/info) を使い、系列数を抑える
+    def __init__(self, app, registry: MetricsRegistry, profiler: Optional[SlowRequestProfiler] = None):
+        self.app = app
+        self.profiler = profiler
+        self.requests = registry.counter(
+            "http_requests_total", "HTTP requests by route, method and status", ("method", "route", "status"))
+        self.latency = registry.histogram(
+            "http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+        self.in_flight = registry.gauge("http_requests_in_flight", "HTTP requests currently being processed")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        started = time.monotonic()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # ストリーミングレスポンスは本文を送り終えるまでを計測する
+            elapsed = time.monotonic() - started
+            self.in_flight.dec()
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            self.requests.inc(method, route, str(status))
+            self.latency.observe(elapsed, method, route)
+            if self.profiler is not None:
+                self.profiler.request_finished(started, route)
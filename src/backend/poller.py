@@ -0,0 +1,222 @@
+# ルーター状態の定期収集スケジューラー
+# 全ルーターを一定間隔でポーリングし、APIの読み取りは最新の収集結果から返す
+# 開始時刻をジッターで分散させ、全体の同時実行数を制限し、デバイスごとに間隔を調整する
+
+import asyncio
+import heapq
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Collector = Callable[[str], Awaitable[Dict[str, Any]]]
+UpdateHandler = Callable[[str, Dict[str, Any]], Awaitable[None]]
+# (ip, 所要時間, 成功したか) - メトリクスの記録用
+PollObserver = Callable[[str, float, bool], None]
+
+class PollTarget:
+    def __init__(self, ip: str, interval: float):
+        self.ip = ip
+        self.interval = interval
+        self.due = 0.0
+        self.in_flight = False
+        self.repoll = False
+        self.polls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.changes = 0
+        self.last_duration: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+class PollState:
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self.collected_at = time.time()
+
+class PollingScheduler:
+    def __init__(
+        self,
+        collect: Collector,
+        interval: float = 30.0,
+        min_interval: float = 5.0,
+        max_interval: float = 300.0,
+        max_concurrency: int = 50,
+        timeout: float = 10.0,
+        jitter: float = 0.2,
+        on_update: Optional[UpdateHandler] = None,
+        on_poll: Optional[PollObserver] = None,
+    ):
+        self.collect = collect
+        self.on_update = on_update
+        self.on_poll = on_poll
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.jitter = jitter
+        self.targets: Dict[str, PollTarget] = {}
+        self.states: Dict[str, PollState] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._sequence = 0
+        self._wakeup = asyncio.Event()
+        self._budget: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._polls: set = set()
+
+    def _schedule(self, target: PollTarget, due: float):
+        target.due = due
+        self._sequence += 1
+        heapq.heappush(self._heap, (due, self._sequence, target.ip))
+        self._wakeup.set()
+
+    def _next_delay(self, interval: float) -> float:
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def register(self, ip: str):
+        if ip in self.targets:
+            return
+        target = PollTarget(ip, self.interval)
+        self.targets[ip] = target
+        # 初回の開始時刻を1周期内に分散させ、登録直後の一斉ポーリングを避ける
+        self._schedule(target, time.monotonic() + random.uniform(0, self.interval))
+
+    def unregister(self, ip: str):
+        # ヒープ上の古いエントリはスケジューラーが読み飛ばす
+        self.targets.pop(ip, None)
+        self.states.pop(ip, None)
+
+    def poll_soon(self, ip: str):
+        # 状態が変わったことが分かっている場合は次の周期を待たずに収集する
+        target = self.targets.get(ip)
+        if target is None:
+            return
+        if target.in_flight:
+            target.repoll = True
+        else:
+            self._schedule(target, time.monotonic())
+
+    def set_state(self, ip: str, data: Dict[str, Any]):
+        # syslogやSNMPトラップで分かった状態を次のポーリングを待たずに反映する
+        if ip in self.targets:
+            self.states[ip] = PollState(data)
+
+    def latest(self, ip: str) -> Optional[PollState]:
+        return self.states.get(ip)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._budget = asyncio.Semaphore(self.max_concurrency)
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, _, ip = self._heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            target = self.targets.get(ip)
+            # 登録解除や再スケジュールで無効になったエントリは読み飛ばす
+            if target is None or target.due != due or target.in_flight:
+                continue
+            # 全体の同時実行数の上限に達している間は次のポーリングを開始しない
+            await self._budget.acquire()
+            # 待っている間に登録解除・再登録・再スケジュールされていれば、枠を返して読み飛ばす
+            if self.targets.get(ip) is not target or target.due != due or target.in_flight:
+                self._budget.release()
+                continue
+            target.in_flight = True
+            task = asyncio.create_task(self._poll(target))
+            self._polls.add(task)
+            task.add_done_callback(self._polls.discard)
+
+    async def _poll(self, target: PollTarget):
+        started = time.monotonic()
+        succeeded = False
+        try:
+            data = await asyncio.wait_for(self.collect(target.ip), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            target.failures += 1
+            target.consecutive_failures += 1
+            target.last_error = str(e) or type(e).__name__
+            # 応答しないデバイスは間隔を広げて負荷を下げる
+            target.interval = min(self.max_interval, max(target.interval, self.interval) * 2)
+            logger.warning(f"Polling {target.ip} failed ({target.last_error}), next in {target.interval:.0f}s")
+        else:
+            previous = self.states.get(target.ip)
+            changed = previous is not None and previous.data != data
+            if target.ip in self.targets:
+                self.states[target.ip] = PollState(data)
+                if self.on_update is not None:
+                    try:
+                        await self.on_update(target.ip, data)
+                    except Exception as e:
+                        logger.error(f"State update handler failed for {target.ip}: {e}")
+            succeeded = True
+            target.consecutive_failures = 0
+            target.last_error = None
+            if changed:
+                # 状態が変化し続けるデバイスは間隔を縮めて追従する
+                target.changes += 1
+                target.interval = max(self.min_interval, min(target.interval, self.interval) / 2)
+            elif target.interval < self.interval:
+                target.interval = min(self.interval, target.interval * 2)
+            else:
+                target.interval = self.interval
+        finally:
+            target.polls += 1
+            target.last_duration = time.monotonic() - started
+            target.in_flight = False
+            self._budget.release()
+            if self.on_poll is not None:
+                self.on_poll(target.ip, target.last_duration, succeeded)
+        if self.targets.get(target.ip) is target:
+            if target.repoll:
+                target.repoll = False
+                self._schedule(target, time.monotonic())
+            else:
+                self._schedule(target, time.monotonic() + self._next_delay(target.interval))
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "targets": len(self.targets),
+            "in_flight": sum(1 for target in self.targets.values() if target.in_flight),
+            "max_concurrency": self.max_concurrency,
+            "devices": {
+                ip: {
+                    "interval": round(target.interval, 1),
+                    "polls": target.polls,
+                    "failures": target.failures,
+                    "changes": target.changes,
+                    "last_duration": target.last_duration,
+                    "last_error": target.last_error,
+                    "age": round(now - self.states[ip].collected_at, 1) if ip in self.states else None,
+                }
+                for ip, target in self.targets.items()
+            },
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._polls):
+            task.cancel()
+        await asyncio.gather(*self._polls, return_exceptions=True)
+        self._polls.clear()
@@ -0,0 +1,104 @@
+# 読み取りAPIのレスポンスキャッシュ
+# シリアライズ済みのJSONとETagを (ルーター, リソース, 状態のバージョン) ごとに保持し、
+# If-None-Matchが一致すれば本文を作らずに304を返す
+
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+class CachedResponse:
+    __slots__ = ("body", "etag")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        # 本文のハッシュを強いETagとして使う
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            # If-None-Matchの比較は弱い比較で行う
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == self.etag:
+                return True
+        return False
+
+def serialize(payload: Any) -> bytes:
+    # FastAPIのJSONResponseと同じ形式でエンコードする
+    return json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 4096, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # キーの先頭要素はルーターのIP (ルーター単位の無効化に使う)
+        self._entries: "OrderedDict[Tuple[Hashable, ...], CachedResponse]" = OrderedDict()
+        self._by_router: Dict[Hashable, Set[Tuple[Hashable, ...]]] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Tuple[Hashable, ...], payload: Any) -> CachedResponse:
+        entry = CachedResponse(serialize(payload))
+        self._remove(key)
+        self._entries[key] = entry
+        self._by_router.setdefault(key[0], set()).add(key)
+        self._bytes += len(entry.body)
+        # 件数とバイト数の両方の上限を超えないよう、最も古く使われたものから捨てる
+        while len(self._entries) > self.max_entries or (self._bytes > self.max_bytes and len(self._entries) > 1):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return entry
+
+    def _remove(self, key: Tuple[Hashable, ...]) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= len(entry.body)
+        keys = self._by_router[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._by_router[key[0]]
+        return True
+
+    def invalidate(self, router: Optional[str] = None):
+        if router is None:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._by_router.clear()
+            self._bytes = 0
+            return
+        for key in list(self._by_router.get(router, ())):
+            self._remove(key)
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
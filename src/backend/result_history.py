@@ -0,0 +1,269 @@
+# 診断・Ping・Traceroute・コマンド実行の結果履歴
+# APIの処理ではメモリ上のキューに積むだけにし、別スレッドでまとめてSQLite (WALモード) に書き込む
+# 一覧は (時刻, ID) のキーセットで改ページし、保存期間と最大件数を超えた古い行は少しずつ削除する
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS results ("
+    " id INTEGER PRIMARY KEY, ts REAL NOT NULL, router TEXT NOT NULL, site TEXT, kind TEXT NOT NULL,"
+    " target TEXT, status TEXT, payload TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS issues ("
+    " id INTEGER PRIMARY KEY, result_id INTEGER NOT NULL, ts REAL NOT NULL, router TEXT NOT NULL, site TEXT,"
+    " type TEXT NOT NULL, severity TEXT NOT NULL, description TEXT)",
+    # 一覧の並び順 (ts DESC, id DESC) と各絞り込み条件に合わせた索引
+    "CREATE INDEX IF NOT EXISTS results_router_ts ON results (router, ts, id)",
+    "CREATE INDEX IF NOT EXISTS results_site_ts ON results (site, ts, id)",
+    "CREATE INDEX IF NOT EXISTS results_kind_ts ON results (kind, ts, id)",
+    "CREATE INDEX IF NOT EXISTS results_ts ON results (ts, id)",
+    "CREATE INDEX IF NOT EXISTS issues_site_severity_ts ON issues (site, severity, ts, id)",
+    "CREATE INDEX IF NOT EXISTS issues_router_ts ON issues (router, ts, id)",
+    "CREATE INDEX IF NOT EXISTS issues_type_ts ON issues (type, ts, id)",
+    "CREATE INDEX IF NOT EXISTS issues_severity_ts ON issues (severity, ts, id)",
+    "CREATE INDEX IF NOT EXISTS issues_ts ON issues (ts, id)",
+    "CREATE INDEX IF NOT EXISTS issues_result ON issues (result_id)",
+)
+
+# 絞り込みに使える列
+RESULT_FILTERS = ("router", "site", "kind", "status")
+ISSUE_FILTERS = ("router", "site", "type", "severity")
+
+def encode_cursor(ts: float, row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([ts, row_id]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        ts, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(ts), int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+class ResultHistory:
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 500,
+        flush_interval: float = 0.5,
+        max_queue: int = 100000,
+        retention_days: float = 30.0,
+        max_rows: int = 2000000,
+        compact_interval: float = 300.0,
+        max_payload: int = 65536,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.retention_days = retention_days
+        self.max_rows = max_rows
+        self.compact_interval = compact_interval
+        self.max_payload = max_payload
+        self._queue: Deque[tuple] = deque()
+        self._wakeup = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-history")
+        self._db: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.deleted = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _open(self):
+        db = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        # auto_vacuum は表を作る前に設定する必要がある (既存のファイルでは変わらない)
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            db.execute(statement)
+        self._db = db
+
+    async def start(self):
+        if self._db is None:
+            await self._run(self._open)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._writer())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._db is not None:
+            # 残っている結果を書き出してから閉じる
+            await self._flush_all()
+            await self._run(self._db.close)
+            self._db = None
+
+    # 記録 - リクエストの処理中に呼ばれるため、キューに積むだけで待たない
+    def record(self, router: str, kind: str, payload: Any, site: Optional[str] = None,
+               target: Optional[str] = None, status: Optional[str] = None,
+               issues: Optional[List[Dict[str, Any]]] = None):
+        if len(self._queue) >= self.max_queue:
+            # 書き込みが追いつかない場合は最も古い結果を捨てる
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append((time.time(), router, site, kind, target, status, payload, issues or []))
+        self.recorded += 1
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _writer(self):
+        last_compact = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._flush_all()
+                if time.monotonic() - last_compact >= self.compact_interval:
+                    last_compact = time.monotonic()
+                    self.deleted += await self._run(self._compact)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Writing result history failed: {e}")
+
+    async def _flush_all(self):
+        while self._queue:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            await self._run(self._write_batch, batch)
+            self.written += len(batch)
+            self.batches += 1
+
+    def _encode(self, payload: Any) -> str:
+        encoded = json.dumps(payload, ensure_ascii=False, default=str)
+        if len(encoded) > self.max_payload:
+            encoded = json.dumps({"truncated": True, "preview": encoded[:self.max_payload]}, ensure_ascii=False)
+        return encoded
+
+    def _write_batch(self, batch: List[tuple]):
+        # 1回のトランザクションでまとめて書き込む
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for ts, router, site, kind, target, status, payload, issues in batch:
+                cursor = db.execute(
+                    "INSERT INTO results (ts, router, site, kind, target, status, payload) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (ts, router, site, kind, target, status, self._encode(payload)))
+                if issues:
+                    db.executemany(
+                        "INSERT INTO issues (result_id, ts, router, site, type, severity, description) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(cursor.lastrowid, ts, router, site, issue.get("type", "unknown"),
+                          issue.get("severity", "unknown"), issue.get("description")) for issue in issues])
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _compact(self, chunk: int = 10000) -> int:
+        # 長いロックを避けるため、削除は chunk 件ずつ別のトランザクションで行う
+        db = self._db
+        deleted = 0
+        cutoff = time.time() - self.retention_days * 86400
+        limit_id = None
+        row = db.execute("SELECT id FROM results ORDER BY id DESC LIMIT 1 OFFSET ?", (self.max_rows,)).fetchone()
+        if row is not None:
+            limit_id = row[0]
+        while True:
+            ids = [row[0] for row in db.execute(
+                "SELECT id FROM results WHERE ts < ? OR id <= ? ORDER BY id LIMIT ?",
+                (cutoff, limit_id if limit_id is not None else -1, chunk))]
+            if not ids:
+                break
+            placeholders = ",".join("?" * len(ids))
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(f"DELETE FROM issues WHERE result_id IN ({placeholders})", ids)
+            db.execute(f"DELETE FROM results WHERE id IN ({placeholders})", ids)
+            db.execute("COMMIT")
+            deleted += len(ids)
+        if deleted:
+            # execute() では1ページしか解放されないため、executescript() で最後まで実行する
+            db.executescript("PRAGMA incremental_vacuum;")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+    # 問い合わせ
+    def _page(self, table: str, columns: str, filters: Dict[str, Any], allowed: Tuple[str, ...],
+              since: Optional[float], until: Optional[float], limit: int, cursor: Optional[str]) -> Dict[str, Any]:
+        where, params = [], []
+        for column in allowed:
+            if filters.get(column) is not None:
+                where.append(f"{column} = ?")
+                params.append(filters[column])
+        if since is not None:
+            where.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("ts < ?")
+            params.append(until)
+        if cursor:
+            # 前のページの最後の行より後ろ (新しい順に並べて次の行) から読む
+            where.append("(ts, id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+        sql = f"SELECT {columns} FROM {table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+        self._db.row_factory = sqlite3.Row
+        try:
+            rows = [dict(row) for row in self._db.execute(sql, params)]
+        finally:
+            self._db.row_factory = None
+        next_cursor = encode_cursor(rows[limit - 1]["ts"], rows[limit - 1]["id"]) if len(rows) > limit else None
+        return {"items": rows[:limit], "next_cursor": next_cursor}
+
+    async def results(self, filters: Dict[str, Any], since: Optional[float] = None, until: Optional[float] = None,
+                      limit: int = 100, cursor: Optional[str] = None) -> Dict[str, Any]:
+        page = await self._run(self._page, "results", "id, ts, router, site, kind, target, status, payload",
+                               filters, RESULT_FILTERS, since, until, limit, cursor)
+        for item in page["items"]:
+            item["payload"] = json.loads(item["payload"])
+        return page
+
+    async def issues(self, filters: Dict[str, Any], since: Optional[float] = None, until: Optional[float] = None,
+                     limit: int = 100, cursor: Optional[str] = None) -> Dict[str, Any]:
+        return await self._run(self._page, "issues", "id, result_id, ts, router, site, type, severity, description",
+                               filters, ISSUE_FILTERS, since, until, limit, cursor)
+
+    def _counts(self) -> Dict[str, int]:
+        return {
+            "results": self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0],
+            "issues": self._db.execute("SELECT COUNT(*) FROM issues").fetchone()[0],
+        }
+
+    async def stats(self) -> Dict[str, Any]:
+        counts = await self._run(self._counts) if self._db is not None else {}
+        return {
+            **counts,
+            "path": self.path,
+            "bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "queue_depth": len(self._queue),
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "deleted": self.deleted,
+            "retention_days": self.retention_days,
+            "max_rows": self.max_rows,
+        }
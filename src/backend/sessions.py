@@ -0,0 +1,215 @@
+# /connect で発行するセッションの管理
+# IDは推測できない乱数から作り、最終利用からの期限 (idle) と発行からの期限 (absolute) で失効させる
+# 失効の判定は期限順のヒープで行い、全件の走査はしない
+
+import asyncio
+import heapq
+import logging
+import secrets
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+ExpireHandler = Callable[[str], Awaitable[None]]
+
+class SessionLimitError(Exception):
+    pass
+
+class SessionStore:
+    # セッションの実体は共有状態 (namespace) に置き、どのワーカーでも参照・失効できるようにする
+    # 最終利用時刻はワーカー内で毎回更新し、共有状態への書き込みは idle_ttl の1/4ごとにまとめる
+    # そのため共有状態の最終利用時刻は他のワーカーでの利用より最大 idle_ttl/4 古く、その分の猶予をおいて失効させる
+    def __init__(
+        self,
+        backend,
+        namespace: str = "connections",
+        idle_ttl: float = 1800.0,
+        absolute_ttl: float = 86400.0,
+        max_per_user: int = 20,
+        max_sessions: int = 100000,
+        sweep_interval: float = 1.0,
+        on_expire: Optional[ExpireHandler] = None,
+    ):
+        self.backend = backend
+        self.namespace = namespace
+        self.idle_ttl = idle_ttl
+        self.absolute_ttl = absolute_ttl
+        self.max_per_user = max_per_user
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self.on_expire = on_expire
+        self._sessions = backend.items(namespace)
+        # 各セッションにつきヒープ上の有効なエントリは1つだけ (_scheduled と期限が一致するもの)
+        self._heap: List[Tuple[float, str]] = []
+        self._scheduled: Dict[str, float] = {}
+        self._last_seen: Dict[str, float] = {}
+        self._by_user: Dict[str, Set[str]] = {}
+        self._users: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+        self.created = 0
+        self.expired = 0
+        self.closed = 0
+        self.rejected = 0
+        backend.watch(namespace, self._on_change)
+
+    def _deadline(self, session_id: str, record: Dict[str, Any]) -> float:
+        idle_deadline = max(self._last_seen.get(session_id, 0.0) + self.idle_ttl,
+                            record["last_seen"] + self.idle_ttl + self.idle_ttl / 4)
+        return min(record["created"] + self.absolute_ttl, idle_deadline)
+
+    def _track(self, session_id: str, record: Dict[str, Any]):
+        user = record.get("user")
+        if user is not None:
+            self._by_user.setdefault(user, set()).add(session_id)
+            self._users[session_id] = user
+        if session_id not in self._scheduled:
+            deadline = self._deadline(session_id, record)
+            self._scheduled[session_id] = deadline
+            heapq.heappush(self._heap, (deadline, session_id))
+
+    def _untrack(self, session_id: str):
+        self._scheduled.pop(session_id, None)
+        self._last_seen.pop(session_id, None)
+        user = self._users.pop(session_id, None)
+        if user is not None:
+            ids = self._by_user[user]
+            ids.discard(session_id)
+            if not ids:
+                del self._by_user[user]
+
+    def _on_change(self, session_id: str, record: Optional[Dict[str, Any]]):
+        # 自分と他のワーカーでの作成・更新・削除
+        if record is None:
+            self._untrack(session_id)
+        elif "created" in record:
+            self._track(session_id, record)
+
+    def _new_id(self) -> str:
+        # 128ビットの乱数 - 衝突は事実上起きないが、念のため既存のIDと重複しないことを確認する
+        while True:
+            session_id = f"session-{secrets.token_urlsafe(16)}"
+            if session_id not in self._sessions:
+                return session_id
+
+    async def create(self, data: Dict[str, Any], user: Optional[str] = None) -> str:
+        # ユーザー名を伴わない接続 (デモ用ルーター) は全体の上限だけを適用する
+        if len(self._sessions) >= self.max_sessions:
+            self.rejected += 1
+            raise SessionLimitError(f"Too many sessions (limit {self.max_sessions})")
+        if user is not None and len(self._by_user.get(user, ())) >= self.max_per_user:
+            self.rejected += 1
+            raise SessionLimitError(f"Too many sessions for user {user} (limit {self.max_per_user})")
+        session_id = self._new_id()
+        now = time.time()
+        await self.backend.set(self.namespace, session_id, {**data, "user": user, "created": now, "last_seen": now})
+        self.created += 1
+        return session_id
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        record = self._sessions.get(session_id)
+        if record is None or self._deadline(session_id, record) <= time.time():
+            return None
+        return record
+
+    def touch(self, session_id: str) -> bool:
+        record = self.get(session_id)
+        if record is None:
+            return False
+        now = time.time()
+        self._last_seen[session_id] = now
+        if now - record["last_seen"] > self.idle_ttl / 4:
+            self._spawn(self.backend.set(self.namespace, session_id, {**record, "last_seen": now}))
+        return True
+
+    async def update(self, session_id: str, **changes: Any) -> Optional[Dict[str, Any]]:
+        record = self.get(session_id)
+        if record is None:
+            return None
+        record = {**record, **changes, "last_seen": max(record["last_seen"], self._last_seen.get(session_id, 0.0))}
+        await self.backend.set(self.namespace, session_id, record)
+        return record
+
+    async def close(self, session_id: str) -> bool:
+        if session_id not in self._sessions:
+            return False
+        await self._remove(session_id)
+        self.closed += 1
+        return True
+
+    async def _remove(self, session_id: str):
+        await self.backend.delete(self.namespace, session_id)
+        if self.on_expire is not None:
+            try:
+                await self.on_expire(session_id)
+            except Exception as e:
+                logger.error(f"Session cleanup for {session_id} failed: {e}")
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def expire_due(self) -> int:
+        # 期限が過ぎたエントリだけを取り出す - 延長されていれば新しい期限で入れ直す
+        now = time.time()
+        expired = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, session_id = heapq.heappop(self._heap)
+            if self._scheduled.get(session_id) != deadline:
+                continue
+            record = self._sessions.get(session_id)
+            if record is None:
+                self._untrack(session_id)
+                continue
+            actual = self._deadline(session_id, record)
+            if actual > now:
+                self._scheduled[session_id] = actual
+                heapq.heappush(self._heap, (actual, session_id))
+                continue
+            del self._scheduled[session_id]
+            await self._remove(session_id)
+            expired += 1
+        self.expired += expired
+        return expired
+
+    def start(self):
+        # 起動前から共有状態にあるセッション (他のワーカーが作成したもの) も期限を管理する
+        for session_id, record in list(self._sessions.items()):
+            if "created" in record:
+                self._track(session_id, record)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.expire_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Session expiry failed: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "users": len(self._by_user),
+            "scheduled": len(self._scheduled),
+            "heap_entries": len(self._heap),
+            "idle_ttl": self.idle_ttl,
+            "absolute_ttl": self.absolute_ttl,
+            "max_per_user": self.max_per_user,
+            "created": self.created,
+            "expired": self.expired,
+            "closed": self.closed,
+            "rejected": self.rejected,
+        }
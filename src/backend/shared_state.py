@@ -0,0 +1,224 @@
+# ワーカー間で共有する状態とメッセージバス
+# 読み取りは各プロセスのミラー (dict) から行い、書き込みはバックエンドに保存したうえで他のワーカーに通知する
+# memory: 単一プロセス用 (既定) / sqlite: 同じホストの複数ワーカーでWALモードのSQLiteファイルを共有する
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MessageHandler = Callable[[Any], Awaitable[None]]
+# (キー, 値) - 削除された場合の値はNone
+ChangeHandler = Callable[[str, Any], None]
+
+class MemoryBackend:
+    name = "memory"
+    # 他のプロセスと状態を共有するか
+    shared = False
+
+    def __init__(self):
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._data: Dict[str, Dict[str, Any]] = {}
+        self._handlers: Dict[str, List[MessageHandler]] = {}
+        self._watchers: Dict[str, List[ChangeHandler]] = {}
+        self.published = 0
+        self.received = 0
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # キーバリュー
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        return self._data.get(namespace, {}).get(key, default)
+
+    def items(self, namespace: str) -> Dict[str, Any]:
+        # 返す辞書はミラーそのもの - 呼び出し側で変更しないこと
+        return self._data.setdefault(namespace, {})
+
+    def watch(self, namespace: str, handler: ChangeHandler):
+        # 自分と他のワーカーの両方の変更で呼ばれる
+        self._watchers.setdefault(namespace, []).append(handler)
+
+    def _apply(self, namespace: str, key: str, value: Any):
+        entries = self._data.setdefault(namespace, {})
+        if value is None:
+            if entries.pop(key, None) is None:
+                return
+        else:
+            entries[key] = value
+        for handler in self._watchers.get(namespace, ()):
+            try:
+                handler(key, value)
+            except Exception as e:
+                logger.error(f"State watcher for {namespace} failed: {e}")
+
+    async def set(self, namespace: str, key: str, value: Any):
+        self._apply(namespace, key, value)
+
+    async def delete(self, namespace: str, key: str):
+        self._apply(namespace, key, None)
+
+    # メッセージバス
+    def subscribe(self, channel: str, handler: MessageHandler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def _deliver(self, channel: str, message: Any):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.error(f"Handler for {channel} failed: {e}")
+
+    async def publish(self, channel: str, message: Any):
+        self.published += 1
+        await self._deliver(channel, message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "worker_id": self.worker_id,
+            "namespaces": {namespace: len(entries) for namespace, entries in self._data.items()},
+            "published": self.published,
+            "received": self.received,
+        }
+
+class SQLiteBackend(MemoryBackend):
+    # 変更とメッセージはeventsテーブルに追記し、各ワーカーは poll_interval ごとに新しい行を読み取る
+    # SQLiteへのアクセスは専用の1スレッドで直列に行い、イベントループを止めない
+    name = "sqlite"
+    shared = True
+    _KV_CHANNEL = "__kv__"
+
+    def __init__(self, path: str, poll_interval: float = 0.05, retention: float = 60.0):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._db: Optional[sqlite3.Connection] = None
+        self._last_event = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _open(self) -> Tuple[List[Tuple[str, str, str]], int]:
+        db = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        # 実機の認証情報も保存されるため、所有者以外は読めないようにする
+        os.chmod(self.path, 0o600)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                   "value TEXT NOT NULL, PRIMARY KEY (namespace, key))")
+        db.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "channel TEXT NOT NULL, origin TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS events_created ON events (created)")
+        self._db = db
+        # 状態の読み込みと最後のイベントIDを同じスナップショットで読み、取りこぼしを防ぐ
+        db.execute("BEGIN")
+        try:
+            rows = db.execute("SELECT namespace, key, value FROM kv").fetchall()
+            last = db.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        finally:
+            db.execute("COMMIT")
+        return rows, last
+
+    async def start(self):
+        if self._db is not None:
+            return
+        rows, self._last_event = await self._run(self._open)
+        for namespace, key, value in rows:
+            self._data.setdefault(namespace, {})[key] = json.loads(value)
+        self._task = asyncio.create_task(self._follow())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+
+    def _write(self, statements: List[Tuple[str, tuple]]):
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                db.execute(sql, params)
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _event(self, channel: str, payload: Any) -> Tuple[str, tuple]:
+        return ("INSERT INTO events (channel, origin, payload, created) VALUES (?, ?, ?, ?)",
+                (channel, self.worker_id, json.dumps(payload, ensure_ascii=False), time.time()))
+
+    async def set(self, namespace: str, key: str, value: Any):
+        # 自分のミラーには即座に反映し (自分の書き込みはすぐ読める)、保存と通知は同じトランザクションで行う
+        self._apply(namespace, key, value)
+        if value is None:
+            change = ("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        else:
+            change = ("INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                      (namespace, key, json.dumps(value, ensure_ascii=False)))
+        await self._run(self._write, [change, self._event(self._KV_CHANNEL, [namespace, key, value])])
+
+    async def delete(self, namespace: str, key: str):
+        await self.set(namespace, key, None)
+
+    async def publish(self, channel: str, message: Any):
+        self.published += 1
+        await self._run(self._write, [self._event(channel, message)])
+        await self._deliver(channel, message)
+
+    def _read_events(self, after: int, prune: bool) -> List[Tuple[int, str, str, str]]:
+        if prune:
+            self._db.execute("DELETE FROM events WHERE created < ?", (time.time() - self.retention,))
+        return self._db.execute("SELECT id, channel, origin, payload FROM events WHERE id > ? ORDER BY id",
+                                (after,)).fetchall()
+
+    async def _follow(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            prune = time.monotonic() - last_prune > self.retention / 4
+            try:
+                rows = await self._run(self._read_events, self._last_event, prune)
+            except sqlite3.Error as e:
+                logger.warning(f"Reading shared events failed: {e}")
+                continue
+            if prune:
+                last_prune = time.monotonic()
+            for event_id, channel, origin, payload in rows:
+                self._last_event = event_id
+                # 自分が書いたイベントは書き込み時に反映・配信済み
+                if origin == self.worker_id:
+                    continue
+                self.received += 1
+                message = json.loads(payload)
+                if channel == self._KV_CHANNEL:
+                    self._apply(*message)
+                else:
+                    await self._deliver(channel, message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "path": self.path, "last_event": self._last_event}
+
+def create_backend(name: str, path: Optional[str] = None) -> MemoryBackend:
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(path or "shared_state.db")
+    raise ValueError(f"Unknown state backend: {name}")
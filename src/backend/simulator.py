@@ -0,0 +1,445 @@
+# 仮想ルーター群のシミュレーター
+# シード値から拠点・ルーター・インターフェース・ACLを決定的に生成し、一部に障害を注入する
+# 応答遅延は固定値ではなく分布から引き、ゼロ遅延モードでは待機しない
+
+import asyncio
+import copy
+import hashlib
+import ipaddress
+import random
+import re
+import socket
+from typing import Any, Dict, List, Optional, Tuple
+
+# デモ用ルーター (フロントエンドの既定の接続先)
+DEMO_ROUTER_IP = "192.168.1.1"
+DEMO_ROUTER = {
+    "hostname": "Router",
+    "info": {
+        "name": "Cisco 892",
+        "model": "C892FSP-K9",
+        "serial_number": "FTX1840ABCD",
+        "firmware_version": "15.7(3)M2",
+        "uptime": "10 days, 4 hours, 32 minutes"
+    },
+    "interfaces": {
+        "GigabitEthernet0": {
+            "name": "GigabitEthernet0",
+            "status": "up",
+            "protocol": "up",
+            "ip": "192.168.1.1",
+            "speed": "1000Mb/s",
+            "duplex": "full"
+        },
+        "GigabitEthernet1": {
+            "name": "GigabitEthernet1",
+            "status": "up",
+            "protocol": "up",
+            "ip": "10.0.0.1",
+            "speed": "1000Mb/s",
+            "duplex": "full"
+        },
+        "GigabitEthernet2": {
+            "name": "GigabitEthernet2",
+            "status": "up",
+            "protocol": "up",
+            "ip": "172.16.0.1",
+            "speed": "1000Mb/s",
+            "duplex": "full"
+        },
+        "GigabitEthernet3": {
+            "name": "GigabitEthernet3",
+            "status": "administratively down",
+            "protocol": "down",
+            "ip": "unassigned",
+            "speed": "auto",
+            "duplex": "auto"
+        }
+    },
+    "acls": [
+        {
+            "name": "ALLOW_WEB",
+            "entries": [
+                "permit tcp any any eq 80",
+                "permit tcp any any eq 443"
+            ]
+        },
+        {
+            "name": "BLOCK_TELNET",
+            "entries": [
+                "deny tcp any any eq 23",
+                "permit ip any any"
+            ]
+        }
+    ]
+}
+
+_DEFAULT_ACLS = DEMO_ROUTER["acls"]
+
+def _scenario(interfaces: Dict[str, Dict[str, str]], target: str, reachable: bool, hops: List[Dict[str, Any]],
+              acls: Optional[List[Dict[str, Any]]] = None, remove_acls: Optional[List[str]] = None) -> Dict[str, Any]:
+    base_interfaces = {
+        "GigabitEthernet0": {"status": "up", "protocol": "up"},
+        "GigabitEthernet1": {"status": "up", "protocol": "up"},
+        "GigabitEthernet2": {"status": "up", "protocol": "up"},
+        "GigabitEthernet3": {"status": "administratively down", "protocol": "down"}
+    }
+    for name, changes in interfaces.items():
+        base_interfaces[name] = {**base_interfaces[name], **changes}
+    ping = {"success": True, "packet_loss": 0, "rtt_min": 1.1, "rtt_avg": 2.3, "rtt_max": 3.7} if reachable \
+        else {"success": False, "packet_loss": 100, "rtt_min": 0, "rtt_avg": 0, "rtt_max": 0}
+    scenario = {
+        "interfaces": base_interfaces,
+        "ping_results": {target: ping},
+        "traceroute_results": {target: hops}
+    }
+    # ACLは名前ごとに上書き・追加し、remove_aclsに挙げたものを削除する
+    if acls:
+        scenario["acls"] = acls
+    if remove_acls:
+        scenario["remove_acls"] = remove_acls
+    return scenario
+
+def _addressing(router: Dict[str, Any]) -> Tuple[str, str, str, str]:
+    # 1ホップ目 (Gi0)、上流側のアドレス (Gi1)、上流の隣接アドレス (Ping/Tracerouteの宛先)、誤設定に使うアドレス
+    interfaces = router["interfaces"]
+    uplink = interfaces["GigabitEthernet1"]["ip"]
+    network = ipaddress.ip_network(f"{uplink}/{router.get('masks', {}).get('GigabitEthernet1', '255.255.255.0')}",
+                                   strict=False)
+    gateway = network.network_address + 1
+    if str(gateway) == uplink:
+        gateway += 1
+    misconfigured = network.broadcast_address - 1
+    if str(misconfigured) in (uplink, str(gateway)):
+        # /30 のように空きの無いサブネットでは隣のサブネットのアドレスにする
+        misconfigured = network.broadcast_address + 2
+    return interfaces["GigabitEthernet0"]["ip"], uplink, str(gateway), str(misconfigured)
+
+def build_scenario(router: Dict[str, Any], name: str) -> Dict[str, Any]:
+    # シナリオ (障害の種類) の定義 - アドレスはルーターごとの割り当てから決める
+    # インターフェース名とACL名はデモ用ルーターと生成したルーターで共通
+    first_hop, uplink, gateway, misconfigured = _addressing(router)
+    if name == "healthy":
+        return _scenario({}, gateway, True, [
+            {"hop": 1, "ip": first_hop, "rtt": 0.5},
+            {"hop": 2, "ip": uplink, "rtt": 1.2},
+            {"hop": 3, "ip": gateway, "rtt": 2.1}
+        ])
+    if name == "interface_down":
+        return _scenario({"GigabitEthernet1": {"status": "down", "protocol": "down"}}, gateway, False, [
+            {"hop": 1, "ip": first_hop, "rtt": 0.5},
+            {"hop": 2, "ip": "*", "rtt": None},
+            {"hop": 3, "ip": "*", "rtt": None}
+        ])
+    if name == "ip_misconfigured":
+        return _scenario({"GigabitEthernet1": {"ip": misconfigured}}, gateway, False, [
+            {"hop": 1, "ip": first_hop, "rtt": 0.5},
+            {"hop": 2, "ip": misconfigured, "rtt": 1.3},
+            {"hop": 3, "ip": "*", "rtt": None}
+        ])
+    if name == "acl_misconfigured":
+        return _scenario({}, gateway, False, [
+            {"hop": 1, "ip": first_hop, "rtt": 0.5},
+            {"hop": 2, "ip": uplink, "rtt": 1.2},
+            {"hop": 3, "ip": "*", "rtt": None}
+        ], acls=[
+            {"name": "BLOCK_ALL", "entries": ["deny ip any any"]}
+        ], remove_acls=["BLOCK_TELNET"])
+    raise KeyError(name)
+
+def default_traceroute(router: Dict[str, Any], target: str) -> List[Dict[str, Any]]:
+    # シナリオに結果の無い宛先は上流経由で到達したものとする
+    first_hop, uplink, _, _ = _addressing(router)
+    return [
+        {"hop": 1, "ip": first_hop, "rtt": 0.5},
+        {"hop": 2, "ip": uplink, "rtt": 1.2},
+        {"hop": 3, "ip": target, "rtt": 2.1}
+    ]
+
+# デモ用ルーターのシナリオ (シナリオ名の一覧を兼ねる)
+SCENARIOS = {name: build_scenario(DEMO_ROUTER, name)
+             for name in ("healthy", "interface_down", "ip_misconfigured", "acl_misconfigured")}
+
+FAULTS = ("interface_down", "ip_misconfigured", "acl_misconfigured")
+
+# 操作ごとの基準遅延 (秒) - 従来の固定待ち時間と同じ値
+BASE_LATENCY = {
+    "connect": 1.0,
+    "info": 0.5,
+    "interfaces": 0.5,
+    "acls": 0.5,
+    "poll": 0.5,
+    "ping": 1.5,
+    "ping_probe": 0.3,
+    "traceroute": 2.0,
+    "traceroute_hop": 0.5,
+    "diagnostics": 3.0,
+    "execute": 1.0,
+    # 確立済みのセッションで続けて実行するコマンド1件あたり
+    "execute_pipelined": 0.05,
+    "sweep_probe": 0.01,
+    "sweep_timeout": 1.0,
+}
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal", "zero")
+
+class LatencyModel:
+    def __init__(self, distribution: str = "fixed", scale: float = 1.0, jitter: float = 0.0,
+                 seed: Optional[int] = None, base: Optional[Dict[str, float]] = None):
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.distribution = distribution
+        self.scale = scale
+        self.jitter = jitter
+        self.base = {**BASE_LATENCY, **(base or {})}
+        self._random = random.Random(seed)
+
+    def sample(self, operation: str) -> float:
+        base = self.base.get(operation, 0.0) * self.scale
+        if self.distribution == "zero" or base <= 0:
+            return 0.0
+        if self.distribution == "uniform":
+            return base * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        if self.distribution == "lognormal":
+            # 中央値が基準遅延になる対数正規分布 (ロングテールを再現する)
+            return base * self._random.lognormvariate(0.0, self.jitter)
+        return base
+
+    async def delay(self, operation: str):
+        seconds = self.sample(operation)
+        # ゼロ遅延モードではイベントループに制御を返さずにそのまま進む
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+class FleetSimulator:
+    # 拠点ごとに1台のハブと、ハブの配下のルーターで構成する
+    # ハブのGi1はWANコアに、配下のルーターのGi1はハブのGi2 (拠点セグメント) に接続する
+    # 配下のルーターのLAN (10.0.0.0/9 の /24) と拠点セグメント (172.17.0.0 - 172.31.255.0 の /24) の数で台数の上限が決まる
+    # 拠点セグメントはデモ用ルーターのGi2 (172.16.0.0/24) と重ならないよう 172.17 から割り当てる
+    MAX_LANS = 32768
+    MAX_SITES = 3840
+
+    def __init__(self, size: int = 0, seed: int = 0, routers_per_site: int = 50, fault_rate: float = 0.0):
+        if routers_per_site < 1 or routers_per_site > 250:
+            raise ValueError("routers_per_site must be between 1 and 250")
+        max_size = min(self.MAX_LANS, self.MAX_SITES * routers_per_site)
+        if size > max_size:
+            raise ValueError(f"size must be at most {max_size} with {routers_per_site} routers per site")
+        self.size = size
+        self.seed = seed
+        self.routers_per_site = routers_per_site
+        self.fault_rate = fault_rate
+        self.routers: Dict[str, Dict[str, Any]] = {}
+        self.faults: Dict[str, str] = {}
+        self.links: List[Dict[str, Any]] = []
+        self._scenarios: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._random = random.Random(seed)
+        self._generate()
+
+    def scenario(self, ip: Optional[str], name: str) -> Dict[str, Any]:
+        # ルーターのアドレスに合わせたシナリオ (ルーターを指定しない場合はデモ用ルーターのもの)
+        if name not in SCENARIOS:
+            return {}
+        if ip is None or ip == DEMO_ROUTER_IP or ip not in self.routers:
+            return SCENARIOS[name]
+        scenario = self._scenarios.get((ip, name))
+        if scenario is None:
+            scenario = self._scenarios[(ip, name)] = build_scenario(self.routers[ip], name)
+        return scenario
+
+    def _generate(self):
+        self.routers[DEMO_ROUTER_IP] = copy.deepcopy(DEMO_ROUTER)
+        hubs: Dict[int, str] = {}
+        for index in range(self.size):
+            site, position = divmod(index, self.routers_per_site)
+            ip = self._management_ip(site, position)
+            if position == 0:
+                hubs[site] = ip
+            self.routers[ip] = self._router(index, site, position)
+            if position == 0:
+                self.links.append({"a": ip, "a_interface": "GigabitEthernet1", "b": "core", "b_interface": None})
+            else:
+                self.links.append({"a": ip, "a_interface": "GigabitEthernet1",
+                                   "b": hubs[site], "b_interface": "GigabitEthernet2"})
+            if self._random.random() < self.fault_rate:
+                self.faults[ip] = self._random.choice(FAULTS)
+        self._check_static_overlap()
+
+    def _check_static_overlap(self):
+        # 生成したアドレスが固定のルーター (デモ用) のアドレスやサブネットと重なるとトポロジーに存在しない経路ができる
+        static = []
+        for ip, router in self.routers.items():
+            if ip == DEMO_ROUTER_IP:
+                static += [(address, _prefix(address, mask)) for address, mask in _addresses(router)]
+        for ip, router in self.routers.items():
+            if ip == DEMO_ROUTER_IP:
+                continue
+            for address, mask in _addresses(router):
+                network, netmask = _prefix(address, mask)
+                for static_address, (static_network, static_mask) in static:
+                    # 短い方のマスクで比べて一致すれば重なっている
+                    common = netmask & static_mask
+                    if address == static_address or network & common == static_network & common:
+                        raise ValueError(f"{ip} address {address} overlaps static address {static_address}")
+
+    @staticmethod
+    def _management_ip(site: int, position: int) -> str:
+        return f"10.{128 + site // 256}.{site % 256}.{position + 1}"
+
+    def _router(self, index: int, site: int, position: int) -> Dict[str, Any]:
+        rng = self._random
+        site_segment = f"172.{17 + site // 256}.{site % 256}"
+        if position == 0:
+            wan = ipaddress.IPv4Address("100.64.0.0") + 4 * site + 1
+            uplink, uplink_mask = str(wan), "255.255.255.252"
+            lan, lan_mask = f"{site_segment}.1", "255.255.255.0"
+        else:
+            uplink, uplink_mask = f"{site_segment}.{position + 1}", "255.255.255.0"
+            lan, lan_mask = f"10.{(index >> 8) & 127}.{index & 255}.1", "255.255.255.0"
+        management = self._management_ip(site, position)
+        days, hours, minutes = rng.randint(0, 400), rng.randint(0, 23), rng.randint(0, 59)
+        return {
+            "hostname": f"site{site:03d}-rtr{position:02d}",
+            "info": {
+                "name": "Cisco 892",
+                "model": rng.choice(("C892FSP-K9", "C891F-K9", "C897VA-K9")),
+                "serial_number": f"FGL{rng.randrange(16 ** 8):08X}",
+                "firmware_version": rng.choice(("15.7(3)M2", "15.8(3)M4", "15.9(3)M6")),
+                "uptime": f"{days} days, {hours} hours, {minutes} minutes",
+                "site": f"site{site:03d}"
+            },
+            "interfaces": {
+                "GigabitEthernet0": self._interface("GigabitEthernet0", management),
+                "GigabitEthernet1": self._interface("GigabitEthernet1", uplink),
+                "GigabitEthernet2": self._interface("GigabitEthernet2", lan),
+                "GigabitEthernet3": {
+                    "name": "GigabitEthernet3",
+                    "status": "administratively down",
+                    "protocol": "down",
+                    "ip": "unassigned",
+                    "speed": "auto",
+                    "duplex": "auto"
+                }
+            },
+            "masks": {
+                "GigabitEthernet0": "255.255.255.0",
+                "GigabitEthernet1": uplink_mask,
+                "GigabitEthernet2": lan_mask,
+            },
+            "acls": copy.deepcopy(_DEFAULT_ACLS) + [{
+                "name": "MGMT_ACCESS",
+                "entries": [
+                    f"permit tcp 10.{128 + site // 256}.{site % 256}.0 0.0.0.255 any eq 22",
+                    "deny tcp any any eq 22 log",
+                    "permit ip any any"
+                ]
+            }]
+        }
+
+    def _interface(self, name: str, ip: str) -> Dict[str, str]:
+        speed = self._random.choice(("1000Mb/s", "1000Mb/s", "100Mb/s"))
+        return {"name": name, "status": "up", "protocol": "up", "ip": ip, "speed": speed, "duplex": "full"}
+
+    def stats(self) -> Dict[str, Any]:
+        faults: Dict[str, int] = {}
+        for fault in self.faults.values():
+            faults[fault] = faults.get(fault, 0) + 1
+        return {
+            "routers": len(self.routers),
+            "sites": (self.size + self.routers_per_site - 1) // self.routers_per_site,
+            "seed": self.seed,
+            "links": len(self.links),
+            "faults": faults,
+        }
+
+# Pingスイープで応答するホストの割合
+HOST_DENSITY = 0.3
+
+_UNREACHABLE = {"success": False, "packet_loss": 100, "rtt_min": 0, "rtt_avg": 0, "rtt_max": 0}
+
+def _addresses(router: Dict[str, Any]) -> List[Tuple[str, str]]:
+    masks = router.get("masks", {})
+    return [(interface["ip"], masks.get(name, "255.255.255.0"))
+            for name, interface in router["interfaces"].items() if interface["ip"] != "unassigned"]
+
+def _prefix(address: str, mask: str) -> Tuple[int, int]:
+    netmask = int.from_bytes(socket.inet_aton(mask), "big")
+    return int.from_bytes(socket.inet_aton(address), "big") & netmask, netmask
+
+def _is_up(interface: Dict[str, str]) -> bool:
+    return interface["status"] == "up" and interface["protocol"] == "up"
+
+def simulate_ping(router: Dict[str, Any], scenario: Dict[str, Any], target: str, seed: int = 0) -> Dict[str, Any]:
+    # シナリオに結果が定義されていればそれを使い、無ければ経路 (直結か上流か) と
+    # インターフェースの状態から判定する - 応答の有無はシードと宛先から決定的に決まる
+    if target in scenario.get("ping_results", {}):
+        return scenario["ping_results"][target]
+    address = ipaddress.ip_address(target)
+    egress = router["interfaces"].get("GigabitEthernet1")
+    for name, interface in router["interfaces"].items():
+        if interface["ip"] == "unassigned":
+            continue
+        if interface["ip"] == target:
+            if not _is_up(interface):
+                return dict(_UNREACHABLE)
+            return {"success": True, "packet_loss": 0, "rtt_min": 0.1, "rtt_avg": 0.2, "rtt_max": 0.4}
+        mask = router.get("masks", {}).get(name, "255.255.255.0")
+        if address in ipaddress.ip_network(f"{interface['ip']}/{mask}", strict=False):
+            egress = interface
+            break
+    if egress is None or not _is_up(egress):
+        return dict(_UNREACHABLE)
+    digest = hashlib.blake2b(f"{seed}|{router.get('hostname')}|{target}".encode(), digest_size=8).digest()
+    if int.from_bytes(digest[:4], "big") / 2 ** 32 >= HOST_DENSITY:
+        return dict(_UNREACHABLE)
+    rtt = round(0.5 + 20 * digest[4] / 255, 1)
+    return {"success": True, "packet_loss": 0, "rtt_min": round(rtt * 0.8, 1), "rtt_avg": rtt, "rtt_max": round(rtt * 1.5, 1)}
+
+# シミュレーションしたshowコマンドの出力
+def render_show_version(router: Dict[str, Any]) -> str:
+    info = router["info"]
+    firmware = info["firmware_version"]
+    return (f"Cisco IOS Software, C800 Software (C800-UNIVERSALK9-M), Version {firmware}\n"
+            f"ROM: System Bootstrap, Version {firmware.replace(')', 'r)', 1)}\n"
+            f"{router.get('hostname', 'Router')} uptime is {info['uptime']}")
+
+def render_ip_interface_brief(router: Dict[str, Any]) -> str:
+    lines = ["Interface              IP-Address      OK? Method Status                Protocol"]
+    for interface in router["interfaces"].values():
+        lines.append(f"{interface['name']:<23}{interface['ip']:<16}YES NVRAM  "
+                     f"{interface['status']:<22}{interface['protocol']}")
+    return "\n".join(lines)
+
+def render_running_config(router: Dict[str, Any]) -> str:
+    masks = router.get("masks", {})
+    body = [
+        "!",
+        "version " + re.match(r"\d+\.\d+", router["info"]["firmware_version"]).group(0),
+        "service timestamps debug datetime msec",
+        "service timestamps log datetime msec",
+        "no service password-encryption",
+        "!",
+        f"hostname {router.get('hostname', 'Router')}",
+        "!",
+    ]
+    for interface in router["interfaces"].values():
+        body.append(f"interface {interface['name']}")
+        if interface["ip"] == "unassigned":
+            body.append(" no ip address")
+        else:
+            body.append(f" ip address {interface['ip']} {masks.get(interface['name'], '255.255.255.0')}")
+        if interface["status"] == "administratively down":
+            body.append(" shutdown")
+        else:
+            if interface["duplex"] != "auto":
+                body.append(f" duplex {interface['duplex']}")
+            if interface["speed"] != "auto":
+                body.append(f" speed {interface['speed'].replace('Mb/s', '')}")
+        body.append("!")
+    for acl in router.get("acls", []):
+        body.append(f"ip access-list extended {acl['name']}")
+        body.extend(f" {entry}" for entry in acl["entries"])
+        body.append("!")
+    body.append("end")
+    text = "\n".join(body)
+    return f"Building configuration...\n\nCurrent configuration : {len(text)} bytes\n{text}"
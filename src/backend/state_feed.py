@@ -0,0 +1,169 @@
+# ルーター状態の差分配信
+# 購読開始時に全体のスナップショットを1回送り、以降はフィールド単位の差分だけを送る
+# 差分にはルーターごとの連番を付け、クライアントは欠番を検出したら再同期を要求する
+
+import json
+from collections import deque
+from typing import Any, Deque, Dict, FrozenSet, List, Optional, Tuple
+
+Change = Dict[str, Any]
+
+def normalize_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    # ACLは名前で引けるようにしてから比較する
+    return {
+        "info": state.get("info") or {},
+        "interfaces": state.get("interfaces") or {},
+        "acls": {acl["name"]: acl["entries"] for acl in state.get("acls") or []},
+    }
+
+def diff_state(old: Dict[str, Any], new: Dict[str, Any], path: Tuple[str, ...] = ()) -> List[Change]:
+    # インターフェース名に "." が含まれることがあるため、パスは配列で表す
+    changes: List[Change] = []
+    for key, value in new.items():
+        if key not in old:
+            changes.append({"op": "add", "path": [*path, key], "new": value})
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            changes.extend(diff_state(old[key], value, (*path, key)))
+        elif old[key] != value:
+            changes.append({"op": "change", "path": [*path, key], "old": old[key], "new": value})
+    for key in old:
+        if key not in new:
+            changes.append({"op": "remove", "path": [*path, key], "old": old[key]})
+    return changes
+
+def _encode(frame: Dict[str, Any]) -> str:
+    return json.dumps(frame, separators=(",", ":"), ensure_ascii=False)
+
+class Subscription:
+    def __init__(self, client_id: str, router: str, interfaces: Optional[FrozenSet[str]]):
+        self.client_id = client_id
+        self.router = router
+        # Noneの場合はルーター全体を購読する
+        self.interfaces = interfaces
+        self.last_seq = 0
+
+    def accepts(self, change: Change) -> bool:
+        if self.interfaces is None:
+            return True
+        path = change["path"]
+        return path[0] == "interfaces" and (len(path) == 1 or path[1] in self.interfaces)
+
+    def view(self, snapshot: Dict[str, Any]) -> Dict[str, Any]:
+        if self.interfaces is None:
+            return snapshot
+        return {"interfaces": {name: value for name, value in snapshot["interfaces"].items()
+                               if name in self.interfaces}}
+
+class _RouterFeed:
+    def __init__(self, history_size: int):
+        self.seq = 0
+        self.snapshot: Optional[Dict[str, Any]] = None
+        self.history: Deque[Tuple[int, List[Change]]] = deque(maxlen=history_size)
+        self.subscribers: Dict[str, Subscription] = {}
+
+class StateFeed:
+    def __init__(self, history_size: int = 256):
+        self.history_size = history_size
+        self._routers: Dict[str, _RouterFeed] = {}
+        self.published = 0
+        self.frames_encoded = 0
+        self.frames_sent = 0
+
+    def _feed(self, router: str) -> _RouterFeed:
+        feed = self._routers.get(router)
+        if feed is None:
+            feed = _RouterFeed(self.history_size)
+            self._routers[router] = feed
+        return feed
+
+    def version(self, router: str) -> int:
+        # 状態が変化するたびに増える (レスポンスキャッシュのキーに使う)
+        feed = self._routers.get(router)
+        return feed.seq if feed is not None else 0
+
+    def has_state(self, router: str) -> bool:
+        feed = self._routers.get(router)
+        return feed is not None and feed.snapshot is not None
+
+    def publish(self, router: str, state: Dict[str, Any]) -> List[Tuple[str, str]]:
+        # 差分を計算して (client_id, 送信するJSON) の一覧を返す
+        feed = self._feed(router)
+        snapshot = normalize_state(state)
+        if feed.snapshot is None:
+            feed.snapshot = snapshot
+            return []
+        changes = diff_state(feed.snapshot, snapshot)
+        if not changes:
+            return []
+        feed.snapshot = snapshot
+        feed.seq += 1
+        feed.history.append((feed.seq, changes))
+        self.published += 1
+
+        # 同じ条件の購読者には同じフレームを1回だけエンコードして使い回す
+        encoded: Dict[Tuple[Optional[FrozenSet[str]], int], Optional[str]] = {}
+        deliveries = []
+        for subscription in feed.subscribers.values():
+            group = (subscription.interfaces, subscription.last_seq)
+            if group not in encoded:
+                relevant = [change for change in changes if subscription.accepts(change)]
+                encoded[group] = _encode(self._delta_frame(router, feed.seq, subscription.last_seq, relevant)) \
+                    if relevant else None
+                if relevant:
+                    self.frames_encoded += 1
+            if encoded[group] is None:
+                continue
+            subscription.last_seq = feed.seq
+            deliveries.append((subscription.client_id, encoded[group]))
+        self.frames_sent += len(deliveries)
+        return deliveries
+
+    @staticmethod
+    def _delta_frame(router: str, seq: int, prev_seq: int, changes: List[Change]) -> Dict[str, Any]:
+        # prev_seqはこの購読者に前回送った連番 - 受信済みの連番と異なれば欠番がある
+        return {"type": "state_delta", "router": router, "seq": seq, "prev_seq": prev_seq, "changes": changes}
+
+    def subscribe(self, client_id: str, router: str, interfaces: Optional[List[str]] = None) -> Dict[str, Any]:
+        feed = self._feed(router)
+        subscription = Subscription(client_id, router, frozenset(interfaces) if interfaces else None)
+        feed.subscribers[client_id] = subscription
+        return self._snapshot_frame(feed, subscription)
+
+    def _snapshot_frame(self, feed: _RouterFeed, subscription: Subscription) -> Dict[str, Any]:
+        subscription.last_seq = feed.seq
+        return {
+            "type": "state_snapshot",
+            "router": subscription.router,
+            "seq": feed.seq,
+            "state": subscription.view(feed.snapshot or normalize_state({})),
+        }
+
+    def resync(self, client_id: str, router: str, since: int) -> Optional[Dict[str, Any]]:
+        # 履歴に残っていれば欠けた差分をまとめて返し、無ければスナップショットを返す
+        feed = self._routers.get(router)
+        subscription = feed.subscribers.get(client_id) if feed else None
+        if subscription is None:
+            return None
+        oldest = feed.history[0][0] if feed.history else feed.seq + 1
+        if since > feed.seq or since < oldest - 1:
+            return self._snapshot_frame(feed, subscription)
+        changes = [change for seq, entries in feed.history if seq > since
+                   for change in entries if subscription.accepts(change)]
+        subscription.last_seq = feed.seq
+        return self._delta_frame(router, feed.seq, since, changes)
+
+    def unsubscribe(self, client_id: str, router: Optional[str] = None):
+        routers = [router] if router is not None else list(self._routers)
+        for name in routers:
+            feed = self._routers.get(name)
+            if feed is not None:
+                feed.subscribers.pop(client_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "routers": len(self._routers),
+            "subscriptions": sum(len(feed.subscribers) for feed in self._routers.values()),
+            "published": self.published,
+            "frames_encoded": self.frames_encoded,
+            "frames_sent": self.frames_sent,
+        }
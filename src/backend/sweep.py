@@ -0,0 +1,111 @@
+# サブネットのPingスイープ
+# 宛先ごとのPingを固定数のワーカーで並行に実行し、ルーター単位と全体のレート制限をかける
+# 結果は完了順に返し、最後に到達性の集計を返す
+
+import asyncio
+import ipaddress
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence
+
+# 1回のスイープで扱う宛先数の上限 (/20 相当)
+MAX_SWEEP_TARGETS = 4096
+
+Probe = Callable[[str], Awaitable[Dict[str, Any]]]
+
+def expand_targets(cidr: Optional[str] = None, targets: Iterable[str] = (),
+                   max_targets: int = MAX_SWEEP_TARGETS) -> List[str]:
+    # CIDRはネットワークアドレスとブロードキャストアドレスを除いたホストに展開する
+    expanded: Dict[str, None] = {}
+    if cidr:
+        try:
+            network = ipaddress.ip_network(cidr, strict=False)
+        except ValueError as e:
+            raise ValueError(f"Invalid CIDR: {cidr} ({e})")
+        if network.num_addresses > max_targets + 2:
+            raise ValueError(f"{cidr} has {network.num_addresses} addresses (limit {max_targets})")
+        for host in network.hosts():
+            expanded[str(host)] = None
+    for target in targets:
+        try:
+            expanded[str(ipaddress.ip_address(target))] = None
+        except ValueError:
+            raise ValueError(f"Invalid target address: {target}")
+    if len(expanded) > max_targets:
+        raise ValueError(f"Too many targets: {len(expanded)} (limit {max_targets})")
+    return list(expanded)
+
+class TokenBucket:
+    # rate 回/秒、最大 burst 回までまとめて許可する (rate が0以下なら制限しない)
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+async def sweep(
+    targets: Sequence[str],
+    probe: Probe,
+    limiters: Sequence[TokenBucket] = (),
+    max_concurrency: int = 256,
+) -> AsyncIterator[Dict[str, Any]]:
+    # 宛先ごとにタスクを作らず、max_concurrency 個のワーカーが宛先を順に取り出す
+    started = time.perf_counter()
+    pending = iter(targets)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def worker():
+        for target in pending:
+            for limiter in limiters:
+                await limiter.acquire()
+            entry: Dict[str, Any] = {"type": "result", "target": target}
+            try:
+                entry["result"] = await probe(target)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                entry["error"] = str(e) or type(e).__name__
+            await results.put(entry)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(max_concurrency, len(targets))))]
+    reachable: List[str] = []
+    rtts: List[float] = []
+    errors = 0
+    try:
+        for _ in range(len(targets)):
+            entry = await results.get()
+            result = entry.get("result")
+            if result is None:
+                errors += 1
+            elif result.get("success"):
+                reachable.append(entry["target"])
+                rtts.append(result.get("rtt_avg", 0))
+            yield entry
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    total = len(targets)
+    yield {
+        "type": "summary",
+        "total": total,
+        "reachable": len(reachable),
+        "unreachable": total - len(reachable) - errors,
+        "errors": errors,
+        "reachability": round(len(reachable) / total, 4) if total else 0.0,
+        "rtt_avg": round(sum(rtts) / len(rtts), 3) if rtts else None,
+        "wall_time": round(time.perf_counter() - started, 6),
+        "reachable_hosts": sorted(reachable, key=ipaddress.ip_address),
+    }
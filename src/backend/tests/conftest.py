@@ -0,0 +1,5 @@
+# バックエンドのモジュールは src/backend を起点に直接 import する
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
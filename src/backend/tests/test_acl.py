@@ -0,0 +1,129 @@
+# ACLのコンパイル結果 (ビット集合による照合) と素朴な先頭からの照合の比較
+
+import ipaddress
+import random
+
+import pytest
+
+from acl import ICMP_NAMES, ACLParseError, compile_acl, parse_entry
+
+def naive_match(rules, protocol, src, dst, src_port, dst_port, established, icmp_type, icmp_code):
+    # 各エントリを先頭から順に調べ、最初に一致したものを返す
+    def in_ports(intervals, port):
+        if intervals is None:
+            return True
+        return port is not None and any(low <= port <= high for low, high in intervals)
+
+    for rule in rules:
+        if rule.protocol is not None and rule.protocol != protocol:
+            continue
+        if rule.established and not established:
+            continue
+        if src & ~rule.src[1] & 0xFFFFFFFF != rule.src[0] or dst & ~rule.dst[1] & 0xFFFFFFFF != rule.dst[0]:
+            continue
+        if protocol in (6, 17) and not (in_ports(rule.src_ports, src_port) and in_ports(rule.dst_ports, dst_port)):
+            continue
+        if protocol == 1 and rule.icmp is not None:
+            if icmp_type != rule.icmp[0] or (rule.icmp[1] is not None and icmp_code != rule.icmp[1]):
+                continue
+        return rule
+    return None
+
+ADDRESSES = [f"10.0.{third}.{fourth}" for third in range(4) for fourth in range(8)]
+# 連続しないワイルドカードを含める
+WILDCARDS = ["0.0.0.0", "0.0.0.7", "0.0.3.255", "0.0.1.1", "0.0.2.5", "255.255.255.255", "0.0.3.0"]
+PORTS = [0, 1, 2, 5, 7, 10, 22, 23, 80, 443, 65534, 65535]
+
+def random_address(rng):
+    choice = rng.random()
+    if choice < 0.2:
+        return "any"
+    if choice < 0.5:
+        return f"host {rng.choice(ADDRESSES)}"
+    return f"{rng.choice(ADDRESSES)} {rng.choice(WILDCARDS)}"
+
+def random_ports(rng):
+    choice = rng.randrange(6)
+    if choice == 0:
+        return ""
+    if choice == 1:
+        return " eq " + " ".join(str(port) for port in rng.sample(PORTS, rng.randint(1, 3)))
+    if choice == 2:
+        return " neq " + " ".join(str(port) for port in rng.sample(PORTS, rng.randint(1, 2)))
+    if choice == 3:
+        return f" lt {rng.choice(PORTS)}"
+    if choice == 4:
+        return f" gt {rng.choice(PORTS)}"
+    return f" range {rng.choice(PORTS)} {rng.choice(PORTS)}"
+
+def random_icmp(rng):
+    choice = rng.randrange(4)
+    if choice == 0:
+        return ""
+    if choice == 1:
+        return " " + rng.choice(list(ICMP_NAMES))
+    if choice == 2:
+        return f" {rng.choice((0, 3, 8, 11))}"
+    return f" {rng.choice((0, 3, 8, 11))} {rng.choice((0, 1, 3, 4))}"
+
+def random_entry(rng):
+    action = rng.choice(("permit", "deny"))
+    protocol = rng.choice(("ip", "tcp", "tcp", "udp", "icmp", "47"))
+    src, dst = random_address(rng), random_address(rng)
+    if protocol in ("tcp", "udp"):
+        line = f"{action} {protocol} {src}{random_ports(rng)} {dst}{random_ports(rng)}"
+        if protocol == "tcp" and rng.random() < 0.3:
+            line += " established"
+    elif protocol == "icmp":
+        line = f"{action} {protocol} {src} {dst}{random_icmp(rng)}"
+    else:
+        line = f"{action} {protocol} {src} {dst}"
+    if rng.random() < 0.2:
+        line += " log"
+    return line
+
+def random_flow(rng):
+    protocol = rng.choice((1, 6, 17, 47))
+    return (
+        protocol,
+        int(ipaddress.IPv4Address(rng.choice(ADDRESSES))),
+        int(ipaddress.IPv4Address(rng.choice(ADDRESSES))),
+        rng.choice(PORTS + [None]),
+        rng.choice(PORTS + [None]),
+        rng.random() < 0.5,
+        rng.choice((0, 3, 8, 11, None)),
+        rng.choice((0, 1, 3, 4, None)),
+    )
+
+@pytest.mark.parametrize("seed", range(20))
+def test_compiled_matches_first_match_loop(seed):
+    rng = random.Random(seed)
+    for _ in range(20):
+        entries = [random_entry(rng) for _ in range(rng.randint(1, 40))]
+        compiled = compile_acl(f"ACL{seed}", entries)
+        for _ in range(200):
+            flow = random_flow(rng)
+            assert compiled.match(*flow) is naive_match(compiled.rules, *flow), (entries, flow)
+
+def test_icmp_type_is_part_of_the_match():
+    compiled = compile_acl("ICMP", ["permit icmp any any echo-reply", "permit icmp any any 3 4", "deny icmp any any"])
+    flow = {"protocol": "icmp", "src": "10.0.0.1", "dst": "10.0.0.2"}
+    assert compiled.evaluate({**flow, "icmp_type": 0, "icmp_code": 0})["entry"] == 0
+    assert compiled.evaluate({**flow, "icmp_type": 8, "icmp_code": 0})["action"] == "deny"
+    assert compiled.evaluate({**flow, "icmp_type": 3, "icmp_code": 4})["entry"] == 1
+    assert compiled.evaluate({**flow, "icmp_type": 3, "icmp_code": 1})["action"] == "deny"
+    assert compiled.evaluate(flow)["action"] == "deny"
+
+@pytest.mark.parametrize("line", [
+    "permit ip any any dscp ef",
+    "permit tcp any any fragments",
+    "permit icmp any any bogus-type",
+    "permit tcp any any time-range WORK",
+])
+def test_unsupported_qualifiers_are_rejected(line):
+    with pytest.raises(ACLParseError):
+        parse_entry(line)
+
+def test_log_options_are_ignored():
+    assert parse_entry("deny tcp any any eq 22 log").dst_ports == ((22, 22),)
+    assert parse_entry("permit icmp any any echo log-input").icmp == (8, None)
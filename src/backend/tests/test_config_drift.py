@@ -0,0 +1,158 @@
+# running-configのドリフト検出 (無視パターンと基準の選び方) のテスト
+
+import fnmatch
+import random
+
+import pytest
+
+from config_drift import DriftEngine, split_config
+
+def render(hostname="Router", interfaces=None, extra=""):
+    interfaces = interfaces if interfaces is not None else {
+        "GigabitEthernet0": "192.168.1.1",
+        "GigabitEthernet1": "10.0.0.1",
+    }
+    lines = [f"hostname {hostname}", "!"]
+    for name, address in interfaces.items():
+        lines += [f"interface {name}", f" ip address {address} 255.255.255.0", "!"]
+    lines += [
+        "access-list 100 permit tcp any any eq 22",
+        "access-list 100 deny ip any any",
+        "ip route 0.0.0.0 0.0.0.0 10.0.0.254",
+        "snmp-server location lab",
+        "line vty 0 4",
+        " login local",
+        "!",
+    ]
+    return "\n".join(lines) + "\n" + extra
+
+GOLDEN = render()
+
+def test_split_config_groups_blocks():
+    snapshot = split_config(GOLDEN)
+    assert sorted(snapshot) == sorted([
+        "hostname", "interface GigabitEthernet0", "interface GigabitEthernet1", "access-list 100",
+        "ip route", "snmp-server", "line vty 0 4",
+    ])
+    assert snapshot["access-list 100"][1] == ("access-list 100 permit tcp any any eq 22",
+                                              "access-list 100 deny ip any any")
+    assert snapshot["interface GigabitEthernet0"][1] == ("interface GigabitEthernet0",
+                                                         " ip address 192.168.1.1 255.255.255.0")
+
+def test_compare_reports_missing_changed_and_extra():
+    engine = DriftEngine()
+    assert engine.compare(GOLDEN, GOLDEN)["in_sync"]
+
+    config = render(interfaces={"GigabitEthernet0": "192.168.1.9"}, extra="ntp server 10.0.0.5\n")
+    report = engine.compare(config, GOLDEN)
+    assert not report["in_sync"]
+    assert [entry["block"] for entry in report["changed"]] == ["interface GigabitEthernet0"]
+    assert [entry["block"] for entry in report["missing"]] == ["interface GigabitEthernet1"]
+    assert report["extra"] == ["ntp"]
+    diff = report["changed"][0]["diff"]
+    assert "- ip address 192.168.1.1 255.255.255.0" in diff
+    assert "+ ip address 192.168.1.9 255.255.255.0" in diff
+
+    # 余分なブロックは strict の場合だけドリフト扱い
+    config = render(extra="ntp server 10.0.0.5\n")
+    assert engine.compare(config, GOLDEN)["in_sync"]
+    assert not engine.compare(config, GOLDEN, strict=True)["in_sync"]
+
+def test_ignore_patterns():
+    engine = DriftEngine()
+    config = render(hostname="Branch-7", interfaces={"GigabitEthernet0": "192.168.7.1",
+                                                     "GigabitEthernet1": "10.0.7.1"})
+    assert not engine.compare(config, GOLDEN)["in_sync"]
+    assert not engine.compare(config, GOLDEN, ignore=["hostname"])["in_sync"]
+
+    report = engine.compare(config, GOLDEN, ignore=["hostname", "interface *"])
+    assert report["in_sync"]
+    assert report["matched"] == 4
+
+    # パターンは大文字・小文字を区別し、ブロック名全体に一致する必要がある
+    report = engine.compare(config, GOLDEN, ignore=["hostname", "interface gigabitethernet*", "interface"])
+    assert [entry["block"] for entry in report["changed"]] == ["interface GigabitEthernet0", "interface GigabitEthernet1"]
+    report = engine.compare(config, GOLDEN, ignore=["hostname", "interface GigabitEthernet[0]"])
+    assert [entry["block"] for entry in report["changed"]] == ["interface GigabitEthernet1"]
+
+    # 無視したブロックは extra にも含めない
+    config = render(extra="ntp server 10.0.0.5\nntp source Loopback0\n")
+    assert engine.compare(config, GOLDEN, ignore=["ntp"], strict=True)["in_sync"]
+
+def test_reports_are_cached_per_ignore_list():
+    engine = DriftEngine()
+    config = render(hostname="Branch-7")
+    first = engine.compare(config, GOLDEN)
+    assert engine.compare(config, GOLDEN) is first
+    ignored = engine.compare(config, GOLDEN, ignore=["hostname"])
+    assert ignored["in_sync"] and not first["in_sync"]
+    stats = engine.cache_stats()
+    assert (stats["report_hits"], stats["report_misses"]) == (1, 2)
+    # 同じ文字列の分割結果は再利用する
+    assert stats["snapshot_misses"] == 2
+
+BLOCK_POOL = {
+    "hostname": ["hostname R1", "hostname R2"],
+    "interface GigabitEthernet0": ["interface GigabitEthernet0\n ip address 10.0.0.1 255.255.255.0",
+                                   "interface GigabitEthernet0\n shutdown"],
+    "interface GigabitEthernet1": ["interface GigabitEthernet1\n ip address 10.0.1.1 255.255.255.0",
+                                   "interface GigabitEthernet1\n description uplink"],
+    "interface Loopback0": ["interface Loopback0\n ip address 1.1.1.1 255.255.255.255"],
+    "access-list 100": ["access-list 100 deny ip any any", "access-list 100 permit ip any any"],
+    "ip route": ["ip route 0.0.0.0 0.0.0.0 10.0.0.254", "ip route 0.0.0.0 0.0.0.0 10.0.1.254"],
+    "line vty 0 4": ["line vty 0 4\n login local", "line vty 0 4\n transport input ssh"],
+}
+IGNORE_CHOICES = ["hostname", "interface *", "interface GigabitEthernet?", "ip *", "access-list 100", "line*"]
+
+def random_config(rng: random.Random):
+    chosen = {key: rng.choice(options) for key, options in BLOCK_POOL.items() if rng.random() < 0.8}
+    return "\n!\n".join(chosen.values()) + "\n", chosen
+
+@pytest.mark.parametrize("seed", range(20))
+def test_compare_matches_naive_block_comparison(seed):
+    rng = random.Random(seed)
+    engine = DriftEngine()
+    for _ in range(10):
+        golden, expected = random_config(rng)
+        config, actual = random_config(rng)
+        ignore = rng.sample(IGNORE_CHOICES, rng.randint(0, 2))
+        strict = rng.random() < 0.5
+        kept = lambda key: not any(fnmatch.fnmatchcase(key, pattern) for pattern in ignore)
+        missing = [key for key in expected if kept(key) and key not in actual]
+        changed = [key for key in expected if kept(key) and key in actual and actual[key] != expected[key]]
+        extra = [key for key in actual if kept(key) and key not in expected]
+
+        report = engine.compare(config, golden, ignore, strict)
+        assert [entry["block"] for entry in report["missing"]] == missing
+        assert [entry["block"] for entry in report["changed"]] == changed
+        assert report["extra"] == extra
+        assert report["in_sync"] == (not missing and not changed and not (strict and extra))
+
+def test_fleet_uses_majority_as_baseline():
+    engine = DriftEngine()
+    configs = {f"10.0.0.{index}": render(hostname=f"R{index}") for index in range(1, 5)}
+    configs["10.0.0.4"] = render(hostname="R4", interfaces={"GigabitEthernet0": "192.168.1.99",
+                                                            "GigabitEthernet1": "10.0.0.1"})
+    configs["10.0.0.5"] = render(hostname="R5", interfaces={"GigabitEthernet0": "192.168.1.1"})
+
+    result = engine.compare_fleet(configs)
+    assert result["devices"] == 5
+    blocks = {entry["block"]: entry for entry in result["drifted_blocks"]}
+    # ホスト名は機器ごとに異なるので全機器が亜種になる
+    assert blocks["hostname"]["variant_count"] == 4
+
+    interface = blocks["interface GigabitEthernet0"]
+    assert interface["baseline"]["devices"] == 4
+    assert [variant["devices"] for variant in interface["variants"]] == [["10.0.0.4"]]
+    assert "+ ip address 192.168.1.99 255.255.255.0" in interface["variants"][0]["diff"]
+    assert blocks["interface GigabitEthernet1"]["missing"] == ["10.0.0.5"]
+    assert blocks["interface GigabitEthernet1"]["variants"] == []
+    # 基準に一致する機器が少ない (ばらつきの大きい) ブロックほど先に並ぶ
+    assert [entry["block"] for entry in result["drifted_blocks"]] == [
+        "hostname", "interface GigabitEthernet0", "interface GigabitEthernet1"]
+
+    result = engine.compare_fleet(configs, ignore=["hostname"])
+    assert "hostname" not in {entry["block"] for entry in result["drifted_blocks"]}
+    result = engine.compare_fleet(configs, ignore=["hostname", "interface *"])
+    assert result["drifted_blocks"] == []
+    assert result["blocks"] == 4
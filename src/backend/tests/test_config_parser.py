@@ -0,0 +1,44 @@
+# running-configパーサーのテスト
+
+from config_parser import RunningConfigParser
+
+CONFIG = """Building configuration...
+!
+hostname Router
+enable secret 5 $1$mERr$abcdefghijklmnop
+username admin privilege 15 password 0 cisco123
+username ops secret 9 $9$abcdefgh
+snmp-server community public RO
+snmp-server community private RW 10
+snmp-server location lab
+tacacs-server key 7 0822455D0A16
+key chain OSPF
+ key 1
+  key-string OSPFSECRET
+!
+interface GigabitEthernet0
+ ip address 192.168.1.1 255.255.255.0
+!
+line vty 0 4
+ password cisco
+ login
+!
+end
+"""
+
+SECRETS = ("$1$mERr$abcdefghijklmnop", "cisco123", "$9$abcdefgh", "public", "private", "0822455D0A16",
+           "OSPFSECRET", "cisco")
+
+def test_global_secrets_are_redacted():
+    model = RunningConfigParser().parse(CONFIG)
+    lines = model["global"]
+    for secret in SECRETS:
+        assert not any(secret in line.split() for line in lines), secret
+    assert "enable secret <removed>" in lines
+    assert "username admin privilege 15 password <removed>" in lines
+    assert "snmp-server community <removed> RW 10" in lines
+    # 認証情報でない設定と鍵の番号は残す
+    assert "snmp-server location lab" in lines
+    assert any(line.strip() == "key 1" for line in lines)
+    assert "password <removed>" in model["lines"]["vty 0 4"]["config"]
+    assert model["interfaces"]["GigabitEthernet0"]["ip"] == "192.168.1.1"
@@ -0,0 +1,129 @@
+# 診断エンジンの差分再評価のテスト
+
+import random
+
+import pytest
+
+from diagnostics import DiagnosticEngine
+
+INTERFACES = ("GigabitEthernet0", "GigabitEthernet1", "GigabitEthernet2")
+TARGETS = ("10.0.0.2", "10.0.0.3")
+
+def random_fact(rng: random.Random):
+    kind = rng.choice(("interface", "expected_ip", "acl", "ping", "traceroute"))
+    if kind == "interface":
+        name = rng.choice(INTERFACES)
+        return f"interface:{name}", {"name": name, "status": rng.choice(("up", "down", "administratively down")),
+                                     "ip": rng.choice(("192.168.1.1", "192.168.1.2", "unassigned"))}
+    if kind == "expected_ip":
+        return f"expected_ip:{rng.choice(INTERFACES)}", {"ip": rng.choice(("192.168.1.1", "unassigned", None))}
+    if kind == "acl":
+        entries = [rng.choice(("permit ip any any", "deny ip any any", "deny tcp any any eq 23"))
+                   for _ in range(rng.randint(0, 3))]
+        return f"acl:{rng.choice(('100', 'BLOCK'))}", entries
+    if kind == "ping":
+        return f"ping:{rng.choice(TARGETS)}", {"success": rng.random() < 0.5, "packet_loss": rng.choice((0, 60, 100))}
+    hops = [{"hop": hop, "ip": rng.choice(("10.0.0.1", "*"))} for hop in range(1, rng.randint(1, 3) + 1)]
+    return f"traceroute:{rng.choice(TARGETS)}", hops
+
+def full_result(facts):
+    # 毎回新しいエンジンで全ルールを評価した結果を基準とする
+    return DiagnosticEngine().evaluate("router", dict(facts))
+
+@pytest.mark.parametrize("seed", range(20))
+def test_update_facts_matches_full_evaluation(seed):
+    rng = random.Random(seed)
+    engine = DiagnosticEngine()
+    facts = {}
+    for _ in range(60):
+        if facts and rng.random() < 0.2:
+            key = rng.choice(sorted(facts))
+            del facts[key]
+            result = engine.update_facts("router", {}, [key])
+        else:
+            key, value = random_fact(rng)
+            facts[key] = value
+            result = engine.update_facts("router", {key: value})
+        assert result == full_result(facts)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_evaluate_matches_full_evaluation(seed):
+    rng = random.Random(seed)
+    engine = DiagnosticEngine()
+    facts = {}
+    for _ in range(30):
+        key, value = random_fact(rng)
+        facts[key] = value
+        if rng.random() < 0.3:
+            facts.pop(rng.choice(sorted(facts)))
+        assert engine.evaluate("router", dict(facts)) == full_result(facts)
+
+def test_only_affected_rules_are_reevaluated():
+    engine = DiagnosticEngine()
+    facts = {
+        "interface:GigabitEthernet0": {"name": "GigabitEthernet0", "status": "up", "ip": "192.168.1.1"},
+        "expected_ip:GigabitEthernet0": {"ip": "192.168.1.1"},
+        "interface:GigabitEthernet1": {"name": "GigabitEthernet1", "status": "up", "ip": "10.0.0.1"},
+        "acl:100": ["permit ip any any"],
+        "ping:10.0.0.2": {"success": True},
+    }
+    assert engine.evaluate("router", facts)["status"] == "healthy"
+    # interface_down×2, ip_mismatch×2, acl, destination_unreachable
+    assert engine.evaluations == 6
+
+    # 同じ値の再送では何も評価しない
+    engine.evaluate("router", dict(facts))
+    assert engine.evaluations == 6
+
+    # インターフェースの変化はそのインターフェースの2ルールだけ
+    result = engine.update_facts("router", {"interface:GigabitEthernet0": {"name": "GigabitEthernet0", "status": "down",
+                                                                            "ip": "192.168.1.1"}})
+    assert engine.evaluations == 8
+    assert result["status"] == "error"
+    assert [issue["type"] for issue in result["issues"]] == ["interface_down"]
+
+    # 期待IPの変化は ip_mismatch だけ
+    result = engine.update_facts("router", {"expected_ip:GigabitEthernet0": {"ip": "192.168.1.9"}})
+    assert engine.evaluations == 9
+    assert [issue["type"] for issue in result["issues"]] == ["interface_down", "ip_mismatch"]
+
+    # traceroute は ping と同じルールに入力される
+    result = engine.update_facts("router", {"ping:10.0.0.2": {"success": False, "packet_loss": 100},
+                                            "traceroute:10.0.0.2": [{"hop": 1, "ip": "10.0.0.1"}, {"hop": 2, "ip": "*"}]})
+    assert engine.evaluations == 10
+    assert "最後に応答したホップ: 1 (10.0.0.1)" in result["issues"][-1]["description"]
+
+def test_removed_facts_clear_issues():
+    engine = DiagnosticEngine()
+    engine.evaluate("router", {"acl:BLOCK": ["deny ip any any", "permit ip any any"]})
+    assert engine.result("router")["status"] == "warning"
+    result = engine.update_facts("router", {}, ["acl:BLOCK"])
+    assert result["status"] == "healthy"
+    # 存在しないファクトの削除は評価を起こさない
+    evaluations = engine.evaluations
+    engine.update_facts("router", {}, ["acl:BLOCK", "acl:UNKNOWN"])
+    assert engine.evaluations == evaluations
+
+def test_targets_are_independent():
+    engine = DiagnosticEngine()
+    down = {"interface:GigabitEthernet1": {"name": "GigabitEthernet1", "status": "down", "ip": "10.0.0.1"}}
+    engine.evaluate(("10.0.0.1", "scenario-a"), down)
+    engine.evaluate(("10.0.0.1", "scenario-b"), {})
+    assert engine.result(("10.0.0.1", "scenario-a"))["status"] == "error"
+    assert engine.result(("10.0.0.1", "scenario-b"))["status"] == "healthy"
+    engine.forget(("10.0.0.1", "scenario-a"))
+    assert engine.stats()["targets"] == 1
+
+def test_result_order_does_not_depend_on_fact_order():
+    acl = {"acl:100": ["deny ip any any"]}
+    mismatch = {"interface:GigabitEthernet0": {"name": "GigabitEthernet0", "status": "up", "ip": "192.168.1.2"},
+                "expected_ip:GigabitEthernet0": {"ip": "192.168.1.1"}}
+    engine = DiagnosticEngine()
+    engine.update_facts("a", acl)
+    engine.update_facts("a", mismatch)
+    engine.update_facts("b", mismatch)
+    engine.update_facts("b", acl)
+    assert engine.result("a") == engine.result("b")
+    # 同じ深刻度ではエラー扱いの問題が要約に使われる
+    assert engine.result("a")["status"] == "error"
+    assert engine.result("a")["summary"] == "IP設定エラーを検出しました"
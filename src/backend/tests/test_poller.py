@@ -0,0 +1,82 @@
+# ポーリングスケジューラーの同時実行数の制限のテスト
+
+import asyncio
+
+from poller import PollingScheduler
+
+async def wait_for(condition, timeout: float = 2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline
+        await asyncio.sleep(0.005)
+
+class BlockingCollector:
+    # 指定したルーターの収集だけを gate が開くまで止める
+    def __init__(self, blocked: str):
+        self.blocked = blocked
+        self.gate = asyncio.Event()
+        self.calls = []
+
+    async def __call__(self, ip: str):
+        self.calls.append(ip)
+        if ip == self.blocked:
+            await self.gate.wait()
+        return {"ip": ip}
+
+def start_blocked(collector: BlockingCollector) -> PollingScheduler:
+    scheduler = PollingScheduler(collector, interval=30.0, max_concurrency=1)
+    scheduler.start()
+    scheduler.register(collector.blocked)
+    scheduler.poll_soon(collector.blocked)
+    return scheduler
+
+def test_target_unregistered_while_waiting_for_budget_is_skipped():
+    async def scenario():
+        collector = BlockingCollector("10.0.0.1")
+        scheduler = start_blocked(collector)
+        try:
+            await wait_for(lambda: collector.calls == ["10.0.0.1"])
+            # 同時実行数の枠が空くのを待っている間に登録解除する
+            scheduler.register("10.0.0.2")
+            scheduler.poll_soon("10.0.0.2")
+            await asyncio.sleep(0.02)
+            scheduler.unregister("10.0.0.2")
+            collector.gate.set()
+            await wait_for(lambda: scheduler.targets["10.0.0.1"].polls == 1)
+            await asyncio.sleep(0.02)
+            assert collector.calls == ["10.0.0.1"]
+
+            # 読み飛ばした分の枠は返されている
+            scheduler.register("10.0.0.3")
+            scheduler.poll_soon("10.0.0.3")
+            await wait_for(lambda: "10.0.0.3" in collector.calls)
+            assert scheduler.latest("10.0.0.2") is None
+        finally:
+            await scheduler.close()
+
+    asyncio.run(scenario())
+
+def test_target_reregistered_while_waiting_is_polled_once():
+    async def scenario():
+        collector = BlockingCollector("10.0.0.1")
+        scheduler = start_blocked(collector)
+        try:
+            await wait_for(lambda: collector.calls == ["10.0.0.1"])
+            scheduler.register("10.0.0.2")
+            scheduler.poll_soon("10.0.0.2")
+            await asyncio.sleep(0.02)
+            # 再登録・再スケジュールされたルーターは新しいエントリで1回だけ収集する
+            scheduler.unregister("10.0.0.2")
+            scheduler.register("10.0.0.2")
+            scheduler.poll_soon("10.0.0.2")
+            scheduler.poll_soon("10.0.0.2")
+            collector.gate.set()
+            await wait_for(lambda: scheduler.targets["10.0.0.2"].polls == 1)
+            await asyncio.sleep(0.02)
+            assert collector.calls == ["10.0.0.1", "10.0.0.2"]
+            assert scheduler.latest("10.0.0.2").data == {"ip": "10.0.0.2"}
+        finally:
+            await scheduler.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,237 @@
+# セッションの期限管理 (ヒープによるidle/absolute失効) のテスト
+
+import asyncio
+
+import pytest
+
+import sessions
+import shared_state
+from sessions import SessionLimitError, SessionStore
+
+T0 = 1_700_000_000.0
+IDLE = 100.0
+GRACE = IDLE / 4
+
+class Clock:
+    def __init__(self):
+        self.now = T0
+
+    def time(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessions, "time", clock)
+    return clock
+
+def make_store(backend, **options) -> SessionStore:
+    options.setdefault("idle_ttl", IDLE)
+    options.setdefault("absolute_ttl", 10000.0)
+    return SessionStore(backend, **options)
+
+def run(scenario):
+    async def wrapper():
+        backend = shared_state.create_backend("memory")
+        await backend.start()
+        try:
+            await scenario(backend)
+        finally:
+            await backend.close()
+    asyncio.run(wrapper())
+
+async def settle():
+    # touch() が共有状態への書き込みを非同期に行うため、それを待つ
+    await asyncio.sleep(0)
+
+def test_untouched_session_expires_after_idle_ttl_and_grace(clock):
+    async def scenario(backend):
+        removed = []
+
+        async def on_expire(session_id):
+            removed.append(session_id)
+
+        store = make_store(backend, on_expire=on_expire)
+        session_id = await store.create({"ip": "10.0.0.1"}, user="alice")
+        clock.now = T0 + IDLE + GRACE - 1
+        assert await store.expire_due() == 0
+        assert store.get(session_id)["ip"] == "10.0.0.1"
+
+        clock.now = T0 + IDLE + GRACE
+        # 失効の走査を待たずに get() では期限切れとして扱う
+        assert store.get(session_id) is None
+        assert await store.expire_due() == 1
+        assert removed == [session_id]
+        assert session_id not in backend.items("connections")
+        stats = store.stats()
+        assert (stats["sessions"], stats["users"], stats["scheduled"], stats["heap_entries"]) == (0, 0, 0, 0)
+        assert stats["expired"] == 1
+
+    run(scenario)
+
+def test_touch_extends_idle_deadline(clock):
+    async def scenario(backend):
+        store = make_store(backend)
+        session_id = await store.create({}, user="alice")
+
+        # idle_ttl/4 以内の利用は共有状態に書き込まず、ワーカー内の最終利用時刻だけを更新する
+        clock.now = T0 + GRACE - 1
+        assert store.touch(session_id)
+        await settle()
+        assert backend.items("connections")[session_id]["last_seen"] == T0
+
+        clock.now = T0 + 3 * GRACE
+        assert store.touch(session_id)
+        await settle()
+        assert backend.items("connections")[session_id]["last_seen"] == T0 + 3 * GRACE
+
+        # 最後の利用から idle_ttl 以内は失効しない
+        clock.now = T0 + 3 * GRACE + IDLE - 1
+        assert await store.expire_due() == 0
+        assert store.get(session_id) is not None
+        # 期限の延長でヒープにエントリが溜まらない
+        assert store.stats()["heap_entries"] == 1
+
+        clock.now = T0 + 3 * GRACE + IDLE + GRACE
+        assert await store.expire_due() == 1
+        assert not store.touch(session_id)
+
+    run(scenario)
+
+def test_absolute_ttl_caps_active_sessions(clock):
+    async def scenario(backend):
+        store = make_store(backend, absolute_ttl=5 * IDLE)
+        session_id = await store.create({})
+        while clock.now + IDLE / 2 < T0 + 5 * IDLE:
+            clock.now += IDLE / 2
+            assert store.touch(session_id)
+            await settle()
+            assert await store.expire_due() == 0
+        clock.now = T0 + 5 * IDLE
+        assert not store.touch(session_id)
+        assert await store.expire_due() == 1
+
+    run(scenario)
+
+def test_use_on_another_worker_is_honoured_within_grace(clock):
+    async def scenario(backend):
+        # 同じ共有状態を参照する2つのワーカー
+        creator = make_store(backend)
+        other = make_store(backend)
+        session_id = await creator.create({}, user="alice")
+        assert other.get(session_id) is not None
+
+        # 他のワーカーでの利用は最大 idle_ttl/4 遅れて共有状態に反映される
+        last_use = T0
+        for _ in range(20):
+            clock.now += 20.0
+            assert other.touch(session_id)
+            last_use = clock.now
+            await settle()
+            assert await creator.expire_due() == 0
+            assert await other.expire_due() == 0
+
+        # 利用が止まってから idle_ttl の間は、どちらのワーカーも失効させない
+        clock.now = last_use + IDLE - 1
+        assert await creator.expire_due() == 0
+        assert await other.expire_due() == 0
+        assert creator.get(session_id) is not None
+
+        # 猶予を含めた期限を過ぎれば作成元のワーカーでも失効する
+        clock.now = last_use + IDLE + GRACE
+        assert await creator.expire_due() == 1
+        assert other.get(session_id) is None
+        assert other.stats()["scheduled"] == 0
+
+    run(scenario)
+
+def test_many_sessions_expire_in_deadline_order(clock):
+    async def scenario(backend):
+        removed = []
+
+        async def on_expire(session_id):
+            removed.append(session_id)
+
+        store = make_store(backend, on_expire=on_expire)
+        created = []
+        for index in range(50):
+            clock.now = T0 + index
+            created.append(await store.create({"index": index}))
+        # 後半のセッションだけ利用を続ける
+        clock.now = T0 + 60
+        for session_id in created[25:]:
+            store.touch(session_id)
+        await settle()
+
+        clock.now = T0 + 24 + IDLE + GRACE
+        assert await store.expire_due() == 25
+        assert removed == created[:25]
+        assert await store.expire_due() == 0
+        clock.now = T0 + 60 + IDLE + GRACE
+        assert await store.expire_due() == 25
+        assert removed == created
+        assert store.stats()["heap_entries"] == 0
+
+    run(scenario)
+
+def test_closed_sessions_leave_no_schedule(clock):
+    async def scenario(backend):
+        store = make_store(backend)
+        session_id = await store.create({}, user="alice")
+        assert await store.close(session_id)
+        assert not await store.close(session_id)
+        assert await store.update(session_id, ip="10.0.0.1") is None
+        clock.now = T0 + 10 * IDLE
+        assert await store.expire_due() == 0
+        stats = store.stats()
+        assert (stats["closed"], stats["expired"], stats["heap_entries"]) == (1, 0, 0)
+
+    run(scenario)
+
+def test_update_keeps_latest_last_seen(clock):
+    async def scenario(backend):
+        store = make_store(backend)
+        session_id = await store.create({"ip": "10.0.0.1"})
+        clock.now = T0 + GRACE - 1
+        store.touch(session_id)
+        record = await store.update(session_id, ip="10.0.0.2")
+        assert record["ip"] == "10.0.0.2"
+        assert record["last_seen"] == T0 + GRACE - 1
+
+    run(scenario)
+
+def test_session_limits(clock):
+    async def scenario(backend):
+        store = make_store(backend, max_per_user=2, max_sessions=3)
+        first = await store.create({}, user="alice")
+        await store.create({}, user="alice")
+        with pytest.raises(SessionLimitError):
+            await store.create({}, user="alice")
+        await store.create({}, user="bob")
+        # 全体の上限はユーザー名の無い接続にも適用する
+        with pytest.raises(SessionLimitError):
+            await store.create({})
+        assert store.stats()["rejected"] == 2
+
+        # 失効すれば同じユーザーでも再び作成できる
+        await store.close(first)
+        await store.create({}, user="alice")
+
+    run(scenario)
+
+def test_start_tracks_existing_sessions(clock):
+    async def scenario(backend):
+        await backend.set("connections", "session-existing", {"user": "alice", "created": T0, "last_seen": T0})
+        store = make_store(backend, sweep_interval=3600.0)
+        store.start()
+        try:
+            assert store.stats()["scheduled"] == 1
+            store.max_per_user = 1
+            with pytest.raises(SessionLimitError):
+                await store.create({}, user="alice")
+            clock.now = T0 + IDLE + GRACE
+            assert await store.expire_due() == 1
+        finally:
+            await store.stop()
+
+    run(scenario)
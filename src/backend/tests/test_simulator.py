@@ -0,0 +1,64 @@
+# 擬似フリートのアドレス割り当てのテスト
+
+import pytest
+
+import simulator
+from simulator import DEMO_ROUTER_IP, FleetSimulator
+from topology import CORE, TopologyGraph
+
+def build_graph(fleet: FleetSimulator) -> TopologyGraph:
+    graph = TopologyGraph()
+    for ip, router in fleet.routers.items():
+        graph.update_device(ip, router["interfaces"], router.get("masks"), router["info"].get("site"))
+    for link in fleet.links:
+        if link["b_interface"] is None:
+            graph.add_link(link["a"], link["a_interface"], link["b"])
+    return graph
+
+def test_fleet_addresses_do_not_shadow_demo_router():
+    fleet = FleetSimulator(size=100)
+    graph = build_graph(fleet)
+    for name, interface in fleet.routers[DEMO_ROUTER_IP]["interfaces"].items():
+        if interface["ip"] != "unassigned":
+            assert graph.resolve(interface["ip"])["device"] == DEMO_ROUTER_IP
+    # デモ用ルーターはWANコアに繋がっていない
+    assert not graph.path(DEMO_ROUTER_IP, CORE)["reachable"]
+
+def test_largest_fleet_has_unique_addresses():
+    fleet = FleetSimulator(size=FleetSimulator.MAX_LANS)
+    seen = {}
+    for ip, router in fleet.routers.items():
+        for name, interface in router["interfaces"].items():
+            if interface["ip"] != "unassigned":
+                assert interface["ip"] not in seen, (ip, name, seen.get(interface["ip"]))
+                seen[interface["ip"]] = (ip, name)
+
+def test_size_beyond_address_space_is_rejected():
+    with pytest.raises(ValueError):
+        FleetSimulator(size=FleetSimulator.MAX_LANS + 1)
+    with pytest.raises(ValueError):
+        FleetSimulator(size=FleetSimulator.MAX_SITES + 1, routers_per_site=1)
+
+def test_overlap_with_static_router_fails(monkeypatch):
+    generate = FleetSimulator._router
+
+    def colliding(self, index, site, position):
+        router = generate(self, index, site, position)
+        router["interfaces"]["GigabitEthernet2"]["ip"] = "172.16.0.9"
+        return router
+
+    monkeypatch.setattr(FleetSimulator, "_router", colliding)
+    with pytest.raises(ValueError, match="overlaps"):
+        FleetSimulator(size=3)
+
+def test_scenarios_follow_router_addressing():
+    fleet = FleetSimulator(size=60)
+    for ip in ("10.128.0.1", "10.128.0.2", "10.128.1.5"):
+        uplink = fleet.routers[ip]["interfaces"]["GigabitEthernet1"]["ip"]
+        scenario = fleet.scenario(ip, "ip_misconfigured")
+        misconfigured = scenario["interfaces"]["GigabitEthernet1"]["ip"]
+        assert misconfigured != uplink
+        (target, hops), = scenario["traceroute_results"].items()
+        assert hops[0]["ip"] == ip and hops[1]["ip"] == misconfigured
+        assert target in scenario["ping_results"]
+    assert fleet.scenario(DEMO_ROUTER_IP, "healthy") is simulator.SCENARIOS["healthy"]
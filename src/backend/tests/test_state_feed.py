@@ -0,0 +1,178 @@
+# ルーター状態の差分配信 (連番と再同期) のテスト
+
+import copy
+import json
+import random
+
+import pytest
+
+from state_feed import StateFeed, normalize_state
+
+ROUTER = "10.0.0.1"
+INTERFACES = ("GigabitEthernet0", "GigabitEthernet1", "GigabitEthernet1.100", "Loopback0")
+
+def random_state(rng: random.Random):
+    interfaces = {
+        name: {"status": rng.choice(("up", "down")), "ip": rng.choice(("10.0.0.1", "unassigned"))}
+        for name in INTERFACES if rng.random() < 0.8
+    }
+    acls = [{"name": name, "entries": rng.sample(["permit ip any any", "deny ip any any", "deny tcp any any eq 23"],
+                                                 rng.randint(0, 2))}
+            for name in ("100", "BLOCK") if rng.random() < 0.5]
+    return {"info": {"hostname": "Router", "uptime": rng.choice(("1 day", "2 days"))},
+            "interfaces": interfaces, "acls": acls}
+
+def apply_changes(state, changes):
+    for change in changes:
+        *parents, key = change["path"]
+        target = state
+        for name in parents:
+            target = target[name]
+        if change["op"] == "remove":
+            del target[key]
+        else:
+            target[key] = copy.deepcopy(change["new"])
+
+class Client:
+    # 受信したフレームを適用して手元の状態を組み立てる
+    def __init__(self, feed: StateFeed, client_id: str, interfaces=None):
+        self.feed = feed
+        self.client_id = client_id
+        self.resyncs = 0
+        self.apply(feed.subscribe(client_id, ROUTER, interfaces))
+
+    def apply(self, frame):
+        if frame["type"] == "state_snapshot":
+            self.state = copy.deepcopy(frame["state"])
+        else:
+            assert frame["prev_seq"] == self.seq
+            apply_changes(self.state, frame["changes"])
+        self.seq = frame["seq"]
+
+    def receive(self, message: str):
+        frame = json.loads(message)
+        if frame["prev_seq"] != self.seq:
+            # 欠番を検出したら再同期を要求する
+            self.resyncs += 1
+            frame = self.feed.resync(self.client_id, ROUTER, self.seq)
+        self.apply(frame)
+
+def expected_view(state, interfaces=None):
+    snapshot = normalize_state(state)
+    if interfaces is None:
+        return snapshot
+    return {"interfaces": {name: value for name, value in snapshot["interfaces"].items() if name in interfaces}}
+
+@pytest.mark.parametrize("seed", range(20))
+def test_clients_reconstruct_state_with_drops_and_resync(seed):
+    rng = random.Random(seed)
+    feed = StateFeed(history_size=4)
+    state = random_state(rng)
+    feed.publish(ROUTER, state)
+    filters = {"all": None, "gi1": ["GigabitEthernet1", "GigabitEthernet1.100"], "lo": ["Loopback0"]}
+    clients = {client_id: Client(feed, client_id, interfaces) for client_id, interfaces in filters.items()}
+    for client_id, client in clients.items():
+        assert client.state == expected_view(state, filters[client_id])
+
+    for _ in range(80):
+        state = random_state(rng)
+        for client_id, message in feed.publish(ROUTER, state):
+            # 一部のフレームは届かなかったものとする
+            if rng.random() < 0.25:
+                continue
+            clients[client_id].receive(message)
+        if rng.random() < 0.1:
+            # 受信していない差分は届いた時点で再同期されるため、ここで明示的に追いつかせる
+            for client in clients.values():
+                client.apply(feed.resync(client.client_id, ROUTER, client.seq))
+            for client_id, client in clients.items():
+                assert client.state == expected_view(state, filters[client_id])
+
+    for client in clients.values():
+        client.apply(feed.resync(client.client_id, ROUTER, client.seq))
+    for client_id, client in clients.items():
+        assert client.state == expected_view(state, filters[client_id])
+        assert client.seq == feed.version(ROUTER)
+    assert sum(client.resyncs for client in clients.values()) > 0
+
+def test_sequence_numbers_and_prev_seq():
+    feed = StateFeed()
+    state = {"info": {"hostname": "R1"}, "interfaces": {"GigabitEthernet0": {"status": "up"}}, "acls": []}
+    assert feed.publish(ROUTER, copy.deepcopy(state)) == []
+    assert feed.has_state(ROUTER) and feed.version(ROUTER) == 0
+    assert feed.subscribe("c1", ROUTER)["seq"] == 0
+
+    # 変化が無ければ連番は進まない
+    assert feed.publish(ROUTER, copy.deepcopy(state)) == []
+    assert feed.version(ROUTER) == 0
+
+    state["interfaces"]["GigabitEthernet0"]["status"] = "down"
+    # 収集した状態は毎回新しい辞書として渡される
+    [(client_id, message)] = feed.publish(ROUTER, copy.deepcopy(state))
+    frame = json.loads(message)
+    assert client_id == "c1"
+    assert (frame["seq"], frame["prev_seq"]) == (1, 0)
+    assert frame["changes"] == [{"op": "change", "path": ["interfaces", "GigabitEthernet0", "status"],
+                                 "old": "up", "new": "down"}]
+
+    state["acls"] = [{"name": "100", "entries": ["deny ip any any"]}]
+    frame = json.loads(feed.publish(ROUTER, copy.deepcopy(state))[0][1])
+    assert (frame["seq"], frame["prev_seq"]) == (2, 1)
+    assert frame["changes"] == [{"op": "add", "path": ["acls", "100"], "new": ["deny ip any any"]}]
+
+def test_filtered_subscription_skips_unrelated_changes():
+    feed = StateFeed()
+    state = {"info": {"uptime": "1"}, "interfaces": {"GigabitEthernet0": {"status": "up"},
+                                                    "GigabitEthernet1": {"status": "up"}}}
+    feed.publish(ROUTER, copy.deepcopy(state))
+    snapshot = feed.subscribe("c1", ROUTER, ["GigabitEthernet1"])
+    assert snapshot["state"] == {"interfaces": {"GigabitEthernet1": {"status": "up"}}}
+
+    state["info"]["uptime"] = "2"
+    state["interfaces"]["GigabitEthernet0"]["status"] = "down"
+    assert feed.publish(ROUTER, copy.deepcopy(state)) == []
+
+    # 送られなかった差分の分だけ連番が飛ぶが、prev_seqは前回送った連番なので欠番にはならない
+    state["interfaces"]["GigabitEthernet1"]["status"] = "down"
+    frame = json.loads(feed.publish(ROUTER, copy.deepcopy(state))[0][1])
+    assert (frame["seq"], frame["prev_seq"]) == (2, 0)
+    assert [change["path"] for change in frame["changes"]] == [["interfaces", "GigabitEthernet1", "status"]]
+
+def test_resync_returns_missing_deltas_or_snapshot():
+    feed = StateFeed(history_size=3)
+    feed.publish(ROUTER, {"interfaces": {"GigabitEthernet0": {"status": "0"}}})
+    feed.subscribe("c1", ROUTER)
+    for value in range(1, 6):
+        feed.publish(ROUTER, {"interfaces": {"GigabitEthernet0": {"status": str(value)}}})
+    assert feed.version(ROUTER) == 5
+
+    # 履歴 (連番3〜5) に残っている範囲は差分をまとめて返す
+    frame = feed.resync("c1", ROUTER, 2)
+    assert frame["type"] == "state_delta"
+    assert (frame["seq"], frame["prev_seq"]) == (5, 2)
+    assert [change["new"] for change in frame["changes"]] == ["3", "4", "5"]
+    assert feed.resync("c1", ROUTER, 5)["changes"] == []
+
+    # 履歴から外れた連番や未来の連番にはスナップショットを返す
+    for since in (1, 0, 6):
+        frame = feed.resync("c1", ROUTER, since)
+        assert frame["type"] == "state_snapshot"
+        assert frame["seq"] == 5
+        assert frame["state"]["interfaces"] == {"GigabitEthernet0": {"status": "5"}}
+
+    assert feed.resync("unknown", ROUTER, 0) is None
+    assert feed.resync("c1", "10.9.9.9", 0) is None
+    feed.unsubscribe("c1")
+    assert feed.resync("c1", ROUTER, 5) is None
+
+def test_identical_frames_are_encoded_once():
+    feed = StateFeed()
+    feed.publish(ROUTER, {"interfaces": {"GigabitEthernet0": {"status": "up"}}})
+    for client_id in ("c1", "c2", "c3"):
+        feed.subscribe(client_id, ROUTER)
+    feed.subscribe("c4", ROUTER, ["GigabitEthernet0"])
+    deliveries = feed.publish(ROUTER, {"interfaces": {"GigabitEthernet0": {"status": "down"}}})
+    assert sorted(client_id for client_id, _ in deliveries) == ["c1", "c2", "c3", "c4"]
+    assert len({message for _, message in deliveries}) == 1
+    stats = feed.stats()
+    assert stats["frames_encoded"] == 2 and stats["frames_sent"] == 4
@@ -0,0 +1,166 @@
+# 時系列ストアのリングバッファとダウンサンプリングのテスト
+
+import asyncio
+import math
+import random
+
+import pytest
+
+from timeseries import MAX_PENDING_SAMPLES, TimeSeriesStore, _percentile
+
+KEY = ("10.0.0.1", "GigabitEthernet0", "rx_bps")
+BASE = 1_700_000_000 - 1_700_000_000 % 3600
+
+def record(store: TimeSeriesStore, points):
+    for timestamp, value in points:
+        assert store.record(*KEY, value, timestamp)
+
+def naive_buckets(points, width):
+    buckets = {}
+    for timestamp, value in points:
+        buckets.setdefault(timestamp - timestamp % width, []).append(value)
+    return buckets
+
+def test_raw_ring_keeps_newest_points_in_order():
+    store = TimeSeriesStore(raw_capacity=5)
+    points = [(BASE + i, float(i)) for i in range(13)]
+    record(store, points)
+    result = store.query(*KEY, start=BASE, end=BASE + 100, resolution="raw")
+    assert result["points"] == [{"t": t, "value": v} for t, v in points[-5:]]
+    assert result["aggregate"]["count"] == 5
+    assert result["aggregate"]["min"] == 8.0 and result["aggregate"]["max"] == 12.0
+
+@pytest.mark.parametrize("seed", range(5))
+def test_minute_downsampling_matches_raw_values(seed):
+    rng = random.Random(seed)
+    store = TimeSeriesStore(raw_capacity=1000, minute_capacity=60)
+    points = []
+    timestamp = BASE
+    for _ in range(400):
+        timestamp += rng.randint(0, 4)
+        points.append((timestamp, rng.uniform(0, 1000)))
+    record(store, points)
+    store.roll_up(timestamp + 60)
+
+    result = store.query(*KEY, start=BASE, end=timestamp, resolution="1m")
+    expected = naive_buckets(points, 60)
+    assert [point["t"] for point in result["points"]] == sorted(expected)
+    for point in result["points"]:
+        values = expected[point["t"]]
+        assert point["count"] == len(values)
+        assert point["min"] == min(values)
+        assert point["max"] == max(values)
+        assert point["avg"] == pytest.approx(sum(values) / len(values))
+        assert point["p95"] == _percentile(values, 0.95)
+    assert result["aggregate"]["count"] == len(points)
+
+def test_hour_downsampling_from_minutes():
+    store = TimeSeriesStore(raw_capacity=10, minute_capacity=300, hour_capacity=24)
+    points = [(BASE + i * 10, float(i % 97)) for i in range(3 * 360)]
+    record(store, points)
+    # 最後の1時間は報告が止まった後のタイマーで確定する
+    end = points[-1][0]
+    store.roll_up(end + 3600)
+
+    minutes = store.query(*KEY, start=BASE, end=end, resolution="1m")["points"]
+    result = store.query(*KEY, start=BASE, end=end, resolution="1h")
+    expected = naive_buckets(points, 3600)
+    assert [point["t"] for point in result["points"]] == sorted(expected)
+    for point in result["points"]:
+        values = expected[point["t"]]
+        assert point["count"] == len(values)
+        assert point["min"] == min(values)
+        assert point["max"] == max(values)
+        assert point["avg"] == pytest.approx(sum(values) / len(values))
+        # 1時間のp95は1分ごとのp95から近似する
+        minute_p95 = [minute["p95"] for minute in minutes if point["t"] <= minute["t"] < point["t"] + 3600]
+        assert point["p95"] == _percentile(minute_p95, 0.95)
+
+def test_roll_up_closes_only_finished_buckets():
+    store = TimeSeriesStore()
+    record(store, [(BASE + 5, 1.0), (BASE + 30, 3.0)])
+    store.roll_up(BASE + 59)
+    assert store.query(*KEY, start=BASE, end=BASE + 3600, resolution="1m")["points"] == []
+    store.roll_up(BASE + 60)
+    minutes = store.query(*KEY, start=BASE, end=BASE + 3600, resolution="1m")["points"]
+    assert [(point["t"], point["avg"], point["count"]) for point in minutes] == [(BASE, 2.0, 2)]
+    # 1時間のバケットは時間が終わるまで確定しない
+    assert store.query(*KEY, start=BASE, end=BASE + 3600, resolution="1h")["points"] == []
+    store.roll_up(BASE + 3600)
+    hours = store.query(*KEY, start=BASE, end=BASE + 3600, resolution="1h")["points"]
+    assert [(point["t"], point["count"]) for point in hours] == [(BASE, 2)]
+
+    # 確定済みのバケットは二重に追加されない
+    store.roll_up(BASE + 7200)
+    assert len(store.query(*KEY, start=BASE, end=BASE + 7200, resolution="1h")["points"]) == 1
+
+def test_minute_ring_rollover():
+    store = TimeSeriesStore(minute_capacity=3)
+    record(store, [(BASE + minute * 60, float(minute)) for minute in range(6)])
+    store.roll_up(BASE + 6 * 60)
+    minutes = store.query(*KEY, start=BASE, end=BASE + 3600, resolution="1m")["points"]
+    assert [point["t"] for point in minutes] == [BASE + 180, BASE + 240, BASE + 300]
+    assert [point["max"] for point in minutes] == [3.0, 4.0, 5.0]
+
+def test_pending_samples_are_bounded():
+    store = TimeSeriesStore(raw_capacity=10)
+    values = [float(i) for i in range(MAX_PENDING_SAMPLES * 2)]
+    record(store, [(BASE, value) for value in values])
+    store.roll_up(BASE + 60)
+    minute = store.query(*KEY, start=BASE, end=BASE + 60, resolution="1m")["points"][0]
+    # min/max/avg/countは全件から正確に求め、p95は上限件数までのサンプルから求める
+    assert minute["count"] == len(values)
+    assert minute["max"] == values[-1]
+    assert minute["avg"] == pytest.approx(sum(values) / len(values))
+    assert minute["p95"] == _percentile(values[:MAX_PENDING_SAMPLES], 0.95)
+    assert store.stats()["buffer_bytes"] <= store.stats()["max_buffer_bytes"]
+
+def test_large_counter_values_are_not_rounded():
+    store = TimeSeriesStore()
+    value = float(2 ** 53 - 1)
+    record(store, [(BASE, value), (BASE + 1, value - 1)])
+    points = store.query(*KEY, start=BASE, end=BASE + 1, resolution="raw")["points"]
+    assert [point["value"] for point in points] == [value, value - 1]
+
+def test_auto_resolution_picks_finest_covering_tier():
+    store = TimeSeriesStore(raw_capacity=60, minute_capacity=120)
+    record(store, [(BASE + i * 10, 1.0) for i in range(360)])
+    end = BASE + 3590
+    store.roll_up(end)
+    assert store.query(*KEY, start=end - 300, end=end)["resolution"] == "raw"
+    assert store.query(*KEY, start=BASE + 1800, end=end)["resolution"] == "1m"
+    # どの解像度も届かない場合は最も長い期間を持つ解像度を使う
+    assert store.query(*KEY, start=BASE - 86400, end=end)["resolution"] == "1m"
+    with pytest.raises(ValueError):
+        store.query(*KEY, resolution="5m")
+
+def test_series_limit_rejects_new_series():
+    store = TimeSeriesStore(max_series=2)
+    assert store.record("10.0.0.1", "Gi0", "rx_bps", 1.0, BASE)
+    assert store.record("10.0.0.1", "Gi1", "rx_bps", 1.0, BASE)
+    assert not store.record("10.0.0.2", "Gi0", "rx_bps", 1.0, BASE)
+    # 既存の系列への記録は続けられる
+    assert store.record("10.0.0.1", "Gi0", "rx_bps", 2.0, BASE + 1)
+    stats = store.stats()
+    assert stats["series"] == 2 and stats["rejected"] == 1
+    assert store.series("10.0.0.2") == []
+    empty = store.query("10.0.0.2", "Gi0", "rx_bps", start=BASE, end=BASE + 1)
+    assert empty["points"] == [] and empty["aggregate"]["count"] == 0
+
+def test_background_roll_up_closes_stalled_series():
+    async def scenario():
+        store = TimeSeriesStore()
+        record(store, [(BASE, 4.0)])
+        store.start(interval=0.01)
+        try:
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if store.query(*KEY, start=BASE, end=BASE + 3600, resolution="1h")["points"]:
+                    break
+        finally:
+            await store.close()
+        hours = store.query(*KEY, start=BASE, end=BASE + 3600, resolution="1h")["points"]
+        assert [(point["t"], point["avg"]) for point in hours] == [(BASE, 4.0)]
+        assert not math.isnan(hours[0]["p95"])
+
+    asyncio.run(scenario())
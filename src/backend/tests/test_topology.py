@@ -0,0 +1,150 @@
+# トポロジーの最短経路木の差分修復のテスト (毎回作り直した木と比較する)
+
+import random
+from collections import deque
+
+import pytest
+
+from simulator import DEMO_ROUTER_IP, FleetSimulator
+from topology import CORE, TopologyGraph, node_type
+
+def build(fleet: FleetSimulator, max_trees: int = 256) -> TopologyGraph:
+    graph = TopologyGraph(max_trees=max_trees)
+    for ip, router in fleet.routers.items():
+        graph.update_device(ip, router["interfaces"], router.get("masks"), router["info"].get("site"))
+    for link in fleet.links:
+        if link["b_interface"] is None:
+            graph.add_link(link["a"], link["a_interface"], link["b"])
+    return graph
+
+def bfs(graph: TopologyGraph, source: str):
+    dist = {source: 0}
+    queue = deque([source])
+    while queue:
+        node = queue.popleft()
+        for neighbor in graph._adjacency.get(node, ()):
+            if neighbor not in dist:
+                dist[neighbor] = dist[node] + 1
+                queue.append(neighbor)
+    return dist
+
+def assert_trees_match_bfs(graph: TopologyGraph):
+    for source, tree in graph._trees.items():
+        expected = bfs(graph, source)
+        assert tree.dist == expected, source
+        # 親は隣接していて1つ近いノード、子の集合は親の逆引きと一致する
+        for node, parent in tree.parent.items():
+            if node == source:
+                assert parent is None
+                continue
+            assert parent in graph._adjacency[node]
+            assert tree.dist[parent] == tree.dist[node] - 1
+            assert node in tree.children[parent]
+        for parent, children in tree.children.items():
+            for child in children:
+                assert tree.parent.get(child) == parent
+
+def set_state(graph: TopologyGraph, fleet: FleetSimulator, device: str, name: str, up: bool):
+    interface = fleet.routers[device]["interfaces"][name]
+    mask = fleet.routers[device].get("masks", {}).get(name)
+    graph.set_interface(device, name, interface["ip"], mask, up)
+
+@pytest.fixture
+def fleet():
+    # 3拠点 x 5台 (各拠点の先頭がハブ)
+    return FleetSimulator(size=15, routers_per_site=5)
+
+def warm(graph: TopologyGraph, sources):
+    for source in sources:
+        graph.reachability(source)
+
+SOURCES = [CORE, "10.128.0.1", "10.128.0.3", "10.128.2.5", DEMO_ROUTER_IP]
+
+@pytest.mark.parametrize("device,name", [
+    ("10.128.0.1", "GigabitEthernet1"),  # ハブのWAN
+    ("10.128.0.1", "GigabitEthernet2"),  # ハブの拠点セグメント
+    ("10.128.0.1", "GigabitEthernet0"),  # ハブの管理セグメント
+    ("10.128.0.3", "GigabitEthernet1"),  # 配下のルーターの上流 (管理セグメントで迂回できる)
+    ("10.128.0.3", "GigabitEthernet0"),
+])
+def test_single_link_down_and_up(fleet, device, name):
+    graph = build(fleet)
+    warm(graph, SOURCES)
+    set_state(graph, fleet, device, name, False)
+    assert_trees_match_bfs(graph)
+    set_state(graph, fleet, device, name, True)
+    assert_trees_match_bfs(graph)
+    assert graph.repairs > 0
+
+def test_spoke_isolated_when_both_uplinks_fail(fleet):
+    graph = build(fleet)
+    warm(graph, SOURCES)
+    set_state(graph, fleet, "10.128.0.3", "GigabitEthernet1", False)
+    assert graph.path(CORE, "10.128.0.3")["reachable"]
+    set_state(graph, fleet, "10.128.0.3", "GigabitEthernet0", False)
+    assert not graph.path(CORE, "10.128.0.3")["reachable"]
+    assert_trees_match_bfs(graph)
+    set_state(graph, fleet, "10.128.0.3", "GigabitEthernet0", True)
+    assert graph.path(CORE, "10.128.0.3")["reachable"]
+    assert_trees_match_bfs(graph)
+
+@pytest.mark.parametrize("seed", range(10))
+def test_random_link_sequences(fleet, seed):
+    rng = random.Random(seed)
+    graph = build(fleet)
+    warm(graph, SOURCES)
+    interfaces = [(ip, name) for ip, router in fleet.routers.items() if ip != DEMO_ROUTER_IP
+                  for name in ("GigabitEthernet0", "GigabitEthernet1", "GigabitEthernet2")]
+    state = {key: True for key in interfaces}
+    for _ in range(60):
+        key = rng.choice(interfaces)
+        state[key] = not state[key]
+        set_state(graph, fleet, *key, state[key])
+        assert_trees_match_bfs(graph)
+        if rng.random() < 0.2:
+            # 途中で新しい始点の木もキャッシュする
+            warm(graph, [rng.choice(interfaces)[0]])
+
+@pytest.mark.parametrize("device,name", [
+    ("10.128.0.1", "GigabitEthernet1"),
+    ("10.128.0.1", "GigabitEthernet0"),
+    ("10.128.1.1", "GigabitEthernet2"),
+    ("10.128.0.3", "GigabitEthernet1"),
+])
+def test_impact_matches_recomputation(fleet, device, name):
+    graph = build(fleet)
+    # ハブの管理セグメントを落として迂回路を減らした状態でも比較する
+    for prepared in ([], [("10.128.0.1", "GigabitEthernet0")]):
+        if (device, name) in prepared:
+            continue
+        for key in prepared:
+            set_state(graph, fleet, *key, False)
+        before = {node for node in bfs(graph, CORE) if node_type(node) == "device"}
+        result = graph.impact(device, name)
+        # グラフは変更しない
+        assert graph.devices[device][name].up
+        set_state(graph, fleet, device, name, False)
+        after = {node for node in bfs(graph, CORE) if node_type(node) == "device"}
+        set_state(graph, fleet, device, name, True)
+        assert set(result["lost_devices"]) == before - after
+        assert_trees_match_bfs(graph)
+
+def test_tree_cache_evicts_least_recently_used(fleet):
+    graph = build(fleet, max_trees=2)
+    graph.reachability(CORE)
+    graph.reachability("10.128.0.1")
+    assert graph.stats()["tree_builds"] == 2
+    # 使った木は最近使ったものとして残る
+    graph.reachability(CORE)
+    graph.reachability("10.128.1.1")
+    assert list(graph._trees) == [CORE, "10.128.1.1"]
+    assert graph.stats()["cached_trees"] == 2
+    assert graph.stats()["tree_builds"] == 3
+    # 追い出された木は作り直す
+    graph.reachability("10.128.0.1")
+    assert graph.stats()["tree_builds"] == 4
+    assert list(graph._trees) == ["10.128.1.1", "10.128.0.1"]
+    # 追い出された木は修復の対象にならず、作り直した木は最新のグラフと一致する
+    set_state(graph, fleet, "10.128.0.1", "GigabitEthernet1", False)
+    graph.reachability(CORE)
+    assert_trees_match_bfs(graph)
@@ -0,0 +1,176 @@
+# 疑似IOSサーバーに対するセッションプールのテスト
+
+import asyncio
+
+import pytest
+
+from fake_ios import FakeIOSServer
+from transport import AuthenticationError, DeviceParams, SessionPool, TransportError
+
+def params_for(server: FakeIOSServer, connection_type: str, **overrides) -> DeviceParams:
+    options = {
+        "username": server.username,
+        "password": server.password,
+        "enable_password": server.enable_password,
+        "connection_type": connection_type,
+        "port": server.ssh_port if connection_type == "ssh" else server.telnet_port,
+    }
+    options.update(overrides)
+    return DeviceParams(server.host, **options)
+
+async def start(server: FakeIOSServer, connection_type: str, tmp_path) -> SessionPool:
+    if connection_type == "ssh":
+        await server.start_ssh()
+        # 疑似サーバーのホスト鍵だけを信頼する
+        known_hosts = tmp_path / "known_hosts"
+        known_hosts.write_text(server.known_hosts_entry())
+        return SessionPool(command_timeout=2.0, known_hosts=str(known_hosts))
+    await server.start_telnet()
+    return SessionPool(command_timeout=2.0)
+
+@pytest.mark.parametrize("connection_type", ["ssh", "telnet"])
+def test_run_reuses_session(connection_type, tmp_path):
+    async def scenario():
+        server = FakeIOSServer()
+        pool = await start(server, connection_type, tmp_path)
+        try:
+            params = params_for(server, connection_type)
+            output = await pool.run(params, "show version")
+            assert "Version 15.7(3)M2" in output
+            assert "GigabitEthernet0" in await pool.run(params, "show ip interface brief")
+            stats = pool.stats()[f"{connection_type}://{server.host}:{params.port}"]
+            assert stats == {"idle": 1, "in_use": 0, "created": 1, "reused": 1}
+            assert server.connections == 1
+        finally:
+            await pool.close()
+            await server.close()
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("connection_type", ["ssh", "telnet"])
+def test_run_batch(connection_type, tmp_path):
+    async def scenario():
+        server = FakeIOSServer()
+        pool = await start(server, connection_type, tmp_path)
+        try:
+            params = params_for(server, connection_type)
+            results = [item async for item in pool.run_batch(params, ["show version", "show running-config", "show foo"])]
+            assert [command for command, _ in results] == ["show version", "show running-config", "show foo"]
+            assert "Version 15.7(3)M2" in results[0][1]
+            assert "Invalid input" in results[2][1]
+            assert server.connections == 1
+        finally:
+            await pool.close()
+            await server.close()
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("connection_type", ["ssh", "telnet"])
+def test_authentication_failure(connection_type, tmp_path):
+    async def scenario():
+        server = FakeIOSServer()
+        pool = await start(server, connection_type, tmp_path)
+        try:
+            params = params_for(server, connection_type, password="wrong")
+            with pytest.raises(AuthenticationError):
+                await pool.verify(params)
+            stats = pool.stats()[f"{connection_type}://{server.host}:{params.port}"]
+            assert stats["idle"] == 0 and stats["in_use"] == 0
+        finally:
+            await pool.close()
+            await server.close()
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("connection_type", ["ssh", "telnet"])
+def test_enable_failure(connection_type, tmp_path):
+    async def scenario():
+        server = FakeIOSServer()
+        pool = await start(server, connection_type, tmp_path)
+        try:
+            with pytest.raises(AuthenticationError):
+                await pool.verify(params_for(server, connection_type, enable_password="wrong"))
+        finally:
+            await pool.close()
+            await server.close()
+
+    asyncio.run(scenario())
+
+def test_unknown_host_key_is_rejected(tmp_path):
+    async def scenario():
+        server = FakeIOSServer()
+        await server.start_ssh()
+        known_hosts = tmp_path / "known_hosts"
+        known_hosts.write_text("")
+        pool = SessionPool(command_timeout=2.0, known_hosts=str(known_hosts))
+        try:
+            with pytest.raises(TransportError):
+                await pool.verify(params_for(server, "ssh"))
+        finally:
+            await pool.close()
+            await server.close()
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("connection_type", ["ssh", "telnet"])
+def test_cancelled_command_discards_session(connection_type, tmp_path):
+    async def scenario():
+        server = FakeIOSServer(response_delay=0.5)
+        pool = await start(server, connection_type, tmp_path)
+        try:
+            params = params_for(server, connection_type)
+            task = asyncio.create_task(pool.run(params, "show version"))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # 応答待ちのまま取り消したセッションは再利用せず、次のコマンドは新しいセッションで実行する
+            stats = pool.stats()[f"{connection_type}://{server.host}:{params.port}"]
+            assert stats["idle"] == 0 and stats["in_use"] == 0
+            assert "Version 15.7(3)M2" in await pool.run(params, "show version")
+            assert server.connections == 2
+        finally:
+            await pool.close()
+            await server.close()
+
+    asyncio.run(scenario())
+
+def test_maintenance_concurrent_with_checkout(tmp_path):
+    async def scenario():
+        server = FakeIOSServer(response_delay=0.01)
+        await server.start_telnet()
+        pool = SessionPool(max_sessions_per_device=2, idle_timeout=0.2, keepalive_interval=0.0,
+                           command_timeout=2.0)
+        try:
+            params = params_for(server, "telnet")
+            checked_out = []
+
+            async def worker():
+                for _ in range(10):
+                    async with pool.session(params) as session:
+                        # 同じセッションが同時に2つの呼び出しに渡されてはならない
+                        assert session not in checked_out
+                        checked_out.append(session)
+                        await session.run("show version")
+                        checked_out.remove(session)
+
+            async def maintainer():
+                for _ in range(20):
+                    await pool._maintain()
+                    await asyncio.sleep(0)
+
+            await asyncio.gather(worker(), worker(), worker(), maintainer())
+            stats = pool.stats()[f"telnet://{server.host}:{params.port}"]
+            assert stats["in_use"] == 0
+            assert stats["idle"] <= 2
+            assert all(session.is_alive for session in pool._pools[params.key].idle)
+
+            # アイドル時間を超えたセッションは閉じ、使われていないプールは破棄する
+            await asyncio.sleep(0.3)
+            await pool._maintain()
+            assert pool.stats() == {}
+        finally:
+            await pool.close()
+            await server.close()
+
+    asyncio.run(scenario())
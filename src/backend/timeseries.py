@@ -0,0 +1,280 @@
+# インターフェースカウンターやPing RTTの時系列ストア
+# (ルーター, インターフェース, メトリクス) ごとに固定長のリングバッファを持ち、
+# 生データ → 1分 → 1時間の順に自動でダウンサンプリングする
+# 値は array の float64 (カウンターの値を丸めないため)、時刻は uint32 (UNIX秒) で保持し、メモリ使用量を系列数に比例させる
+# 報告が止まった系列も集計されるよう、終了した分・時間のバケットは start() のタイマーでも確定する
+
+import asyncio
+import logging
+import math
+import time
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+SeriesKey = Tuple[str, str, str]
+
+# 1バケットあたりのパーセンタイル計算に使う生データの上限 (系列あたりのメモリの上限に含める)
+MAX_PENDING_SAMPLES = 256
+
+RESOLUTIONS = {"raw": 0, "1m": 60, "1h": 3600}
+
+def _percentile(values: Sequence[float], q: float) -> float:
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(0, math.ceil(q * len(ordered)) - 1)
+    return ordered[rank]
+
+class _Ring:
+    # 固定長のリングバッファ - 列は1つのarrayに行単位で交互に並べる
+    __slots__ = ("capacity", "width", "times", "values", "start", "size")
+
+    def __init__(self, capacity: int, width: int):
+        self.capacity = capacity
+        self.width = width
+        self.times = array("I", bytes(array("I").itemsize * capacity))
+        self.values = array("d", bytes(array("d").itemsize * capacity * width))
+        self.start = 0
+        self.size = 0
+
+    def append(self, timestamp: int, *values: float):
+        if self.size < self.capacity:
+            index = (self.start + self.size) % self.capacity
+            self.size += 1
+        else:
+            # 満杯の場合は最も古い点を上書きする
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[index] = timestamp
+        base = index * self.width
+        self.values[base:base + self.width] = array("d", values)
+
+    def oldest(self) -> Optional[int]:
+        return self.times[self.start] if self.size else None
+
+    def range(self, start: int, end: int) -> List[Tuple[int, Tuple[float, ...]]]:
+        points = []
+        for offset in range(self.size):
+            index = (self.start + offset) % self.capacity
+            timestamp = self.times[index]
+            if start <= timestamp <= end:
+                base = index * self.width
+                points.append((timestamp, tuple(self.values[base:base + self.width])))
+        return points
+
+    def nbytes(self) -> int:
+        return self.times.itemsize * len(self.times) + self.values.itemsize * len(self.values)
+
+class _Bucket:
+    # 集計中のバケット (min/max/sum/countは正確、p95は上限件数までのサンプルから計算)
+    __slots__ = ("start", "minimum", "maximum", "total", "count", "samples")
+
+    def __init__(self, start: int):
+        self.start = start
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.total = 0.0
+        self.count = 0
+        self.samples = array("d")
+
+    def add(self, minimum: float, maximum: float, total: float, count: int, sample: float):
+        self.minimum = min(self.minimum, minimum)
+        self.maximum = max(self.maximum, maximum)
+        self.total += total
+        self.count += count
+        if len(self.samples) < MAX_PENDING_SAMPLES:
+            self.samples.append(sample)
+
+class Series:
+    __slots__ = ("raw", "minute", "hour", "pending_minute", "pending_hour")
+
+    def __init__(self, raw_capacity: int, minute_capacity: int, hour_capacity: int):
+        self.raw = _Ring(raw_capacity, 1)
+        # 列: min, max, sum, count, p95
+        self.minute = _Ring(minute_capacity, 5)
+        self.hour = _Ring(hour_capacity, 5)
+        self.pending_minute: Optional[_Bucket] = None
+        self.pending_hour: Optional[_Bucket] = None
+
+    def tier(self, width: int) -> _Ring:
+        return self.minute if width == 60 else self.hour
+
+    def record(self, timestamp: int, value: float):
+        self.raw.append(timestamp, value)
+        bucket = self.pending_minute
+        if bucket is not None and bucket.start != timestamp - timestamp % 60:
+            closed = self._close(self.minute, bucket)
+            self._feed_hour(bucket, closed)
+            bucket = None
+        if bucket is None:
+            bucket = self.pending_minute = _Bucket(timestamp - timestamp % 60)
+        bucket.add(value, value, value, 1, value)
+
+    def _feed_hour(self, minute: _Bucket, minute_p95: float):
+        # 1時間バケットのp95は1分ごとのp95から近似する
+        bucket = self.pending_hour
+        if bucket is not None and bucket.start != minute.start - minute.start % 3600:
+            self._close(self.hour, bucket)
+            bucket = None
+        if bucket is None:
+            bucket = self.pending_hour = _Bucket(minute.start - minute.start % 3600)
+        bucket.add(minute.minimum, minute.maximum, minute.total, minute.count, minute_p95)
+
+    def roll_up(self, now: int):
+        # 新しい値が来なくても、終了した分・時間のバケットを確定する
+        bucket = self.pending_minute
+        if bucket is not None and bucket.start + 60 <= now:
+            closed = self._close(self.minute, bucket)
+            self._feed_hour(bucket, closed)
+            self.pending_minute = None
+        bucket = self.pending_hour
+        if bucket is not None and bucket.start + 3600 <= now and self.pending_minute is None:
+            self._close(self.hour, bucket)
+            self.pending_hour = None
+
+    @staticmethod
+    def _close(ring: _Ring, bucket: _Bucket) -> float:
+        p95 = _percentile(bucket.samples, 0.95)
+        ring.append(bucket.start, bucket.minimum, bucket.maximum, bucket.total, bucket.count, p95)
+        return p95
+
+    def nbytes(self) -> int:
+        pending = sum(bucket.samples.itemsize * len(bucket.samples)
+                      for bucket in (self.pending_minute, self.pending_hour) if bucket is not None)
+        return self.raw.nbytes() + self.minute.nbytes() + self.hour.nbytes() + pending
+
+class TimeSeriesStore:
+    def __init__(self, raw_capacity: int = 60, minute_capacity: int = 60, hour_capacity: int = 24,
+                 max_series: int = 50000):
+        self.raw_capacity = raw_capacity
+        self.minute_capacity = minute_capacity
+        self.hour_capacity = hour_capacity
+        self.max_series = max_series
+        self._series: Dict[SeriesKey, Series] = {}
+        self.rejected = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, router: str, interface: str, metric: str, value: float,
+               timestamp: Optional[float] = None) -> bool:
+        key = (router, interface, metric)
+        series = self._series.get(key)
+        if series is None:
+            # 系列数の上限を超える場合は記録しない (メモリ使用量を一定に保つ)
+            if len(self._series) >= self.max_series:
+                self.rejected += 1
+                return False
+            series = Series(self.raw_capacity, self.minute_capacity, self.hour_capacity)
+            self._series[key] = series
+        series.record(int(time.time() if timestamp is None else timestamp), float(value))
+        return True
+
+    def series(self, router: Optional[str] = None) -> List[Dict[str, str]]:
+        return [
+            {"router": key[0], "interface": key[1], "metric": key[2]}
+            for key in self._series
+            if router is None or key[0] == router
+        ]
+
+    def _choose_resolution(self, series: Series, start: int) -> str:
+        # 開始時刻を含む最も細かい解像度を選ぶ
+        # どれも届かない場合は最も長い期間のデータを持つ解像度を使う
+        chosen = "raw"
+        for name, ring in (("raw", series.raw), ("1m", series.minute), ("1h", series.hour)):
+            oldest = ring.oldest()
+            if oldest is None:
+                continue
+            if oldest <= start:
+                return name
+            chosen = name
+        return chosen
+
+    def query(self, router: str, interface: str, metric: str, start: Optional[float] = None,
+              end: Optional[float] = None, resolution: str = "auto") -> Dict[str, Any]:
+        if resolution != "auto" and resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        series = self._series.get((router, interface, metric))
+        end_ts = int(time.time() if end is None else end)
+        start_ts = int(end_ts - 3600 if start is None else start)
+        if series is None:
+            return {"resolution": resolution, "points": [], "aggregate": self._aggregate_empty()}
+        if resolution == "auto":
+            resolution = self._choose_resolution(series, start_ts)
+
+        if resolution == "raw":
+            raw_points = series.raw.range(start_ts, end_ts)
+            points = [{"t": timestamp, "value": values[0]} for timestamp, values in raw_points]
+            values = [values[0] for _, values in raw_points]
+            aggregate = self._aggregate_empty() if not values else {
+                "min": min(values),
+                "avg": sum(values) / len(values),
+                "max": max(values),
+                "p95": _percentile(values, 0.95),
+                "count": len(values),
+            }
+            return {"resolution": resolution, "points": points, "aggregate": aggregate}
+
+        rows = series.tier(RESOLUTIONS[resolution]).range(start_ts, end_ts)
+        points = [{
+            "t": timestamp,
+            "min": minimum,
+            "avg": total / count if count else math.nan,
+            "max": maximum,
+            "p95": p95,
+            "count": int(count),
+        } for timestamp, (minimum, maximum, total, count, p95) in rows]
+        if not rows:
+            return {"resolution": resolution, "points": points, "aggregate": self._aggregate_empty()}
+        total = sum(row[1][2] for row in rows)
+        count = sum(row[1][3] for row in rows)
+        aggregate = {
+            "min": min(row[1][0] for row in rows),
+            "avg": total / count if count else math.nan,
+            "max": max(row[1][1] for row in rows),
+            # ダウンサンプリング後のp95はバケットごとのp95から求めた近似値
+            "p95": _percentile([row[1][4] for row in rows], 0.95),
+            "count": int(count),
+        }
+        return {"resolution": resolution, "points": points, "aggregate": aggregate}
+
+    @staticmethod
+    def _aggregate_empty() -> Dict[str, Any]:
+        return {"min": None, "avg": None, "max": None, "p95": None, "count": 0}
+
+    def roll_up(self, now: Optional[float] = None):
+        now_ts = int(time.time() if now is None else now)
+        for series in self._series.values():
+            series.roll_up(now_ts)
+
+    def start(self, interval: float = 60.0):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.roll_up()
+            except Exception as e:
+                logger.error(f"Time series roll-up failed: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def bytes_per_series(self) -> int:
+        # 集計中のバケット (分・時間) がサンプルを上限まで持った場合を含む
+        pending = 2 * array("d").itemsize * MAX_PENDING_SAMPLES
+        return Series(self.raw_capacity, self.minute_capacity, self.hour_capacity).nbytes() + pending
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "series": len(self._series),
+            "max_series": self.max_series,
+            "rejected": self.rejected,
+            "buffer_bytes": sum(series.nbytes() for series in self._series.values()),
+            "max_buffer_bytes": self.max_series * self.bytes_per_series(),
+        }
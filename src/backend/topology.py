@@ -0,0 +1,358 @@
+# ルーター群のトポロジーグラフ
+# インターフェースのサブネットからセグメントを作り、ルーターとセグメントを辺で結ぶ
+# 始点ごとの最短経路木をキャッシュし、リンクの断・復旧では影響を受けた部分木だけを修復する
+
+import heapq
+import ipaddress
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+CORE = "core"
+DEFAULT_MASK = "255.255.255.0"
+
+def segment_node(network: ipaddress.IPv4Network) -> str:
+    return f"net:{network}"
+
+def host_node(ip: str) -> str:
+    return f"host:{ip}"
+
+def node_type(node: str) -> str:
+    if node == CORE:
+        return "core"
+    if node.startswith("net:"):
+        return "segment"
+    if node.startswith("host:"):
+        return "host"
+    return "device"
+
+class _Interface:
+    __slots__ = ("name", "ip", "mask", "network", "up")
+
+    def __init__(self, name: str, ip: Optional[str], mask: Optional[str],
+                 network: Optional[ipaddress.IPv4Network], up: bool):
+        self.name = name
+        self.ip = ip
+        self.mask = mask
+        self.network = network
+        self.up = up
+
+class _Tree:
+    # 始点からの最短経路木 (辺の重みはすべて1)
+    __slots__ = ("dist", "parent", "children")
+
+    def __init__(self):
+        self.dist: Dict[str, int] = {}
+        self.parent: Dict[str, Optional[str]] = {}
+        self.children: Dict[str, Set[str]] = {}
+
+    def attach(self, node: str, parent: Optional[str], dist: int):
+        old = self.parent.get(node)
+        if old is not None:
+            self.children[old].discard(node)
+        self.dist[node] = dist
+        self.parent[node] = parent
+        if parent is not None:
+            self.children.setdefault(parent, set()).add(node)
+
+    def subtree(self, node: str) -> Set[str]:
+        nodes = {node}
+        stack = [node]
+        while stack:
+            for child in self.children.get(stack.pop(), ()):
+                if child not in nodes:
+                    nodes.add(child)
+                    stack.append(child)
+        return nodes
+
+class TopologyGraph:
+    def __init__(self, max_trees: int = 256):
+        self.max_trees = max_trees
+        # 隣接ノード -> その接続を支える辺のID (同じ2ノード間に複数の辺があり得る)
+        self._adjacency: Dict[str, Dict[str, Set[Hashable]]] = {}
+        self._edges: Dict[Hashable, Tuple[str, str]] = {}
+        self.devices: Dict[str, Dict[str, _Interface]] = {}
+        self.sites: Dict[str, str] = {}
+        # IP -> (デバイス, インターフェース) とプレフィックス長ごとのセグメント索引
+        self._ip_index: Dict[str, Tuple[str, str]] = {}
+        self._segments: Dict[int, Dict[int, ipaddress.IPv4Network]] = {}
+        self._trees: "OrderedDict[str, _Tree]" = OrderedDict()
+        self.tree_builds = 0
+        self.repairs = 0
+
+    # グラフの構築と更新
+    def _add_edge(self, edge_id: Hashable, a: str, b: str):
+        if edge_id in self._edges:
+            return
+        self._edges[edge_id] = (a, b)
+        self._adjacency.setdefault(b, {})
+        supports = self._adjacency.setdefault(a, {}).get(b)
+        if supports is None:
+            self._adjacency[a][b] = {edge_id}
+            self._adjacency[b][a] = {edge_id}
+            self._on_link_up(a, b)
+        else:
+            supports.add(edge_id)
+
+    def _remove_edge(self, edge_id: Hashable):
+        ends = self._edges.pop(edge_id, None)
+        if ends is None:
+            return
+        a, b = ends
+        supports = self._adjacency[a][b]
+        supports.discard(edge_id)
+        if not supports:
+            del self._adjacency[a][b]
+            del self._adjacency[b][a]
+            self._on_link_down(a, b)
+
+    def set_interface(self, device: str, name: str, ip: Optional[str], mask: Optional[str], up: bool):
+        interfaces = self.devices.setdefault(device, {})
+        self._adjacency.setdefault(device, {})
+        if not ip or ip == "unassigned":
+            ip = None
+        current = interfaces.get(name)
+        if current is not None and (current.ip, current.mask) == (ip, mask):
+            # アドレスが変わらなければサブネットを計算し直さない (状態の変化だけの更新が多いため)
+            if current.up == up:
+                return
+            network = current.network
+        else:
+            network = ipaddress.ip_network(f"{ip}/{mask or DEFAULT_MASK}", strict=False) if ip else None
+        if current is not None:
+            if current.ip is not None and self._ip_index.get(current.ip) == (device, name):
+                del self._ip_index[current.ip]
+            self._remove_edge((device, name))
+        interfaces[name] = _Interface(name, ip, mask, network, up)
+        if ip is not None:
+            self._ip_index[ip] = (device, name)
+            self._segments.setdefault(network.prefixlen, {})[int(network.network_address)] = network
+            if up:
+                self._add_edge((device, name), device, segment_node(network))
+
+    def update_device(self, device: str, interfaces: Dict[str, Dict[str, Any]],
+                      masks: Optional[Dict[str, str]] = None, site: Optional[str] = None):
+        # 変化したインターフェースだけが辺の追加・削除になる
+        masks = masks or {}
+        if site is not None:
+            self.sites[device] = site
+        for name, interface in interfaces.items():
+            up = interface.get("status") == "up" and interface.get("protocol") == "up"
+            self.set_interface(device, name, interface.get("ip"), masks.get(name), up)
+
+    def add_link(self, device: str, interface: str, peer: str):
+        # 対向のインターフェースが分からない接続 (WANコアなど) はセグメントと対向ノードを結ぶ
+        network = self.devices.get(device, {}).get(interface)
+        if network is None or network.network is None:
+            return
+        self._add_edge(("link", device, interface, peer), segment_node(network.network), peer)
+
+    def add_traceroute(self, source: str, hops: Iterable[Dict[str, Any]]):
+        # 既知のインターフェースを通る区間はサブネットから分かっているため、未知のホップだけを追加する
+        # 既知のセグメントに含まれるホップはそのセグメントに、それ以外は直前のホップに繋ぐ
+        previous = source
+        for hop in hops:
+            ip = hop.get("ip")
+            if not ip or ip == "*":
+                continue
+            known = self._ip_index.get(ip)
+            if known is not None:
+                previous = known[0]
+                continue
+            node = host_node(ip)
+            segment = self.resolve(ip)
+            anchor = segment["node"] if segment is not None and node_type(previous) != "host" else previous
+            if anchor != node:
+                self._add_edge(("trace", anchor, node), anchor, node)
+            previous = node
+
+    # 最短経路木のキャッシュ
+    def _tree(self, source: str) -> _Tree:
+        tree = self._trees.get(source)
+        if tree is not None:
+            self._trees.move_to_end(source)
+            return tree
+        tree = _Tree()
+        tree.attach(source, None, 0)
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            for neighbor in self._adjacency.get(node, ()):
+                if neighbor not in tree.dist:
+                    tree.attach(neighbor, node, tree.dist[node] + 1)
+                    queue.append(neighbor)
+        self._trees[source] = tree
+        self.tree_builds += 1
+        while len(self._trees) > self.max_trees:
+            self._trees.popitem(last=False)
+        return tree
+
+    def _detach(self, tree: _Tree, a: str, b: str, blocked: Set[Tuple[str, str]]) -> Tuple[Set[str], Dict[str, Tuple[int, str]]]:
+        # a-b が木の辺でなければ最短距離は変わらない
+        if tree.parent.get(b) == a:
+            child = b
+        elif tree.parent.get(a) == b:
+            child = a
+        else:
+            return set(), {}
+        detached = tree.subtree(child)
+        # 切り離された部分木の外側に残ったノードから、距離の小さい順に繋ぎ直す
+        heap: List[Tuple[int, str, str]] = []
+        for node in detached:
+            for neighbor in self._adjacency.get(node, ()):
+                if neighbor not in detached and neighbor in tree.dist and (node, neighbor) not in blocked:
+                    heapq.heappush(heap, (tree.dist[neighbor] + 1, node, neighbor))
+        reattached: Dict[str, Tuple[int, str]] = {}
+        while heap:
+            dist, node, parent = heapq.heappop(heap)
+            if node in reattached:
+                continue
+            reattached[node] = (dist, parent)
+            for neighbor in self._adjacency.get(node, ()):
+                if neighbor in detached and neighbor not in reattached and (node, neighbor) not in blocked:
+                    heapq.heappush(heap, (dist + 1, neighbor, node))
+        return detached, reattached
+
+    def _on_link_down(self, a: str, b: str):
+        for tree in self._trees.values():
+            detached, reattached = self._detach(tree, a, b, set())
+            if not detached:
+                continue
+            self.repairs += 1
+            for node in detached:
+                parent = tree.parent.pop(node)
+                del tree.dist[node]
+                if parent is not None and parent not in detached:
+                    tree.children[parent].discard(node)
+                tree.children.pop(node, None)
+            for node, (dist, parent) in sorted(reattached.items(), key=lambda item: item[1][0]):
+                tree.attach(node, parent, dist)
+
+    def _on_link_up(self, a: str, b: str):
+        for tree in self._trees.values():
+            for near, far in ((a, b), (b, a)):
+                if near not in tree.dist or tree.dist.get(far, tree.dist[near] + 2) <= tree.dist[near] + 1:
+                    continue
+                self.repairs += 1
+                # 新しい辺で近くなったノードから距離の改善を伝播させる
+                tree.attach(far, near, tree.dist[near] + 1)
+                queue = deque([far])
+                while queue:
+                    node = queue.popleft()
+                    for neighbor in self._adjacency.get(node, ()):
+                        if tree.dist.get(neighbor, tree.dist[node] + 2) > tree.dist[node] + 1:
+                            tree.attach(neighbor, node, tree.dist[node] + 1)
+                            queue.append(neighbor)
+
+    # 問い合わせ
+    def resolve(self, address: str) -> Optional[Dict[str, Any]]:
+        # IP -> インターフェース -> デバイス、直結していなければ含まれるセグメントを返す
+        known = self._ip_index.get(address)
+        if known is not None:
+            device, name = known
+            interface = self.devices[device][name]
+            return {"node": device, "type": "device", "device": device, "interface": name,
+                    "network": str(interface.network), "up": interface.up, "site": self.sites.get(device)}
+        value = int(ipaddress.ip_address(address))
+        for prefixlen in sorted(self._segments, reverse=True):
+            mask = (0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF
+            network = self._segments[prefixlen].get(value & mask)
+            if network is not None:
+                return {"node": segment_node(network), "type": "segment", "network": str(network)}
+        return None
+
+    def _node_for(self, target: str) -> Optional[str]:
+        if target in self._adjacency:
+            return target
+        if host_node(target) in self._adjacency:
+            return host_node(target)
+        resolved = self.resolve(target)
+        return resolved["node"] if resolved is not None else None
+
+    def _edge_interfaces(self, a: str, b: str) -> List[str]:
+        return sorted(edge[1] for edge in self._adjacency[a][b]
+                      if isinstance(edge, tuple) and len(edge) == 2 and edge[0] in (a, b))
+
+    def path(self, source: str, target: str) -> Dict[str, Any]:
+        src, dst = self._node_for(source), self._node_for(target)
+        if src is None or dst is None:
+            raise KeyError(source if src is None else target)
+        tree = self._tree(src)
+        if dst not in tree.dist:
+            return {"source": src, "target": dst, "reachable": False, "hops": None, "path": []}
+        nodes = [dst]
+        while nodes[-1] != src:
+            nodes.append(tree.parent[nodes[-1]])
+        nodes.reverse()
+        path = []
+        for index, node in enumerate(nodes):
+            entry: Dict[str, Any] = {"node": node, "type": node_type(node)}
+            if entry["type"] == "device":
+                # このデバイスが経路上で使うインターフェース
+                entry["interfaces"] = [name for neighbor in nodes[max(0, index - 1):index + 2] if neighbor != node
+                                       for name in self._edge_interfaces(node, neighbor)]
+            path.append(entry)
+        return {"source": src, "target": dst, "reachable": True,
+                "hops": sum(1 for entry in path if entry["type"] != "segment") - 1, "path": path}
+
+    def _site_summary(self, devices: Iterable[str]) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for device in devices:
+            site = self.sites.get(device, "unknown")
+            counts[site] = counts.get(site, 0) + 1
+        return counts
+
+    def reachability(self, source: str) -> Dict[str, Any]:
+        src = self._node_for(source)
+        if src is None:
+            raise KeyError(source)
+        tree = self._tree(src)
+        unreachable = sorted(device for device in self.devices if device not in tree.dist)
+        return {
+            "source": src,
+            "reachable_devices": len(self.devices) - len(unreachable),
+            "unreachable_devices": unreachable,
+            "unreachable_sites": self._site_summary(unreachable),
+        }
+
+    def impact(self, device: str, interface: str, root: str = CORE) -> Dict[str, Any]:
+        # インターフェースが落ちた場合に root から到達できなくなるデバイスと拠点 (グラフは変更しない)
+        started = time.perf_counter()
+        if device not in self.devices or interface not in self.devices[device]:
+            raise KeyError(f"{device} {interface}")
+        src = self._node_for(root)
+        if src is None:
+            raise KeyError(root)
+        tree = self._tree(src)
+        state = self.devices[device][interface]
+        lost: Set[str] = set()
+        if state.up and state.network is not None:
+            segment = segment_node(state.network)
+            if len(self._adjacency[device][segment]) == 1:
+                detached, reattached = self._detach(tree, device, segment, {(device, segment), (segment, device)})
+                lost = {node for node in detached if node not in reattached and node_type(node) == "device"}
+        site_totals = self._site_summary(self.devices)
+        lost_sites = self._site_summary(lost)
+        return {
+            "device": device,
+            "interface": interface,
+            "root": src,
+            "already_down": not state.up,
+            "lost_devices": sorted(lost),
+            "lost_sites": sorted(site for site, count in lost_sites.items() if count == site_totals.get(site)),
+            "degraded_sites": {site: count for site, count in sorted(lost_sites.items())
+                               if count < site_totals.get(site, 0)},
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+        }
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "nodes": len(self._adjacency),
+            "links": sum(len(neighbors) for neighbors in self._adjacency.values()) // 2,
+            "devices": len(self.devices),
+            "segments": sum(len(segments) for segments in self._segments.values()),
+            "indexed_ips": len(self._ip_index),
+            "cached_trees": len(self._trees),
+            "tree_builds": self.tree_builds,
+            "repairs": self.repairs,
+        }
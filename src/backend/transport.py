@@ -0,0 +1,457 @@
+# ルーター接続用のトランスポート層
+# SSH/Telnetセッションをデバイスごとにプールして再利用する
+
+import asyncio
+import logging
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import asyncssh
+except ImportError:  # asyncsshが無い環境ではTelnetのみ利用可能
+    asyncssh = None
+
+logger = logging.getLogger(__name__)
+
+# IOSのプロンプト (例: "Router>" / "Router#" / "Router(config)#")
+PROMPT_PATTERN = re.compile(r"^[\w.\-]+(\([\w\-]+\))?[>#]\s*$")
+PASSWORD_PATTERN = re.compile(r"[Pp]assword:\s*$")
+USERNAME_PATTERN = re.compile(r"([Uu]sername|[Ll]ogin):\s*$")
+
+# Telnetのネゴシエーション用バイト
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+
+def known_hosts_from_env():
+    # SSHのホスト鍵は既定で ~/.ssh/known_hosts (SSH_KNOWN_HOSTS で別のファイルを指定) と照合する
+    # 検証を無効にする場合は SSH_VERIFY_HOST_KEY=0 を明示的に指定する (中間者攻撃で認証情報が漏れるため検証環境のみ)
+    if os.environ.get("SSH_VERIFY_HOST_KEY", "1").lower() in ("0", "false", "no"):
+        logger.warning("SSH host key verification is disabled (SSH_VERIFY_HOST_KEY=0)")
+        return None
+    return os.environ.get("SSH_KNOWN_HOSTS") or ()
+
+class TransportError(Exception):
+    pass
+
+class AuthenticationError(TransportError):
+    pass
+
+class DeviceParams:
+    def __init__(
+        self,
+        host: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        enable_password: Optional[str] = None,
+        connection_type: str = "ssh",
+        port: Optional[int] = None,
+    ):
+        if connection_type not in ("ssh", "telnet"):
+            raise TransportError(f"Unsupported connection type: {connection_type}")
+        self.host = host
+        self.username = username
+        self.password = password
+        self.enable_password = enable_password
+        self.connection_type = connection_type
+        self.port = port or (22 if connection_type == "ssh" else 23)
+
+    @property
+    def key(self) -> Tuple[str, int, str, Optional[str], int]:
+        # 認証情報が異なる場合はセッションを共有しない
+        return (self.host, self.port, self.connection_type, self.username,
+                hash((self.password, self.enable_password)))
+
+class CLISession:
+    # 対話型CLIセッションの共通処理 (プロンプト待ち・enableモード)
+    def __init__(self, params: DeviceParams, timeout: float = 10.0):
+        self.params = params
+        self.timeout = timeout
+        self.prompt = ""
+        self.privileged = False
+        self.last_used = time.monotonic()
+        self.created_at = self.last_used
+        self.commands_run = 0
+        self._buffer = ""
+        self._lock = asyncio.Lock()
+
+    async def _read_chunk(self) -> str:
+        raise NotImplementedError
+
+    async def _write(self, data: str):
+        raise NotImplementedError
+
+    async def _connect(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    @property
+    def is_alive(self) -> bool:
+        raise NotImplementedError
+
+    async def _read_until(self, *patterns: re.Pattern) -> Tuple[str, re.Pattern]:
+        # 最終行がいずれかのパターンに一致するまで読み込む
+        async def read():
+            while True:
+                last_line = self._buffer.rsplit("\n", 1)[-1].rstrip("\r")
+                for pattern in patterns:
+                    if pattern.search(last_line):
+                        data, self._buffer = self._buffer, ""
+                        return data, pattern
+                chunk = await self._read_chunk()
+                if not chunk:
+                    raise TransportError(f"Connection to {self.params.host} closed")
+                self._buffer += chunk.replace("\r", "")
+
+        try:
+            return await asyncio.wait_for(read(), self.timeout)
+        except asyncio.TimeoutError:
+            raise TransportError(f"Timed out waiting for prompt from {self.params.host}")
+
+    async def open(self):
+        await self._connect()
+        await self._login()
+        if self.params.enable_password and not self.privileged:
+            await self._enable()
+        # ページングを無効化する
+        await self.run("terminal length 0")
+        self.commands_run = 0
+
+    async def _login(self):
+        # Telnetや一部のSSHサーバーはCLI上で認証を求める
+        for _ in range(4):
+            try:
+                data, pattern = await self._read_until(PROMPT_PATTERN, USERNAME_PATTERN, PASSWORD_PATTERN)
+            except TransportError:
+                if "authentication failed" in self._buffer.lower():
+                    raise AuthenticationError(f"Authentication failed for {self.params.host}")
+                raise
+            if "authentication failed" in data.lower() or "access denied" in data.lower():
+                raise AuthenticationError(f"Authentication failed for {self.params.host}")
+            if pattern is USERNAME_PATTERN:
+                await self._write(f"{self.params.username or ''}\n")
+            elif pattern is PASSWORD_PATTERN:
+                await self._write(f"{self.params.password or ''}\n")
+            else:
+                self._set_prompt(data)
+                return
+        raise AuthenticationError(f"Authentication failed for {self.params.host}")
+
+    async def _enable(self):
+        await self._write("enable\n")
+        data, pattern = await self._read_until(PROMPT_PATTERN, PASSWORD_PATTERN)
+        if pattern is PASSWORD_PATTERN:
+            await self._write(f"{self.params.enable_password}\n")
+            data, pattern = await self._read_until(PROMPT_PATTERN, PASSWORD_PATTERN)
+            if pattern is PASSWORD_PATTERN:
+                raise AuthenticationError(f"Enable password rejected by {self.params.host}")
+        self._set_prompt(data)
+        if not self.privileged:
+            raise AuthenticationError(f"Failed to enter enable mode on {self.params.host}")
+
+    def _set_prompt(self, data: str):
+        self.prompt = data.rsplit("\n", 1)[-1].strip()
+        self.privileged = self.prompt.endswith("#")
+
+    async def run(self, command: str) -> str:
+        async with self._lock:
+            await self._write(f"{command}\n")
+            data, _ = await self._read_until(PROMPT_PATTERN)
+            self._set_prompt(data)
+            self.last_used = time.monotonic()
+            self.commands_run += 1
+            # エコーされたコマンドと末尾のプロンプトを除去する
+            lines = data.split("\n")
+            if lines and lines[0].strip() == command.strip():
+                lines = lines[1:]
+            return "\n".join(lines[:-1]).strip("\n").rstrip()
+
+    async def keepalive(self):
+        async with self._lock:
+            await self._write("\n")
+            data, _ = await self._read_until(PROMPT_PATTERN)
+            self._set_prompt(data)
+
+class TelnetSession(CLISession):
+    def __init__(self, params: DeviceParams, timeout: float = 10.0):
+        super().__init__(params, timeout)
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def _connect(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.params.host, self.params.port), self.timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise TransportError(f"Telnet connection to {self.params.host} failed: {e}")
+
+    async def _read_chunk(self) -> str:
+        # ネゴシエーションのみのパケットは読み飛ばす (空文字列は切断を意味する)
+        while True:
+            raw = await self._reader.read(4096)
+            if not raw:
+                return ""
+            data = self._strip_negotiation(raw)
+            if data:
+                return data.decode("utf-8", errors="replace")
+
+    def _strip_negotiation(self, raw: bytes) -> bytes:
+        # オプションのネゴシエーションは全て拒否する
+        out = bytearray()
+        replies = bytearray()
+        i = 0
+        while i < len(raw):
+            b = raw[i]
+            if b != IAC or i + 1 >= len(raw):
+                out.append(b)
+                i += 1
+                continue
+            cmd = raw[i + 1]
+            if cmd in (DO, DONT, WILL, WONT) and i + 2 < len(raw):
+                option = raw[i + 2]
+                if cmd == DO:
+                    replies += bytes([IAC, WONT, option])
+                elif cmd == WILL:
+                    replies += bytes([IAC, DONT, option])
+                i += 3
+            elif cmd == SB:
+                end = raw.find(bytes([IAC, SE]), i)
+                i = len(raw) if end < 0 else end + 2
+            elif cmd == IAC:
+                out.append(IAC)
+                i += 2
+            else:
+                i += 2
+        if replies and self._writer is not None:
+            self._writer.write(bytes(replies))
+        return bytes(out)
+
+    async def _write(self, data: str):
+        self._writer.write(data.replace("\n", "\r\n").encode())
+        await self._writer.drain()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+            self._writer = None
+
+    @property
+    def is_alive(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+class SSHSession(CLISession):
+    def __init__(self, params: DeviceParams, timeout: float = 10.0, known_hosts=()):
+        super().__init__(params, timeout)
+        # asyncssh の known_hosts 引数 (() は既定のファイル、None は検証しない)
+        self.known_hosts = known_hosts
+        self._conn = None
+        self._process = None
+
+    async def _connect(self):
+        if asyncssh is None:
+            raise TransportError("SSH transport requires the asyncssh package")
+        try:
+            self._conn = await asyncio.wait_for(
+                asyncssh.connect(
+                    self.params.host,
+                    port=self.params.port,
+                    username=self.params.username,
+                    password=self.params.password,
+                    known_hosts=self.known_hosts,
+                ),
+                self.timeout,
+            )
+            # IOSはexecチャネルでの複数コマンド実行に対応しないため対話シェルを使用する
+            self._process = await self._conn.create_process(term_type="vt100")
+        except asyncssh.PermissionDenied as e:
+            raise AuthenticationError(f"Authentication failed for {self.params.host}: {e}")
+        except asyncssh.HostKeyNotVerifiable as e:
+            raise TransportError(f"Host key of {self.params.host} is not trusted: {e}")
+        except (OSError, asyncssh.Error, asyncio.TimeoutError) as e:
+            raise TransportError(f"SSH connection to {self.params.host} failed: {e}")
+
+    async def _read_chunk(self) -> str:
+        return await self._process.stdout.read(4096)
+
+    async def _write(self, data: str):
+        self._process.stdin.write(data)
+
+    async def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            try:
+                await self._conn.wait_closed()
+            except Exception:
+                pass
+            self._conn = None
+
+    @property
+    def is_alive(self) -> bool:
+        return self._conn is not None and self._process is not None and not self._process.stdout.at_eof()
+
+SESSION_TYPES = {
+    "ssh": SSHSession,
+    "telnet": TelnetSession,
+}
+
+class _DevicePool:
+    def __init__(self, max_sessions: int):
+        self.idle: List[CLISession] = []
+        self.semaphore = asyncio.Semaphore(max_sessions)
+        # セッションを待っている・開いている・使っている呼び出しの数 (0 の場合のみプールを破棄できる)
+        self.users = 0
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+
+class SessionPool:
+    # デバイスごとに認証済みセッションを保持し、キープアライブとアイドル破棄を行う
+    def __init__(
+        self,
+        max_sessions_per_device: int = 2,
+        idle_timeout: float = 300.0,
+        keepalive_interval: float = 60.0,
+        command_timeout: float = 10.0,
+        known_hosts=None,
+    ):
+        self.max_sessions_per_device = max_sessions_per_device
+        self.known_hosts = known_hosts_from_env() if known_hosts is None else known_hosts
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.command_timeout = command_timeout
+        self._pools: Dict[tuple, _DevicePool] = {}
+        self._maintenance_task: Optional[asyncio.Task] = None
+
+    def _pool_for(self, params: DeviceParams) -> _DevicePool:
+        pool = self._pools.get(params.key)
+        if pool is None:
+            pool = _DevicePool(self.max_sessions_per_device)
+            self._pools[params.key] = pool
+        return pool
+
+    def _ensure_maintenance(self):
+        if self._maintenance_task is None or self._maintenance_task.done():
+            self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+
+    async def _open_session(self, params: DeviceParams) -> CLISession:
+        options = {"known_hosts": self.known_hosts} if params.connection_type == "ssh" else {}
+        session = SESSION_TYPES[params.connection_type](params, self.command_timeout, **options)
+        try:
+            await session.open()
+        except Exception:
+            await session.close()
+            raise
+        logger.info(f"Opened {params.connection_type} session to {params.host}:{params.port}")
+        return session
+
+    @asynccontextmanager
+    async def session(self, params: DeviceParams):
+        self._ensure_maintenance()
+        pool = self._pool_for(params)
+        pool.users += 1
+        try:
+            async with pool.semaphore:
+                session = None
+                while pool.idle:
+                    candidate = pool.idle.pop()
+                    if candidate.is_alive:
+                        session = candidate
+                        pool.reused += 1
+                        break
+                    await candidate.close()
+                if session is None:
+                    session = await self._open_session(params)
+                    pool.created += 1
+                pool.in_use += 1
+                healthy = True
+                try:
+                    yield session
+                except BaseException:
+                    # 途中で失敗・取り消されたセッションは状態が不明なので再利用しない
+                    healthy = False
+                    raise
+                finally:
+                    pool.in_use -= 1
+                    if healthy and session.is_alive:
+                        pool.idle.append(session)
+                    else:
+                        await session.close()
+        finally:
+            pool.users -= 1
+
+    async def run(self, params: DeviceParams, command: str) -> str:
+        async with self.session(params) as session:
+            return await session.run(command)
+
+    async def run_batch(self, params: DeviceParams, commands: Sequence[str]) -> AsyncIterator[Tuple[str, str]]:
+        # 1つのセッションを確保したまま続けて実行し、コマンドごとに出力を返す
+        async with self.session(params) as session:
+            for command in commands:
+                yield command, await session.run(command)
+
+    async def verify(self, params: DeviceParams):
+        # 接続と認証を確認し、確立したセッションをプールに残す
+        async with self.session(params):
+            pass
+
+    async def _maintenance_loop(self):
+        while True:
+            await asyncio.sleep(min(self.keepalive_interval, self.idle_timeout))
+            try:
+                await self._maintain()
+            except Exception as e:
+                logger.error(f"Session pool maintenance failed: {e}")
+
+    async def _maintain(self):
+        now = time.monotonic()
+        for key, pool in list(self._pools.items()):
+            # 確認中に貸し出されたり返却されたりしても取り違えないよう、待機中のセッションを先に取り外す
+            idle, pool.idle = pool.idle, []
+            keep = []
+            for session in idle:
+                if not session.is_alive or now - session.last_used > self.idle_timeout:
+                    logger.info(f"Evicting idle session to {key[0]}:{key[1]}")
+                    await session.close()
+                    continue
+                if now - session.last_used > self.keepalive_interval:
+                    try:
+                        await session.keepalive()
+                    except TransportError:
+                        await session.close()
+                        continue
+                keep.append(session)
+            # 確認中に返却されたセッションと合わせ、上限を超えた分は閉じる
+            pool.idle.extend(keep)
+            while len(pool.idle) > self.max_sessions_per_device:
+                await pool.idle.pop(0).close()
+            if not pool.idle and pool.users == 0 and self._pools.get(key) is pool:
+                del self._pools[key]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        # 同じデバイスへの認証情報ごとのプールはデバイス単位で合計する
+        totals: Dict[str, Dict[str, int]] = {}
+        for key, pool in self._pools.items():
+            entry = totals.setdefault(f"{key[2]}://{key[0]}:{key[1]}",
+                                      {"idle": 0, "in_use": 0, "created": 0, "reused": 0})
+            entry["idle"] += len(pool.idle)
+            entry["in_use"] += pool.in_use
+            entry["created"] += pool.created
+            entry["reused"] += pool.reused
+        return totals
+
+    async def close(self):
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        for pool in self._pools.values():
+            for session in pool.idle:
+                await session.close()
+        self._pools.clear()
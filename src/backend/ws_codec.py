@@ -0,0 +1,103 @@
+# WebSocketのメッセージ形式
+# クライアントはサブプロトコル (例: "nt.msgpack", "nt.cbor", "nt.json") で形式を指定し、指定が無ければ従来のJSONテキストを使う
+# まとめて送る場合は個々のメッセージを配列にした1フレームを送る (単独のメッセージはオブジェクトのまま)
+# 同じメッセージを複数のクライアントに送る場合は、メッセージごとのメモに形式別のエンコード結果を共有する
+
+import json
+import struct
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:  # msgpackが無い環境ではMessagePack形式を提供しない
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # cbor2が無い環境ではCBOR形式を提供しない
+    cbor2 = None
+
+SUBPROTOCOL_PREFIX = "nt."
+DEFAULT_CODEC = "json"
+
+def _json_dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+def _msgpack_array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 0x10000:
+        return b"\xdc" + struct.pack(">H", length)
+    return b"\xdd" + struct.pack(">I", length)
+
+def _cbor_array_header(length: int) -> bytes:
+    if length < 24:
+        return bytes([0x80 | length])
+    if length < 0x100:
+        return bytes([0x98, length])
+    if length < 0x10000:
+        return b"\x99" + struct.pack(">H", length)
+    return b"\x9a" + struct.pack(">I", length)
+
+class Codec:
+    def __init__(self, name: str, binary: bool, encode: Callable[[Any], Union[str, bytes]],
+                 decode: Callable[[Union[str, bytes]], Any], array_header: Optional[Callable[[int], bytes]] = None):
+        self.name = name
+        self.binary = binary
+        self._encode = encode
+        self._decode = decode
+        self._array_header = array_header
+        self.encoded = 0
+        self.cache_hits = 0
+
+    def encode(self, value: Any, memo: Optional[Dict[str, Union[str, bytes]]] = None) -> Union[str, bytes]:
+        # memo はメッセージごとの辞書 - 同じメッセージを同じ形式で送るクライアントの間でエンコード結果を共有する
+        if memo is not None:
+            cached = memo.get(self.name)
+            if cached is not None:
+                self.cache_hits += 1
+                return cached
+        encoded = self._encode(value)
+        self.encoded += 1
+        if memo is not None:
+            memo[self.name] = encoded
+        return encoded
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        # ライブラリごとに異なる例外をValueErrorにそろえる
+        try:
+            return self._decode(data)
+        except Exception as e:
+            raise ValueError(f"Cannot decode {self.name} message ({type(e).__name__})") from e
+
+    def join(self, parts: Sequence[Union[str, bytes]]) -> Union[str, bytes]:
+        # エンコード済みのメッセージを連結して配列にする (メッセージ全体を作り直さない)
+        if not self.binary:
+            return "[" + ",".join(parts) + "]"
+        return self._array_header(len(parts)) + b"".join(parts)
+
+def _build_codecs() -> Dict[str, Codec]:
+    codecs = {"json": Codec("json", False, _json_dumps, json.loads)}
+    if msgpack is not None:
+        codecs["msgpack"] = Codec("msgpack", True, lambda value: msgpack.packb(value, use_bin_type=True),
+                                  lambda data: msgpack.unpackb(data, raw=False), _msgpack_array_header)
+    if cbor2 is not None:
+        codecs["cbor"] = Codec("cbor", True, cbor2.dumps, cbor2.loads, _cbor_array_header)
+    return codecs
+
+CODECS = _build_codecs()
+
+def negotiate(subprotocols: Sequence[str]) -> Tuple[Codec, Optional[str]]:
+    # クライアントが示した順に、このサーバーで使える最初の形式を選ぶ
+    for subprotocol in subprotocols:
+        if subprotocol.startswith(SUBPROTOCOL_PREFIX):
+            codec = CODECS.get(subprotocol[len(SUBPROTOCOL_PREFIX):])
+            if codec is not None:
+                return codec, subprotocol
+    return CODECS[DEFAULT_CODEC], None
+
+def available() -> List[str]:
+    return [SUBPROTOCOL_PREFIX + name for name in CODECS]
+
+def stats() -> Dict[str, Dict[str, int]]:
+    return {name: {"encoded": codec.encoded, "cache_hits": codec.cache_hits} for name, codec in CODECS.items()}